@@ -0,0 +1,219 @@
+import ast
+
+import numpy as np
+
+
+def column_index(node):
+    """
+    Return k if node is the expression sample_points[:, k], otherwise None.
+    """
+    if not (isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name) and node.value.id == 'sample_points'):
+        return None
+    if not (isinstance(node.slice, ast.ExtSlice) and len(node.slice.dims) == 2):
+        return None
+
+    rows, column = node.slice.dims
+    if not (isinstance(rows, ast.Slice) and rows.lower is None and rows.upper is None and rows.step is None):
+        return None
+    if isinstance(column, ast.Index) and isinstance(column.value, ast.Num) and isinstance(column.value.n, int):
+        return column.value.n
+    return None
+
+
+def linear_form(node):
+    """
+    If node is an affine function of the columns of sample_points, return a tuple (coefficients, constant) where
+    coefficients is a dictionary {column: coefficient}; otherwise return None.
+    """
+    if isinstance(node, ast.Num):
+        return {}, float(node.n)
+
+    column = column_index(node)
+    if column is not None:
+        return {column: 1.0}, 0.0
+
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.UAdd, ast.USub)):
+        form = linear_form(node.operand)
+        if form is None:
+            return None
+        sign = -1.0 if isinstance(node.op, ast.USub) else 1.0
+        return scale_form(form, sign)
+
+    if isinstance(node, ast.BinOp):
+        left = linear_form(node.left)
+        right = linear_form(node.right)
+        if left is None or right is None:
+            return None
+
+        if isinstance(node.op, (ast.Add, ast.Sub)):
+            sign = -1.0 if isinstance(node.op, ast.Sub) else 1.0
+            coefficients = dict(left[0])
+            for column, coefficient in right[0].items():
+                coefficients[column] = coefficients.get(column, 0.0) + sign * coefficient
+            return coefficients, left[1] + sign * right[1]
+
+        if isinstance(node.op, ast.Mult):
+            if len(left[0]) == 0:
+                return scale_form(right, left[1])
+            if len(right[0]) == 0:
+                return scale_form(left, right[1])
+
+        # a constant divided by a constant is left to python, whose integer division must be kept; a column divided by
+        # a constant is only a linear function of floating point columns, which CompiledFit.apply checks
+        if isinstance(node.op, ast.Div) and len(left[0]) > 0 and len(right[0]) == 0 and right[1] != 0:
+            return scale_form(left, 1.0 / right[1])
+
+    return None
+
+
+def scale_form(form, factor):
+    coefficients, constant = form
+    return dict((column, factor * coefficient) for column, coefficient in coefficients.items()), factor * constant
+
+
+def has_division(node):
+    """
+    Return True if node contains a division, whose result depends on the dtype of sample_points.
+    """
+    return any(isinstance(child, ast.BinOp) and isinstance(child.op, ast.Div) for child in ast.walk(node))
+
+
+def is_elementwise(node):
+    """
+    Return True if node only combines columns of sample_points elementwise, so that it can be evaluated on the rows of
+    all the simulations at once: arithmetic, abs, and numpy ufuncs and constants.
+    """
+    if isinstance(node, ast.Num) or column_index(node) is not None:
+        return True
+
+    if isinstance(node, ast.UnaryOp):
+        return is_elementwise(node.operand)
+
+    if isinstance(node, ast.BinOp):
+        return is_elementwise(node.left) and is_elementwise(node.right)
+
+    if numpy_attribute(node) is not None:
+        return isinstance(numpy_attribute(node), float)
+
+    if isinstance(node, ast.Call):
+        if node.keywords or node.starargs or node.kwargs:
+            return False
+        function = numpy_attribute(node.func)
+        if not (isinstance(function, np.ufunc) or (isinstance(node.func, ast.Name) and node.func.id == 'abs')):
+            return False
+        return all(is_elementwise(arg) for arg in node.args)
+
+    return False
+
+
+def numpy_attribute(node):
+    """
+    Return the numpy object named by node if node is of the form np.name, otherwise None.
+    """
+    if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id == 'np':
+        return getattr(np, node.attr, None)
+    return None
+
+
+class CompiledFit(object):
+
+    """Compiled form of the fitting instructions of one model.
+
+    Each instruction is a string, an expression of the columns sample_points[:, k] of a simulation (see
+    parse_info.parse_fitting_information). The instructions are parsed once: if they are all affine functions of the
+    columns, they are applied to the simulations as a single projection matrix, unless they divide integer simulations,
+    which python 2 divides by floor division. Otherwise each instruction is compiled to a code object, which is
+    evaluated on the rows of all the simulations at once if it is elementwise, and on each simulation in turn if it is
+    not (for example if it normalises a trajectory by its maximum).
+    """
+
+    def __init__(self, fitting_instruction):
+        """
+
+        Parameters
+        ----------
+        fitting_instruction : list of strings, one per dimension of the data, or None if the data are fitted to the
+            species in order
+
+        """
+        self.fitting_instruction = fitting_instruction
+        self.projection = None
+        self.codes = None
+        self.integer_projection = True
+
+        if fitting_instruction is None:
+            return
+
+        trees = [ast.parse(instruction.strip(), mode='eval') for instruction in fitting_instruction]
+        forms = [linear_form(tree.body) for tree in trees]
+
+        if all(form is not None for form in forms):
+            ncolumns = max([max(form[0].keys()) + 1 for form in forms if len(form[0]) > 0] + [0])
+            self.projection = np.zeros([ncolumns, len(forms)])
+            self.offset = np.zeros(len(forms))
+            for i, (coefficients, constant) in enumerate(forms):
+                for column, coefficient in coefficients.items():
+                    self.projection[column, i] = coefficient
+                self.offset[i] = constant
+
+            # the projection divides as true division, so integer simulations are divided by evaluating the code
+            self.integer_projection = not any(has_division(tree.body) for tree in trees)
+
+        if self.projection is None or not self.integer_projection:
+            self.codes = [compile(tree, '<fit>', 'eval') for tree in trees]
+            self.elementwise = [is_elementwise(tree.body) for tree in trees]
+
+    def apply(self, sims):
+        """
+        Evaluate the fitting instructions on simulation results.
+
+        Parameters
+        ----------
+        sims : array of simulation results, with shape (..., num_timepoints, model_dimension), eg
+            (num_simulations, beta, num_timepoints, model_dimension)
+
+        Returns
+        -------
+        an array of shape (..., num_timepoints, data_dimension); sims itself if there are no fitting instructions
+
+        """
+        if self.fitting_instruction is None:
+            return sims
+
+        sims = np.asarray(sims)
+        if self.projection is not None and (self.integer_projection or np.issubdtype(sims.dtype, np.floating)):
+            return np.dot(sims[..., :len(self.projection)], self.projection) + self.offset
+
+        # evaluate on a 2D array, so that sample_points[:, k] is column k of every timepoint of every simulation
+        rows = sims.reshape(-1, sims.shape[-1])
+        trajectories = sims.reshape((-1,) + sims.shape[-2:])
+
+        transformed_points = np.zeros([len(rows), len(self.codes)])
+        for i in range(len(self.codes)):
+            if self.elementwise[i]:
+                transformed_points[:, i] = eval(self.codes[i], {'np': np, 'sample_points': rows})
+            else:
+                ntimes = trajectories.shape[1]
+                for j in range(len(trajectories)):
+                    transformed_points[j * ntimes:(j + 1) * ntimes, i] = \
+                        np.squeeze(eval(self.codes[i], {'np': np, 'sample_points': trajectories[j]}))
+
+        return transformed_points.reshape(sims.shape[:-1] + (len(self.codes),))
+
+
+compiled_fits = {}
+
+
+def compile_fit(fitting_instruction):
+    """
+    Return the CompiledFit for a list of fitting instructions, compiling it only the first time the list is seen.
+
+    Parameters
+    ----------
+    fitting_instruction : list of strings, one per dimension of the data, or None
+
+    """
+    key = None if fitting_instruction is None else tuple(fitting_instruction)
+    if key not in compiled_fits:
+        compiled_fits[key] = CompiledFit(fitting_instruction)
+    return compiled_fits[key]
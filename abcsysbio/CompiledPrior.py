@@ -0,0 +1,146 @@
+import numpy as np
+from numpy import random as rnd
+
+from PriorType import PriorType
+
+
+class CompiledPrior(object):
+
+    """Vectorised form of the list of priors of one model.
+
+    The priors are grouped by type once, so that sampling, density evaluation and support checks are array operations
+    over a whole block of particles, with shape (num_particles, nparameters).
+    """
+
+    def __init__(self, priors):
+        """
+
+        Parameters
+        ----------
+        priors : list of Prior namedtuples, one per parameter of the model
+
+        """
+        self.nparameters = len(priors)
+
+        def select(prior_type):
+            return np.array([i for i, p in enumerate(priors) if p.type == prior_type], dtype=int)
+
+        self.constant_index = select(PriorType.constant)
+        self.constant_value = np.array([priors[i].value for i in self.constant_index], dtype=float)
+
+        self.normal_index = select(PriorType.normal)
+        self.normal_mean = np.array([priors[i].mean for i in self.normal_index], dtype=float)
+        self.normal_scale = np.sqrt(np.array([priors[i].variance for i in self.normal_index], dtype=float))
+
+        self.uniform_index = select(PriorType.uniform)
+        self.uniform_lower = np.array([priors[i].lower_bound for i in self.uniform_index], dtype=float)
+        self.uniform_upper = np.array([priors[i].upper_bound for i in self.uniform_index], dtype=float)
+
+        self.lognormal_index = select(PriorType.lognormal)
+        self.lognormal_mu = np.array([priors[i].mu for i in self.lognormal_index], dtype=float)
+        self.lognormal_scale = np.sqrt(np.array([priors[i].sigma for i in self.lognormal_index], dtype=float))
+
+        # bounds of the support of each parameter
+        self.lower = np.empty(self.nparameters)
+        self.upper = np.empty(self.nparameters)
+        self.lower[self.constant_index] = self.constant_value
+        self.upper[self.constant_index] = self.constant_value
+        self.lower[self.normal_index] = -np.inf
+        self.upper[self.normal_index] = np.inf
+        self.lower[self.uniform_index] = self.uniform_lower
+        self.upper[self.uniform_index] = self.uniform_upper
+        self.lower[self.lognormal_index] = 0
+        self.upper[self.lognormal_index] = np.inf
+
+    def sample(self, n):
+        """
+        Draw n samples from the prior.
+
+        Parameters
+        ----------
+        n : number of samples
+
+        Returns
+        -------
+        an array of shape (n, nparameters)
+
+        """
+        samples = np.empty([n, self.nparameters])
+        samples[:, self.constant_index] = self.constant_value
+        samples[:, self.normal_index] = rnd.normal(loc=self.normal_mean, scale=self.normal_scale,
+                                                   size=(n, len(self.normal_index)))
+        samples[:, self.uniform_index] = rnd.uniform(low=self.uniform_lower, high=self.uniform_upper,
+                                                     size=(n, len(self.uniform_index)))
+        samples[:, self.lognormal_index] = rnd.lognormal(mean=self.lognormal_mu, sigma=self.lognormal_scale,
+                                                         size=(n, len(self.lognormal_index)))
+        return samples
+
+    def in_support(self, x):
+        """
+        Return a boolean array indicating, for each row of x, whether the parameters lie inside the support of the
+        prior. Constant parameters are not checked.
+
+        Parameters
+        ----------
+        x : array of parameters, shape (num_particles, nparameters)
+
+        """
+        x = np.asarray(x, dtype=float)
+        uniform = x[:, self.uniform_index]
+        inside = np.all((uniform >= self.uniform_lower) & (uniform <= self.uniform_upper), axis=1)
+        inside &= np.all(x[:, self.lognormal_index] > 0, axis=1)
+        return inside
+
+    def log_pdf(self, x):
+        """
+        Evaluate the joint log-density of the prior for each row of x; this is -inf outside the support.
+        Constant parameters do not contribute.
+
+        Parameters
+        ----------
+        x : array of parameters, shape (num_particles, nparameters)
+
+        """
+        x = np.asarray(x, dtype=float)
+        log_p = np.zeros(x.shape[0])
+
+        z = (x[:, self.normal_index] - self.normal_mean) / self.normal_scale
+        log_p -= np.sum(0.5 * z * z + np.log(self.normal_scale * np.sqrt(2 * np.pi)), axis=1)
+
+        log_p -= np.sum(np.log(self.uniform_upper - self.uniform_lower))
+
+        y = x[:, self.lognormal_index]
+        log_y = np.log(np.where(y > 0, y, 1.0))
+        z = (log_y - self.lognormal_mu) / self.lognormal_scale
+        log_p -= np.sum(0.5 * z * z + log_y + np.log(self.lognormal_scale * np.sqrt(2 * np.pi)), axis=1)
+
+        return np.where(self.in_support(x), log_p, -np.inf)
+
+    def pdf(self, x):
+        """
+        Evaluate the joint density of the prior for each row of x.
+
+        Parameters
+        ----------
+        x : array of parameters, shape (num_particles, nparameters)
+
+        """
+        return np.exp(self.log_pdf(x))
+
+
+compiled_priors = {}
+
+
+def compile_prior(priors):
+    """
+    Return the CompiledPrior for a list of priors, compiling it only the first time the list is seen.
+
+    Parameters
+    ----------
+    priors : list of Prior namedtuples, one per parameter of the model
+
+    """
+    key = tuple(priors)
+    if key not in compiled_priors:
+        compiled_priors[key] = CompiledPrior(priors)
+    return compiled_priors[key]
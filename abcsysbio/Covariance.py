@@ -0,0 +1,50 @@
+import numpy as np
+from numpy import linalg as la
+
+from abcsysbio import statistics
+
+
+class Covariance(object):
+
+    """Covariance matrix of a multivariate normal kernel, factorized once when the kernel is built.
+
+    The Cholesky factor is used to perturb particles, and its inverse and the log normalizer of the density are used to
+    evaluate the kernel density, so that no matrix is decomposed or inverted for each particle.
+    """
+
+    def __init__(self, matrix):
+        """
+
+        Parameters
+        ----------
+        matrix : covariance matrix, shape (d, d)
+
+        """
+        self.matrix = np.array(matrix, dtype=float)
+        self.cholesky = statistics.cholesky_factors(self.matrix[np.newaxis])[0]
+        if len(self.matrix) > 0:
+            self.inv_cholesky = la.inv(self.cholesky)
+        else:
+            self.inv_cholesky = self.cholesky.copy()
+        self.log_det = 2 * np.sum(np.log(np.diag(self.cholesky)))
+        self.log_normalizer = -0.5 * (len(self.matrix) * np.log(2 * np.pi) + self.log_det)
+
+    def __len__(self):
+        return len(self.matrix)
+
+    def log_pdf(self, x, mean):
+        """
+        Evaluate the log density of the multivariate normal distribution with this covariance.
+
+        Parameters
+        ----------
+        x : array of points, shape (..., d)
+        mean : array of means, broadcastable to the shape of x
+
+        Returns
+        -------
+        an array of log densities, of shape x.shape[:-1]
+
+        """
+        z = np.dot(np.asarray(x, dtype=float) - mean, self.inv_cholesky.T)
+        return -0.5 * np.sum(z * z, axis=-1) + self.log_normalizer
@@ -0,0 +1,147 @@
+import numpy as np
+from scipy.special import ndtr
+
+from abcsysbio import statistics
+
+# number of standard deviations beyond which the mass of a normal tail is below the precision of the normalizers
+inside_cutoff = 8.0
+
+# maximum number of elements in the intermediate arrays of the quasi-Monte Carlo estimator
+qmc_block_size = 2 ** 22
+
+
+class KernelNormalizer(object):
+
+    """Mass of perturbation kernels inside the support of the prior, for all the particles of a population.
+
+    The kernel densities are truncated to the prior box, so each particle's density is divided by this mass (the
+    'auxilliary information' of kernels.get_auxilliary_info). The masses are computed with:
+
+    - array operations for the component-wise uniform and normal kernels;
+    - a fast path giving 1 when the kernel is more than inside_cutoff standard deviations inside every bound of the box;
+    - a quasi-Monte Carlo estimator (statistics.mvnormcdf_qmc) for the multivariate kernels, which shares one set of
+      Halton points across all the particles.
+
+    The multivariate masses are memoized per (mean, covariance, bounds), so the particles whose kernel has not changed
+    are not recomputed from one population to the next.
+    """
+
+    def __init__(self, num_points=2048, max_cache=100000):
+        """
+
+        Parameters
+        ----------
+        num_points : number of quasi-Monte Carlo points
+        max_cache : number of masses kept in the cache, which is emptied when it is full
+
+        """
+        self.num_points = num_points
+        self.max_cache = max_cache
+        self.cache = {}
+        self.points = {}
+
+    def component_wise(self, means, variances, lower, upper):
+        """
+        Return the mass inside [lower, upper] of independent normal kernels.
+
+        Parameters
+        ----------
+        means : means of the kernels, shape (num_particles, d)
+        variances : variance of the kernel of each dimension, shape (d,)
+        lower, upper : bounds of the prior box, shape (d,)
+
+        Returns
+        -------
+        an array of masses, one per particle and dimension, shape (num_particles, d)
+
+        """
+        means = np.asarray(means, dtype=float)
+        scale = np.sqrt(np.asarray(variances, dtype=float))
+        return ndtr((upper - means) / scale) - ndtr((lower - means) / scale)
+
+    def component_wise_uniform(self, means, bounds, lower, upper):
+        """
+        Return the fraction of independent uniform kernels inside [lower, upper].
+
+        Parameters
+        ----------
+        means : centres of the kernels, shape (num_particles, d)
+        bounds : lower and upper offsets of the kernel of each dimension, shape (d, 2)
+        lower, upper : bounds of the prior box, shape (d,)
+
+        Returns
+        -------
+        an array of masses, one per particle and dimension, shape (num_particles, d)
+
+        """
+        means = np.asarray(means, dtype=float)
+        bounds = np.asarray(bounds, dtype=float).reshape(-1, 2)
+        width = bounds[:, 1] - bounds[:, 0]
+        overlap = np.minimum(means + bounds[:, 1], upper) - np.maximum(means + bounds[:, 0], lower)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(width > 0, np.clip(overlap, 0, None) / width, 1.0)
+
+    def multivariate(self, means, cholesky, lower, upper):
+        """
+        Return the mass inside [lower, upper] of multivariate normal kernels.
+
+        Parameters
+        ----------
+        means : means of the kernels, shape (num_particles, d)
+        cholesky : lower Cholesky factors of the covariances of the kernels, shape (num_particles, d, d), or (d, d)
+            if all the kernels share the same covariance
+        lower, upper : bounds of the prior box, shape (d,)
+
+        Returns
+        -------
+        an array of masses, shape (num_particles,)
+
+        """
+        means = np.asarray(means, dtype=float)
+        num_particles, d = means.shape
+        cholesky = np.asarray(cholesky, dtype=float)
+        if cholesky.ndim == 2:
+            cholesky = np.repeat(cholesky[np.newaxis], num_particles, axis=0)
+        lower = np.asarray(lower, dtype=float)
+        upper = np.asarray(upper, dtype=float)
+
+        mass = np.ones(num_particles)
+        if d == 0:
+            return mass
+
+        # fast path: the kernel lies inside the box, up to a negligible tail
+        std = np.sqrt(np.sum(cholesky ** 2, axis=2))
+        with np.errstate(invalid='ignore'):
+            inside = np.all((upper - means > inside_cutoff * std) & (means - lower > inside_cutoff * std), axis=1)
+
+        bounds = lower.tobytes() + upper.tobytes()
+        keys = {}
+        for n in np.flatnonzero(~inside):
+            key = means[n].tobytes() + cholesky[n].tobytes() + bounds
+            if key in self.cache:
+                mass[n] = self.cache[key]
+            else:
+                keys[n] = key
+
+        if len(keys) > 0:
+            todo = np.array(sorted(keys))
+            points = self.halton_points(d)
+            block = max(1, qmc_block_size // (len(points) * d))
+            for start in range(0, len(todo), block):
+                index = todo[start:start + block]
+                mass[index] = statistics.mvnormcdf_qmc(lower, upper, means[index], cholesky[index], points)
+
+            if len(self.cache) + len(todo) > self.max_cache:
+                self.cache.clear()
+            for n in todo:
+                self.cache[keys[n]] = mass[n]
+
+        return mass
+
+    def halton_points(self, d):
+        """
+        Return the quasi-Monte Carlo points used for kernels of dimension d, shape (num_points, d - 1).
+        """
+        if d not in self.points:
+            self.points[d] = statistics.halton_sequence(self.num_points, max(d - 1, 1))
+        return self.points[d]
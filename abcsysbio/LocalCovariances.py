@@ -0,0 +1,80 @@
+import numpy as np
+from numpy import linalg as la
+
+from abcsysbio import statistics
+
+
+class LocalCovariances(object):
+
+    """Covariance matrices of a local multivariate normal kernel, one per particle of the previous population.
+
+    The matrices are held in a tensor of shape (num_particles, d, d), where d is the number of non-constant parameters,
+    in the order of the particles of the model in the previous population. The kernel of an ancestor is addressed by
+    its position among these particles. The Cholesky factors, their inverses and the log-determinants are computed once,
+    when the kernel is built.
+    """
+
+    def __init__(self, covariances, particles, index):
+        """
+
+        Parameters
+        ----------
+        covariances : array of covariance matrices, shape (num_particles, d, d)
+        particles : array of the parameters of the particles, shape (num_particles, nparameters)
+        index : list of the d indexes of the non-constant parameters (kernel[0])
+
+        """
+        self.index = list(index)
+        self.covariances = np.array(covariances, dtype=float)
+        self.particles = np.array(particles, dtype=float)[:, self.index]
+
+        self.cholesky = statistics.cholesky_factors(self.covariances)
+        if len(self.index) > 0:
+            self.inv_cholesky = la.inv(self.cholesky)
+        else:
+            self.inv_cholesky = self.cholesky.copy()
+        self.log_det = 2 * np.sum(np.log(np.diagonal(self.cholesky, axis1=1, axis2=2)), axis=1)
+
+        # dictionary from the non-constant parameters of a particle to its position, built on first use
+        self.positions = None
+
+    def __len__(self):
+        return len(self.covariances)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['positions'] = None
+        return state
+
+    def find(self, params):
+        """
+        Return the position of the particle with parameters params. This is only needed by callers which do not know
+        the position of the ancestor of a particle; a particle which is not in the population is given the kernel of
+        its nearest particle.
+
+        Parameters
+        ----------
+        params : the parameters of the particle, of length nparameters
+
+        """
+        if self.positions is None:
+            self.positions = dict((tuple(row), n) for n, row in enumerate(self.particles))
+
+        key = tuple(float(params[i]) for i in self.index)
+        if key in self.positions:
+            return self.positions[key]
+        return int(np.argmin(np.sum((self.particles - np.array(key)) ** 2, axis=1)))
+
+    def reindex(self, particles):
+        """
+        Return the kernel of another population of particles, in which each particle takes the covariance of the
+        nearest particle of this population. This is used when a kernel is not rebuilt for a new population.
+
+        Parameters
+        ----------
+        particles : array of the parameters of the particles of the new population, shape (num_particles, nparameters)
+
+        """
+        particles = np.asarray(particles, dtype=float)
+        nearest = [self.find(p) for p in particles]
+        return LocalCovariances(self.covariances[nearest], particles, self.index)
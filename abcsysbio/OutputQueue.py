@@ -0,0 +1,109 @@
+import Queue
+import sys
+import threading
+
+
+class OutputQueue(object):
+
+    """Write the output of the populations in a background thread, while the next populations are sampled.
+
+    The output of a population is submitted as a list of tasks, each of which is a function and its arguments, such as
+    InputOutput.write_data and the population's AbcsmcResults. The tasks are run in the order in which they were
+    submitted. The arguments must not be modified once submitted, so the caller passes copies of any buffers it reuses.
+    The time spent in the tasks is recorded under the population of the timer which was current when they were
+    submitted, rather than the population being sampled when they run.
+    At most max_pending populations wait in the queue; submit blocks while the queue is full, which bounds the number
+    of populations held in memory for output. flush waits until all the submitted tasks are done.
+
+    If a task raises an exception (including the SystemExit raised by sys.exit when a folder cannot be created), no
+    further task is run, and the exception is raised again in the main thread by the next call to submit or flush.
+    With max_pending 0, the tasks are run in the main thread when they are submitted.
+    """
+
+    def __init__(self, timer, max_pending=2):
+        """
+
+        Parameters
+        ----------
+        timer : the PhaseTimer recording the time spent in each task, and waiting for the queue
+        max_pending : maximum number of populations waiting in the queue, or 0 to run the tasks when they are
+            submitted
+
+        """
+        self.timer = timer
+        self.max_pending = max_pending
+        self.error = None
+        self.thread = None
+
+        if max_pending > 0:
+            self.queue = Queue.Queue(max_pending)
+            self.thread = threading.Thread(target=self.run, name='abcsysbio-output')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def submit(self, tasks):
+        """
+        Queue the output of a population.
+
+        Parameters
+        ----------
+        tasks : list of tuples (name, function, args); each function(*args) is called in turn, timed as the phase name
+
+        """
+        self.check()
+        population = self.timer.current_population()
+        if self.thread is None:
+            self.run_tasks(tasks, population)
+            return
+
+        with self.timer.phase('output_wait'):
+            self.queue.put((tasks, population))
+
+    def flush(self):
+        """
+        Wait until all the submitted tasks are done.
+        """
+        if self.thread is not None:
+            with self.timer.phase('output_wait'):
+                self.queue.join()
+        self.check()
+
+    def close(self):
+        """
+        Wait until all the submitted tasks are done, and stop the thread.
+        """
+        self.flush()
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def check(self):
+        """
+        Raise in the calling thread the exception raised by a task, if any.
+        """
+        if self.error is not None:
+            exc_type, exc_value, exc_traceback = self.error
+            raise exc_type, exc_value, exc_traceback
+
+    def run_tasks(self, tasks, population):
+        self.timer.set_thread_population(population)
+        try:
+            for name, function, args in tasks:
+                with self.timer.phase(name):
+                    function(*args)
+        finally:
+            self.timer.set_thread_population(None)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                if self.error is None:
+                    self.run_tasks(*item)
+            except BaseException:
+                self.error = sys.exc_info()
+            finally:
+                self.queue.task_done()
@@ -0,0 +1,192 @@
+import json
+import threading
+import time
+
+
+class NullPhase(object):
+
+    """Context manager returned by a disabled PhaseTimer, which records nothing."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+null_phase = NullPhase()
+
+
+class Phase(object):
+
+    """Context manager adding the time spent in its block to a phase of a PhaseTimer."""
+
+    __slots__ = ('timer', 'name', 'model', 'start')
+
+    def __init__(self, timer, name, model):
+        self.timer = timer
+        self.name = name
+        self.model = model
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.timer.add(self.name, time.time() - self.start, self.model)
+        return False
+
+
+class PhaseTimer(object):
+
+    """Cumulative wall time and number of calls of the phases of an ABC SMC run, per population and per model.
+
+    A phase is timed by wrapping it in a with block:
+
+        with timer.phase('simulation', model):
+            ...
+
+    When the timer is disabled, phase returns a shared context manager which does nothing, so the instrumentation
+    costs one method call per phase. Phases may be nested, in which case the time of the inner phase is also counted in
+    the outer one. The timings are exported by write as a JSON document of the form:
+
+        {"populations": [{"population": 1, "epsilon": [...], "phases": {name: entry}}, ...],
+         "total": {name: entry}}
+
+    where each entry is {"time": seconds, "calls": n, "models": {model: {"time": seconds, "calls": n}}}. Phases timed
+    before the first population (eg reading a restart file) are reported under population 0.
+
+    Phases are recorded under the population started last, unless the thread timing them has been attached to an
+    earlier population by set_thread_population, as the thread of an OutputQueue is while it writes a population.
+    """
+
+    def __init__(self, enabled=False):
+        """
+
+        Parameters
+        ----------
+        enabled : if False, nothing is recorded
+
+        """
+        self.enabled = enabled
+        self.populations = []
+
+        # phases may be timed in the background thread of an OutputQueue, which records them under the population it
+        # is writing, held in thread_local
+        self.lock = threading.Lock()
+        self.thread_local = threading.local()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        del state['thread_local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+        self.thread_local = threading.local()
+
+    def start_population(self, population, epsilon=None):
+        """
+        Record the following phases under a new population.
+
+        Parameters
+        ----------
+        population : number of the population, starting from 1
+        epsilon : the epsilon of the population
+
+        """
+        if not self.enabled:
+            return
+        entry = {'population': population, 'phases': {}}
+        if epsilon is not None:
+            entry['epsilon'] = [float(e) for e in epsilon]
+        with self.lock:
+            self.populations.append(entry)
+
+    def current_population(self):
+        """
+        Return the entry of the population started last, or None if no population has been started.
+        """
+        if not self.enabled:
+            return None
+        with self.lock:
+            if len(self.populations) == 0:
+                return None
+            return self.populations[-1]
+
+    def set_thread_population(self, population):
+        """
+        Record the phases timed by the calling thread under population, an entry returned by current_population, or
+        under the population started last if population is None.
+        """
+        self.thread_local.population = population
+
+    def phase(self, name, model=None):
+        """
+        Return a context manager timing the phase name, optionally for one model.
+        """
+        if not self.enabled:
+            return null_phase
+        return Phase(self, name, model)
+
+    def add(self, name, elapsed, model=None, calls=1):
+        """
+        Add elapsed seconds and a number of calls to the phase name of the current population.
+        """
+        if not self.enabled:
+            return
+        population = getattr(self.thread_local, 'population', None)
+        with self.lock:
+            if population is None:
+                if len(self.populations) == 0:
+                    self.populations.append({'population': 0, 'phases': {}})
+                population = self.populations[-1]
+
+            add_entry(population['phases'], name, elapsed, calls, model)
+
+    def totals(self):
+        """
+        Return the entries of each phase summed over all the populations.
+        """
+        total = {}
+        for population in self.populations:
+            for name, entry in population['phases'].items():
+                add_entry(total, name, entry['time'], entry['calls'])
+                for model, model_entry in entry['models'].items():
+                    models = total[name]['models']
+                    if model not in models:
+                        models[model] = {'time': 0.0, 'calls': 0}
+                    models[model]['time'] += model_entry['time']
+                    models[model]['calls'] += model_entry['calls']
+        return total
+
+    def write(self, filename):
+        """
+        Write the timings of all the populations, and their totals, to the JSON file filename.
+        """
+        with self.lock:
+            out_file = open(filename, "w")
+            json.dump({'populations': self.populations, 'total': self.totals()}, out_file, indent=1, sort_keys=True)
+            out_file.close()
+
+
+def add_entry(phases, name, elapsed, calls, model=None):
+    """
+    Add elapsed seconds and calls to the entry of the phase name in the dictionary phases, and to the entry of the
+    model if one is given.
+    """
+    if name not in phases:
+        phases[name] = {'time': 0.0, 'calls': 0, 'models': {}}
+    entry = phases[name]
+    entry['time'] += elapsed
+    entry['calls'] += calls
+
+    if model is not None:
+        key = str(model)
+        if key not in entry['models']:
+            entry['models'][key] = {'time': 0.0, 'calls': 0}
+        entry['models'][key]['time'] += elapsed
+        entry['models'][key]['calls'] += calls
@@ -14,7 +14,18 @@ __all__ = ['GillespieAlgorithm',
            'getResults',
            'input_output',
            'abcsmc',
+           'CompiledFit',
+           'CompiledPrior',
+           'Covariance',
+           'distributed',
            'input_output',
+           'KernelNormalizer',
            'kernels',
+           'LocalCovariances',
+           'OutputQueue',
+           'parallel',
            'parse_info',
+           'PhaseTimer',
+           'population',
+           'report',
            'statistics']
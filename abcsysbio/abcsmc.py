@@ -1,15 +1,27 @@
 import numpy as np
 from numpy import random as rnd
+from scipy.special import logsumexp
 
+import collections
 import copy
 import time
 
 from abcsysbio import euclidian
 from abcsysbio import kernels
+from abcsysbio import parallel
 from abcsysbio import statistics
+from abcsysbio.population import AcceptedSimulations
+from abcsysbio.population import Population
 
 from KernelType import KernelType
 from PriorType import PriorType
+from CompiledPrior import compile_prior
+from CompiledFit import compile_fit
+from Covariance import Covariance
+from KernelNormalizer import KernelNormalizer
+from LocalCovariances import LocalCovariances
+from PhaseTimer import PhaseTimer
+from OutputQueue import OutputQueue
 
 
 """
@@ -37,8 +49,11 @@ fit:
 """
 
 
-# distances are stored as [nparticle][nbeta][d1, d2, d3 .... ]
-# trajectories are stored as [nparticle][nbeta][ species ][ times ]
+# maximum number of elements in the intermediate arrays used when computing particle weights
+weight_block_size = 2 ** 20
+
+# distances are stored as an array [nparticle][nbeta][d1, d2, d3 .... ]
+# trajectories are stored as an array [nparticle][nbeta][ times ][ fitted species ], or None if they are not kept
 
 class AbcsmcResults:
     def __init__(self,
@@ -51,12 +66,14 @@ class AbcsmcResults:
                  models,
                  weights,
                  parameters,
-                 epsilon):
+                 epsilon,
+                 trajectory_widths=None):
         self.naccepted = naccepted
         self.sampled = sampled
         self.rate = rate
-        self.trajectories = copy.deepcopy(trajectories)
-        self.distances = np.array(distances)
+        self.trajectories = trajectories
+        self.trajectory_widths = trajectory_widths
+        self.distances = np.asarray(distances)
         self.margins = np.array(margins)
         self.models = np.array(models)
         self.weights = np.array(weights)
@@ -64,6 +81,75 @@ class AbcsmcResults:
         self.epsilon = epsilon
 
 
+class BatchSize:
+    """
+    Choose the number of particles to simulate in each batch.
+
+    With no limits the batch size is fixed. Otherwise each batch is sized to produce the number of particles still
+    needed at the running acceptance rate, within the limits: late populations with low acceptance rates use large
+    batches, and early populations do not simulate many more particles than are needed.
+    """
+
+    def __init__(self, nbatch, nbatch_min=None, nbatch_max=None):
+        """
+
+        Parameters
+        ----------
+        nbatch : the fixed batch size, also used as the missing limit if only one limit is given
+        nbatch_min : minimum batch size
+        nbatch_max : maximum batch size
+
+        """
+        self.nbatch = nbatch
+        self.adaptive = nbatch_min is not None or nbatch_max is not None
+
+        if nbatch_min is None:
+            nbatch_min = nbatch if nbatch_max is None else min(nbatch, nbatch_max)
+        if nbatch_max is None:
+            nbatch_max = max(nbatch, nbatch_min)
+        self.nbatch_min = max(1, nbatch_min)
+        self.nbatch_max = max(self.nbatch_min, nbatch_max)
+        self.previous_rate = None
+        self.sampled = 0
+        self.accepted = 0
+
+    def start_population(self, previous_rate):
+        """
+        Reset the running counts at the start of a population.
+
+        Parameters
+        ----------
+        previous_rate : acceptance rate of the previous population, or None
+
+        """
+        self.previous_rate = previous_rate
+        self.sampled = 0
+        self.accepted = 0
+
+    def update(self, sampled, accepted):
+        """
+        Record the number of particles simulated and accepted in the last batch.
+        """
+        self.sampled += sampled
+        self.accepted += accepted
+
+    def next_size(self, needed):
+        """
+        Return the size of the next batch, given the number of particles still needed.
+        """
+        if not self.adaptive:
+            return self.nbatch
+
+        if self.accepted > 0:
+            rate = self.accepted / float(self.sampled)
+        elif self.previous_rate is not None:
+            rate = min(self.previous_rate, 1.0 / (self.sampled + 1))
+        else:
+            rate = 1.0 / (self.sampled + 1)
+
+        return int(min(max(np.ceil(needed / rate), self.nbatch_min), self.nbatch_max))
+
+
 class Abcsmc:
 
     def __init__(self,
@@ -77,10 +163,20 @@ class Abcsmc:
                  debug,
                  timing,
                  distancefn=euclidian.euclidian_distance,
+                 distance_batchfn=None,
                  kernel_type=KernelType.component_wise_uniform,
+                 kernel_neighbours=None,
                  kernelfn=kernels.get_kernel,
                  kernelpdffn=kernels.get_parameter_kernel_pdf,
-                 perturbfn=kernels.perturb_particle):
+                 perturbfn=kernels.perturb_particle,
+                 nprocesses=1,
+                 nbatch_min=None,
+                 nbatch_max=None,
+                 nqueue=2,
+                 coordinator=None,
+                 trajectory_dtype=np.float64,
+                 keep_trajectories=True,
+                 output_queue=0):
         """
 
         Parameters
@@ -93,12 +189,32 @@ class Abcsmc:
         nbatch
         model_kernel
         debug
-        timing
-        distancefn
+        timing : if True, print the time taken by each population, and record the time spent in each phase of the
+            algorithm in a PhaseTimer, which is written to timings.json in the output folder
+        distancefn : distance between one fitted simulation and the data
+        distance_batchfn : distance between each fitted simulation of a batch and the data (see
+            euclidian.euclidian_distance_batch); by default, the batched form of distancefn
         kernel_type
+        kernel_neighbours : number of nearest neighbours used by the multivariate_normal_nn kernel (default
+            nparticles/4)
         kernelfn
         kernelpdffn
         perturbfn
+        nprocesses : number of worker processes used to simulate each batch (1 simulates in the main process)
+        nbatch_min : if given (with or without nbatch_max), the batch size is adapted to the acceptance rate, and is
+            at least nbatch_min
+        nbatch_max : if given (with or without nbatch_min), the batch size is adapted to the acceptance rate, and is
+            at most nbatch_max
+        nqueue : with worker processes, the number of batches queued for simulation; the next batches are sampled
+            while the workers simulate the queued ones
+        coordinator : a distributed.Coordinator; if given, the particles are sampled and simulated by the workers
+            connected to it instead of by this object
+        trajectory_dtype : dtype of the stored trajectories of the accepted particles (numpy.float64 or numpy.float32)
+        keep_trajectories : if False, the trajectories of the accepted particles are not stored, only their distances
+        output_queue : number of populations whose output may wait to be written and plotted by a background thread
+            while the next population is sampled (see OutputQueue); 0 (the default) writes the output of each
+            population before the next one is started. The diagnostics are drawn with pyplot, so a background thread
+            should only be used with a non-interactive matplotlib backend such as Agg
 
         Returns
         -------
@@ -107,25 +223,28 @@ class Abcsmc:
 
         self.nmodel = len(models)
         self.models = copy.copy(models)
+        self.priors = [compile_prior(model.prior) for model in self.models]
+        self.fits = [compile_fit(model.fit) for model in self.models]
         self.data = copy.deepcopy(data)
 
         self.nparticles = nparticles
 
-        self.model_prev = [0] * nparticles
-        self.weights_prev = [0] * nparticles
-        self.parameters_prev = [[] for _ in range(self.nparticles)]
-        self.margins_prev = [0] * self.nmodel
-
-        self.model_curr = [0] * nparticles
-        self.weights_curr = [0] * nparticles
-        self.parameters_curr = [[] for _ in range(self.nparticles)]
-        self.margins_curr = [0] * self.nmodel
+        # the previous and current populations are two preallocated buffers, swapped after each population
+        nparameters = [model.nparameters for model in self.models]
+        self.population_prev = Population(nparticles, nparameters)
+        self.population_curr = Population(nparticles, nparameters)
 
-        self.b = [0] * nparticles
-        self.distances = []
-        self.trajectories = []
+        self.b = np.zeros(nparticles, dtype=int)
+        self.keep_trajectories = keep_trajectories
+        self.simulations = AcceptedSimulations(nparticles, self.nmodel, beta, trajectory_dtype, keep_trajectories)
 
         self.distancefn = distancefn
+        if distance_batchfn is not None:
+            self.distance_batchfn = distance_batchfn
+        elif distancefn is euclidian.euclidian_distance:
+            self.distance_batchfn = euclidian.euclidian_distance_batch
+        else:
+            self.distance_batchfn = euclidian.BatchedDistance(distancefn)
         self.kernel_type = kernel_type
         self.kernelfn = kernelfn
         self.kernelpdffn = kernelpdffn
@@ -134,12 +253,20 @@ class Abcsmc:
         self.beta = beta
         self.dead_models = []
         self.nbatch = nbatch
+        self.batch_size = BatchSize(nbatch, nbatch_min, nbatch_max)
+        self.nprocesses = nprocesses
+        self.nqueue = nqueue
+        self.coordinator = coordinator
+        self.simulation_pool = None
         self.debug = debug
         self.timing = timing
+        self.timer = PhaseTimer(timing)
+        self.output_queue = output_queue
 
         self.modelprior = modelprior[:]
         self.modelKernel = model_kernel
         self.kernel_aux = [0] * nparticles
+        self.normalizer = KernelNormalizer()
 
         self.kernels = list()
         # self.kernels is a list of length the number of models
@@ -150,8 +277,11 @@ class Abcsmc:
         kernel_option = list()
         for i in range(self.nmodel):
             if self.kernel_type == KernelType.multivariate_normal_nn:
-                # Option for K nearest neigbours - user should be able to specify
-                kernel_option.append(int(nparticles / 4))
+                # Option for K nearest neigbours
+                if kernel_neighbours is None:
+                    kernel_option.append(int(nparticles / 4))
+                else:
+                    kernel_option.append(int(kernel_neighbours))
             else:
                 kernel_option.append(0)
 
@@ -185,6 +315,8 @@ class Abcsmc:
 
     def run_fixed_schedule(self, epsilon, io, store_all_results=False):
         all_start_time = time.time()
+        io.timer = self.timer
+        output = OutputQueue(self.timer, self.output_queue)
         all_results = []
         for pop in range(len(epsilon)):
             start_time = time.time()
@@ -197,27 +329,31 @@ class Abcsmc:
                 all_results.append(results)
             end_time = time.time()
 
-            io.write_pickled(self.nmodel, self.model_prev, self.weights_prev, self.parameters_prev, self.margins_prev,
-                             self.kernels)
-            io.write_data(pop, results, end_time - start_time, self.models, self.data)
+            self.write_population(output, io, pop, results, end_time - start_time)
 
             if self.debug == 1:
                 epsilon_string = map(lambda x: "%0.2f" % x, epsilon[pop])
                 print "### iteration:%d, eps=%s, sampled=%d, accepted=%.1f%%" % (pop + 1, epsilon_string,
                                                                                   self.sampled[pop], self.rate[pop]*100)
-                print "\t model marginals                  :", self.margins_prev
+                print "\t model marginals                  :", self.population_prev.margins
 
                 if len(self.dead_models) > 0:
                     print "\t dead models                      :", self.dead_models
                 if self.timing:
                     print "\t timing:                          :", end_time - start_time
 
+        self.close_simulation_pool()
+        output.submit([('finish_diagnostics', io.finish_diagnostics, ())])
+        output.close()
         if self.timing:
+            self.timer.write(io.folder + '/timings.json')
             print "#### final time:", time.time() - all_start_time
         return all_results
 
     def run_automated_schedule(self, final_epsilon, alpha, io, store_all_results=False):
         all_start_time = time.time()
+        io.timer = self.timer
+        output = OutputQueue(self.timer, self.output_queue)
         all_results = []
 
         done = False
@@ -239,16 +375,14 @@ class Abcsmc:
                 all_results.append(results)
             end_time = time.time()
 
-            io.write_pickled(self.nmodel, self.model_prev, self.weights_prev, self.parameters_prev, self.margins_prev,
-                             self.kernels)
-            io.write_data(pop, results, end_time - start_time, self.models, self.data)
+            self.write_population(output, io, pop, results, end_time - start_time)
 
             final, epsilon = self.compute_next_epsilon(results, final_epsilon, alpha)
 
             if self.debug == 1:
                 print "### population ", pop + 1
                 print "\t sampling steps / acceptance rate :", self.sampled[pop], "/", self.rate[pop]
-                print "\t model marginals                  :", self.margins_prev
+                print "\t model marginals                  :", self.population_prev.margins
                 print "\t next epsilon                     :", epsilon
 
                 if len(self.dead_models) > 0:
@@ -258,10 +392,41 @@ class Abcsmc:
 
             pop += 1
 
+        self.close_simulation_pool()
+        output.submit([('finish_diagnostics', io.finish_diagnostics, ())])
+        output.close()
         if self.timing:
+            self.timer.write(io.folder + '/timings.json')
             print "#### final time:", time.time() - all_start_time
         return all_results
 
+    def write_population(self, output, io, pop, results, elapsed):
+        """
+        Queue the output of a population: the pickled copy of the previous population used to restart the algorithm,
+        and the results written and plotted by io.write_data.
+
+        The buffers of the previous population are reused for the next populations, so copies of them are queued; the
+        arrays of results are not modified after they are returned by iterate_one_population.
+
+        Parameters
+        ----------
+        output : the OutputQueue
+        io : the InputOutput object
+        pop : index of the population
+        results : the AbcsmcResults of the population
+        elapsed : time taken by the population, in seconds
+
+        """
+        prev = self.population_prev
+        kernels_copy = [kernel[:] for kernel in self.kernels]
+        tasks = [('write_pickled', io.write_pickled, (self.nmodel, prev.models.copy(), prev.weights.copy(),
+                                                      prev.parameters.copy(), prev.margins.copy(), kernels_copy)),
+                 ('write_data', io.write_data, (pop, results, elapsed, self.models, self.data))]
+        if self.timing:
+            tasks.append(('write_timings', self.timer.write, (io.folder + '/timings.json',)))
+
+        output.submit(tasks)
+
     def compute_next_epsilon(self, results, target_epsilon, alpha):
         """
 
@@ -281,10 +446,7 @@ class Abcsmc:
 
         nepsilon = len(target_epsilon)
 
-        distance_values = []
-        for i in range(self.nparticles):
-            for j in range(self.beta):
-                distance_values.append(results.distances[i][j])
+        distance_values = results.distances.reshape(self.nparticles * self.beta, -1)
 
         # Important to remember that the initial sort on distance is done on the first distance value
         distance_values = np.sort(distance_values, axis=0)
@@ -312,105 +474,41 @@ class Abcsmc:
 
     def run_simulations(self, io):
 
-        num_accepted = 0
-        sampled = 0
-
-        while num_accepted < self.nparticles:
-            if self.debug == 2:
-                print "\t****batch"
-            sampled_model_indexes = self.sample_model_from_prior()
-            sampled_params = self.sample_parameters_from_prior(sampled_model_indexes)
-
-            accepted_index, distances, traj = self.simulate_and_compare_to_data(sampled_model_indexes, sampled_params,
-                                                                                epsilon=0, do_comp=False)
-
-            for i in range(self.nbatch):
-                if num_accepted < self.nparticles:
-                    sampled += 1
-
-                if num_accepted < self.nparticles and accepted_index[i] > 0:
-
-                    self.model_curr[num_accepted] = sampled_model_indexes[i]
-                    if self.debug == 2:
-                        print "\t****accepted", i, accepted_index[i], sampled_model_indexes[i]
-
-                    for p in range(self.models[sampled_model_indexes[i]].nparameters):
-                        self.parameters_curr[num_accepted].append(sampled_params[i][p])
-
-                    self.b[num_accepted] = accepted_index[i]
-                    self.trajectories.append(copy.deepcopy(traj[i]))
-                    self.distances.append(copy.deepcopy(distances[i]))
-
-                    num_accepted += 1
-
-            if self.debug == 2:
-                print "#### current num_accepted:", num_accepted
-
-            if self.debug == 2:
-                print "\t****end  batch num_accepted/sampled:", num_accepted, sampled
+        self.batch_size.start_population(None)
+        num_accepted, sampled = self.accept_particles(epsilon=0, prior=True, do_comp=False)
 
         if self.debug == 2:
             print "**** end of population num_accepted/sampled:", num_accepted, sampled
 
-        results = AbcsmcResults(num_accepted, sampled, num_accepted / float(sampled), self.trajectories, self.distances,
-                                0, self.model_curr, 0, self.parameters_curr, 0)
+        trajectories, distances, widths = self.simulations.release()
+        results = AbcsmcResults(num_accepted, sampled, num_accepted / float(sampled), trajectories, distances,
+                                0, self.population_curr.models, 0, self.population_curr.parameters, 0, widths)
 
+        self.close_simulation_pool()
         io.write_data_simulation(results, self.models, self.data)
 
     def iterate_one_population(self, next_epsilon, prior):
         if self.debug == 2:
             print "\n\n****iterate_one_population: next_epsilon, prior", next_epsilon, prior
 
-        naccepted = 0
-        sampled = 0
-
-        while naccepted < self.nparticles:
-            if self.debug == 2:
-                print "\t****batch"
-            if not prior:
-                sampled_model_indexes = self.sample_model()
-                sampled_params = self.sample_parameters(sampled_model_indexes)
-            else:
-                sampled_model_indexes = self.sample_model_from_prior()
-                sampled_params = self.sample_parameters_from_prior(sampled_model_indexes)
-
-            accepted_index, distances, traj = self.simulate_and_compare_to_data(sampled_model_indexes, sampled_params,
-                                                                                next_epsilon)
-
-            for i in range(self.nbatch):
-                if naccepted < self.nparticles:
-                    sampled += 1
-
-                if naccepted < self.nparticles and accepted_index[i] > 0:
-
-                    self.model_curr[naccepted] = sampled_model_indexes[i]
-                    if self.debug == 2:
-                        print "\t****accepted", i, accepted_index[i], sampled_model_indexes[i]
-
-                    for p in range(self.models[sampled_model_indexes[i]].nparameters):
-                        self.parameters_curr[naccepted].append(sampled_params[i][p])
-
-                    self.b[naccepted] = accepted_index[i]
-                    self.trajectories.append(copy.deepcopy(traj[i]))
-                    self.distances.append(copy.deepcopy(distances[i]))
-
-                    naccepted += 1
-
-            if self.debug == 2:
-                print "#### current naccepted:", naccepted
+        # start from the acceptance rate of the previous population, if there is one
+        if len(self.rate) > 0:
+            self.batch_size.start_population(self.rate[-1])
+        else:
+            self.batch_size.start_population(None)
+        self.timer.start_population(len(self.hits) + 1, next_epsilon)
 
-            if self.debug == 2:
-                print "\t****end  batch naccepted/sampled:", naccepted, sampled
+        naccepted, sampled = self.accept_particles(next_epsilon, prior)
 
         # Finished loop over particles
         if self.debug == 2:
             print "**** end of population naccepted/sampled:", naccepted, sampled
 
         if not prior:
-            self.compute_particle_weights()
+            with self.timer.phase('weights'):
+                self.compute_particle_weights()
         else:
-            for i in range(self.nparticles):
-                self.weights_curr[i] = self.b[i]
+            self.population_curr.log_weights[:] = np.log(self.b)
 
         self.normalize_weights()
         self.update_model_marginals()
@@ -418,77 +516,190 @@ class Abcsmc:
         if self.debug == 2:
             print "**** end of population: particles"
             for i in range(self.nparticles):
-                print i, self.weights_curr[i], self.model_curr[i], self.parameters_curr[i]
-            print self.margins_curr
+                print i, self.population_curr.weights[i], self.population_curr.models[i], \
+                    self.population_curr.particle_parameters(i)
+            print self.population_curr.margins
 
-        # Prepare for next population
-        self.margins_prev = self.margins_curr[:]
-        self.weights_prev = self.weights_curr[:]
-        self.model_prev = self.model_curr[:]
-        self.parameters_prev = []
-        for i in range(self.nparticles):
-            self.parameters_prev.append(self.parameters_curr[i][:])
+        # Prepare for next population: swap the buffers, and clear the one that will hold the next population
+        self.population_prev, self.population_curr = self.population_curr, self.population_prev
+        self.population_curr.reset()
 
-        self.model_curr = [0] * self.nparticles
-        self.weights_curr = [0] * self.nparticles
-        self.parameters_curr = [[] for _ in range(self.nparticles)]
-        self.margins_curr = [0] * self.nmodel
-
-        self.b = [0] * self.nparticles
+        self.b.fill(0)
+        self.index_previous_population()
 
         # Check for dead models
         self.dead_models = []
         for j in range(self.nmodel):
-            if self.margins_prev[j] < 1e-6:
+            if self.population_prev.margins[j] < 1e-6:
                 self.dead_models.append(j)
 
         # Compute kernels
         for model_index in range(self.nmodel):
-            this_model_index = np.arange(self.nparticles)[np.array(self.model_prev) == model_index]
-            this_population = np.zeros([len(this_model_index), self.models[model_index].nparameters])
-            this_weights = np.zeros(len(this_model_index))
+            this_model_index = self.population_prev.model_index(model_index)
 
             # if we have just sampled from the prior we shall initialise the kernels using all available particles
-            if prior:
-                for it in range(len(this_model_index)):
-                    this_population[it, :] = self.parameters_prev[this_model_index[it]][:]
-                    this_weights[it] = self.weights_prev[this_model_index[it]]
-                tmp_kernel = self.kernelfn(self.kernel_type, self.kernels[model_index], this_population, this_weights)
+            # otherwise, only update the kernels if there are > 5 particles
+            if prior or len(this_model_index) > 5:
+                this_population = self.population_prev.model_parameters(model_index)
+                this_weights = self.population_prev.weights[this_model_index]
+                with self.timer.phase('kernel', self.models[model_index].name):
+                    tmp_kernel = self.kernelfn(self.kernel_type, self.kernels[model_index], this_population,
+                                               this_weights)
                 self.kernels[model_index] = tmp_kernel[:]
-
-            else:
-                # only update the kernels if there are > 5 particles
-                if len(this_model_index) > 5:
-                    for it in range(len(this_model_index)):
-                        this_population[it, :] = self.parameters_prev[this_model_index[it]][:]
-                        this_weights[it] = self.weights_prev[this_model_index[it]]
-                    tmp_kernel = self.kernelfn(self.kernel_type, self.kernels[model_index], this_population, this_weights)
-                    self.kernels[model_index] = tmp_kernel[:]
+            elif isinstance(self.kernels[model_index][2], LocalCovariances) and len(this_model_index) > 0:
+                # the covariances of a local kernel are addressed by the position of the particles, so they are carried
+                # over to the nearest particles of the new population
+                this_population = self.population_prev.model_parameters(model_index)
+                self.kernels[model_index][2] = self.kernels[model_index][2].reindex(this_population)
 
         # Kernel auxilliary information
-        self.kernel_aux = kernels.get_auxilliary_info(self.kernel_type, self.model_prev, self.parameters_prev,
-                                                      self.models, self.kernels)[:]
+        with self.timer.phase('auxilliary'):
+            self.kernel_aux = kernels.get_auxilliary_info(self.kernel_type, self.population_prev.models,
+                                                          self.population_prev.parameters, self.models, self.kernels,
+                                                          self.normalizer)[:]
 
         self.hits.append(naccepted)
         self.sampled.append(sampled)
         self.rate.append(naccepted / float(sampled))
 
+        trajectories, distances, widths = self.simulations.release()
         results = AbcsmcResults(naccepted,
                                 sampled,
                                 naccepted / float(sampled),
-                                self.trajectories,
-                                self.distances,
-                                self.margins_prev,
-                                self.model_prev,
-                                self.weights_prev,
-                                self.parameters_prev,
-                                next_epsilon)
-
-        self.trajectories = []
-        self.distances = []
+                                trajectories,
+                                distances,
+                                self.population_prev.margins,
+                                self.population_prev.models,
+                                self.population_prev.weights,
+                                self.population_prev.parameters,
+                                next_epsilon,
+                                widths)
 
         return results
 
+    def accept_particles(self, epsilon, prior, do_comp=True):
+        """
+        Sample and simulate batches of particles until nparticles have been accepted, and store the accepted particles
+        in the current population.
+
+        Parameters
+        ----------
+        epsilon : value of epsilon
+        prior : if True, sample the particles from the prior, otherwise perturb the previous population
+        do_comp : if False, do not calculate distances, and accept every simulation
+
+        Returns
+        -------
+        naccepted : number of accepted particles
+        sampled : number of particles examined before nparticles were accepted
+
+        """
+        if self.coordinator is not None:
+            return self.coordinator.accept_particles(self, epsilon, prior, do_comp)
+
+        naccepted = 0
+        sampled = 0
+
+        batches = self.simulated_batches(epsilon, prior, do_comp)
+        for sampled_model_indexes, sampled_params, accepted_index, distances, traj in batches:
+            nbatch = len(sampled_model_indexes)
+            self.batch_size.update(nbatch, np.count_nonzero(accepted_index))
+
+            for i in range(nbatch):
+                if naccepted < self.nparticles:
+                    sampled += 1
+
+                if naccepted < self.nparticles and accepted_index[i] > 0:
+
+                    self.population_curr.set_particle(naccepted, sampled_model_indexes[i], sampled_params[i])
+                    if self.debug == 2:
+                        print "\t****accepted", i, accepted_index[i], sampled_model_indexes[i]
+
+                    self.b[naccepted] = accepted_index[i]
+                    self.simulations.set_particle(naccepted, sampled_model_indexes[i], traj[i], distances[i])
+
+                    naccepted += 1
+
+            if self.debug == 2:
+                print "\t****end  batch naccepted/sampled:", naccepted, sampled
+
+            if naccepted == self.nparticles:
+                break
+
+        # stop the generator, which cancels the batches still queued
+        batches.close()
+
+        return naccepted, sampled
+
+    def simulated_batches(self, epsilon, prior, do_comp=True):
+        """
+        Generator of simulated batches of particles, in the order in which they were sampled.
+
+        Without worker processes, each batch is sampled and then simulated. With worker processes, up to nqueue
+        batches are queued for simulation, and a new batch is sampled while the workers simulate the queued ones. When
+        the generator is closed, the batches still queued are cancelled.
+
+        Parameters
+        ----------
+        epsilon : value of epsilon
+        prior : if True, sample the particles from the prior, otherwise perturb the previous population
+        do_comp : if False, do not calculate distances
+
+        Returns
+        -------
+        a generator of tuples (sampled_model_indexes, sampled_params, accepted, distances, traj)
+
+        """
+        if self.nprocesses == 1:
+            while True:
+                sampled_model_indexes, sampled_params = self.sample_batch(prior)
+                yield (sampled_model_indexes, sampled_params) + \
+                    self.simulate_and_compare_to_data(sampled_model_indexes, sampled_params, epsilon, do_comp)
+
+        pending = collections.deque()
+        try:
+            while True:
+                while len(pending) < self.nqueue:
+                    sampled_model_indexes, sampled_params = self.sample_batch(prior)
+                    simulations = self.submit_simulations(sampled_model_indexes, sampled_params, epsilon, do_comp)
+                    pending.append((sampled_model_indexes, sampled_params, simulations))
+
+                sampled_model_indexes, sampled_params, simulations = pending.popleft()
+                with self.timer.phase('simulation_wait'):
+                    results = [(mapping, simulation.get()) for mapping, simulation in simulations]
+                yield (sampled_model_indexes, sampled_params) + \
+                    self.gather_simulations(len(sampled_model_indexes), results)
+        finally:
+            if len(pending) > 0:
+                self.simulation_pool.cancel()
+
+    def sample_batch(self, prior):
+        """
+        Sample the models and parameters of a batch of particles, whose size is given by self.batch_size.
+
+        Parameters
+        ----------
+        prior : if True, sample from the prior, otherwise perturb the previous population
+
+        Returns
+        -------
+        sampled_model_indexes, sampled_params
+
+        """
+        nbatch = self.batch_size.next_size(self.nparticles - min(self.batch_size.accepted, self.nparticles))
+        if self.debug == 2:
+            print "\t****batch", nbatch
+
+        with self.timer.phase('proposal'):
+            if prior:
+                sampled_model_indexes = self.sample_model_from_prior(nbatch)
+                sampled_params = self.sample_parameters_from_prior(sampled_model_indexes)
+            else:
+                sampled_model_indexes = self.sample_model(nbatch)
+                sampled_params = self.sample_parameters(sampled_model_indexes)
+
+        return sampled_model_indexes, sampled_params
+
     def fill_values(self, particle_data):
         """
         Save particle data from pickled array into the corresponding attributes of this abc_smc object.
@@ -499,15 +710,8 @@ class Abcsmc:
          [model_pickled, weights_pickled, parameters_pickled, margins_pickled, kernel]
 
         """
-        self.model_prev = particle_data[0][:]
-
-        self.weights_prev = particle_data[1][:]
-
-        self.parameters_prev = []
-        for it in range(len(particle_data[2])):
-            self.parameters_prev.append(particle_data[2][it][:])
-
-        self.margins_prev = particle_data[3][:]
+        self.population_prev.fill(particle_data[0], particle_data[1], particle_data[2], particle_data[3])
+        self.index_previous_population()
 
         self.kernels = []
         for i in range(self.nmodel):
@@ -515,9 +719,24 @@ class Abcsmc:
             for j in range(len(particle_data[4][i])):
                 self.kernels[i].append(particle_data[4][i][j])
 
+            # kernels pickled by earlier versions hold the covariance matrix of the multivariate normal kernel, and
+            # dictionaries keyed by str(list(particle)) for the local kernels
+            if isinstance(self.kernels[i][2], np.ndarray) and self.kernel_type == KernelType.multivariate_normal:
+                self.kernels[i][2] = Covariance(self.kernels[i][2])
+            elif isinstance(self.kernels[i][2], dict):
+                particles = self.population_prev.model_parameters(i)
+                covariances = [self.kernels[i][2][str(list(p))] for p in particles]
+                self.kernels[i][2] = LocalCovariances(covariances, particles, self.kernels[i][0])
+
+        # the auxilliary information of the kernels is not pickled, so it is computed from the restored population
+        with self.timer.phase('auxilliary'):
+            self.kernel_aux = kernels.get_auxilliary_info(self.kernel_type, self.population_prev.models,
+                                                          self.population_prev.parameters, self.models, self.kernels,
+                                                          self.normalizer)[:]
+
         self.dead_models = []
         for j in range(self.nmodel):
-            if self.margins_prev[j] < 1e-6:
+            if self.population_prev.margins[j] < 1e-6:
                 self.dead_models.append(j)
 
         self.sample_from_prior = False
@@ -529,7 +748,7 @@ class Abcsmc:
         Parameters
         ----------
         sampled_model_indexes : list of sampled model numbers
-        sampled_params : a list, each element of which is a list of sampled parameters
+        sampled_params : an array of sampled parameters, shape (len(sampled_model_indexes), max_nparameters)
         epsilon : value of epsilon
         do_comp : if False, do not actually calculate distance between simulation results and experimental data, and
             instead assume this is 0.
@@ -545,105 +764,192 @@ class Abcsmc:
         if self.debug == 2:
             print '\t\t\t***simulate_and_compare_to_data'
 
-        accepted = [0] * self.nbatch
-        traj = [[] for _ in range(self.nbatch)]
-        distances = [[] for _ in range(self.nbatch)]
+        if self.nprocesses > 1:
+            simulations = self.submit_simulations(sampled_model_indexes, sampled_params, epsilon, do_comp)
+            with self.timer.phase('simulation_wait'):
+                results = [(mapping, simulation.get()) for mapping, simulation in simulations]
+            return self.gather_simulations(len(sampled_model_indexes), results)
 
         models = np.array(sampled_model_indexes)
-
+        results = []
         for model in range(self.nmodel):
 
             # create a list of indexes for the simulations corresponding to this model
-            mapping = np.arange(self.nbatch)[models == model]
+            mapping = np.flatnonzero(models == model)
             if self.debug == 2:
                 print "\t\t\tmodel / mapping:", model, mapping
 
-            num_simulations = len(mapping)
-            if num_simulations == 0:
+            if len(mapping) == 0:
                 continue
 
-            this_model_parameters = []
-            for i in range(num_simulations):
-                this_model_parameters.append(sampled_params[mapping[i]])
+            this_model_parameters = sampled_params[mapping, :self.models[model].nparameters]
+            results.append((mapping, self.simulate_and_compare_model(model, this_model_parameters, epsilon, do_comp)))
 
-            sims = self.models[model].simulate(this_model_parameters, self.data.timepoints, num_simulations, self.beta)
-            if self.debug == 2:
-                print '\t\t\tsimulation dimensions:', sims.shape
+        return self.gather_simulations(len(sampled_model_indexes), results)
 
-            for i in range(num_simulations):
-                # store the trajectories and distances in a list of length beta
-                this_dist = []
-                this_traj = []
-                simulation_number = mapping[i]
-
-                for k in range(self.beta):
-                    sample_points = sims[i, k, :, :]
-                    points = transform_data_for_fitting(self.models[model].fit, sample_points)
-                    if do_comp:
-                        distance = self.distancefn(points, self.data.values, this_model_parameters[i], model)
-                        dist = check_below_threshold(distance, epsilon)
-                    else:
-                        distance = 0
-                        dist = True
-
-                    this_dist.append(distance)
-                    this_traj.append(points)
-
-                    if dist:
-                        accepted[simulation_number] += 1
+    def submit_simulations(self, sampled_model_indexes, sampled_params, epsilon, do_comp=True):
+        """
+        Queue the simulations of a batch in the worker processes, without waiting for them.
 
-                    if self.debug == 2:
-                        print '\t\t\tdistance/this_epsilon/mapping/b:', distance, epsilon, \
-                            simulation_number, accepted[simulation_number]
+        Parameters
+        ----------
+        sampled_model_indexes : list of sampled model numbers
+        sampled_params : an array of sampled parameters, shape (len(sampled_model_indexes), max_nparameters)
+        epsilon : value of epsilon
+        do_comp : if False, do not calculate distances
+
+        Returns
+        -------
+        a list of tuples (mapping, simulation), one per sampled model, where mapping holds the indexes in the batch of
+        the particles of the model and simulation is a parallel.PendingSimulation
+
+        """
+        if self.simulation_pool is None:
+            self.simulation_pool = parallel.SimulationPool(self, self.nprocesses)
+
+        models = np.array(sampled_model_indexes)
+        simulations = []
+        for model in range(self.nmodel):
+            mapping = np.flatnonzero(models == model)
+            if len(mapping) == 0:
+                continue
 
-                traj[simulation_number] = copy.deepcopy(this_traj)
-                distances[simulation_number] = copy.deepcopy(this_dist)
+            this_model_parameters = sampled_params[mapping, :self.models[model].nparameters]
+            simulations.append((mapping, self.simulation_pool.submit(model, this_model_parameters, epsilon, do_comp)))
+
+        return simulations
+
+    @staticmethod
+    def gather_simulations(nbatch, results):
+        """
+        Put the results of the simulations of each model back into the order of the batch.
+
+        Parameters
+        ----------
+        nbatch : number of particles in the batch
+        results : list of tuples (mapping, (accepted, distances, traj)), one per sampled model, where mapping holds the
+            indexes in the batch of the particles of the model
+
+        Returns
+        -------
+        accepted, distances, traj
+
+        """
+        accepted = [0] * nbatch
+        traj = [[] for _ in range(nbatch)]
+        distances = [[] for _ in range(nbatch)]
+
+        for mapping, (this_accepted, this_distances, this_traj) in results:
+            for i in range(len(mapping)):
+                accepted[mapping[i]] = this_accepted[i]
+                distances[mapping[i]] = this_distances[i]
+                traj[mapping[i]] = this_traj[i]
 
         return accepted, distances, traj
 
-    def sample_model_from_prior(self):
+    def simulate_and_compare_model(self, model, params, epsilon, do_comp=True):
         """
-        Returns a list of model numbers, of length self.nbatch, drawn from a categorical distribution with probabilities
-         self.modelprior
+        Simulate a set of particles of one model, and compare the simulations to the data. This is run either in the
+        main process or in the workers of a parallel.SimulationPool.
+
+        Parameters
+        ----------
+        model : index of the model
+        params : array of parameters, shape (num_simulations, nparameters)
+        epsilon : value of epsilon
+        do_comp : if False, do not actually calculate distance between simulation results and experimental data, and
+            instead assume this is 0.
+
+        Returns
+        -------
+        accepted : list containing, for each simulation, the number of the beta repeats that were accepted
+        distances : list containing, for each simulation, an array of shape (beta, ndistances)
+        traj : list containing, for each simulation, an array of shape (beta, num_timepoints, data_dimension) holding
+            the fitted trajectories (None if trajectories are not kept)
 
         """
-        models = [0] * self.nbatch
-        if self.nmodel > 1:
-            for i in range(self.nbatch):
-                models[i] = statistics.w_choice(self.modelprior)
+        num_simulations = len(params)
 
-        return models
+        with self.timer.phase('simulation', self.models[model].name):
+            sims = self.models[model].simulate(params, self.data.timepoints, num_simulations, self.beta)
+        if self.debug == 2:
+            print '\t\t\tsimulation dimensions:', sims.shape
 
-    def sample_model(self):
+        # apply the fitting instructions to all the simulations at once
+        fitted = self.fits[model].apply(sims)[:, :self.beta]
+
+        if do_comp:
+            with self.timer.phase('distance', self.models[model].name):
+                distances = self.distance_batchfn(fitted, self.data.values, params, model)
+                accepted = np.sum(check_below_threshold_batch(distances, epsilon), axis=1)
+        else:
+            distances = np.zeros([num_simulations, self.beta, 1])
+            accepted = np.repeat(self.beta, num_simulations)
+
+        if self.debug == 2:
+            for i in range(num_simulations):
+                print '\t\t\tdistance/this_epsilon/simulation/b:', distances[i], epsilon, i, accepted[i]
+
+        # the trajectories are copied once, into the arrays of the accepted simulations, so they are not copied here
+        if self.keep_trajectories:
+            traj = list(fitted)
+        else:
+            traj = [None] * num_simulations
+
+        return list(accepted), list(distances), traj
+
+    def close_simulation_pool(self):
         """
-        Returns a list of model numbers, of length self.nbatch, obtained by sampling from a categorical distribution
-        with probabilities self.modelprior, and then perturbing with a uniform model perturbation kernel.
+        Stop the worker processes, if any were started.
         """
+        if self.simulation_pool is not None:
+            self.simulation_pool.close()
+            self.simulation_pool = None
 
-        models = [0] * self.nbatch
+    def sample_model_from_prior(self, nbatch=None):
+        """
+        Returns an array of model numbers, of length nbatch (default self.nbatch), drawn from a categorical
+        distribution with probabilities self.modelprior
+
+        """
+        if nbatch is None:
+            nbatch = self.nbatch
 
         if self.nmodel > 1:
-            # Sample models from prior distribution
-            for i in range(self.nbatch):
-                models[i] = statistics.w_choice(self.margins_prev)
+            return statistics.w_choice_batch(self.modelprior, nbatch)
+
+        return np.zeros(nbatch, dtype=int)
+
+    def sample_model(self, nbatch=None):
+        """
+        Returns an array of model numbers, of length nbatch (default self.nbatch), obtained by sampling from a
+        categorical distribution with probabilities given by the previous model marginals, and then perturbing with a
+        uniform model perturbation kernel.
+        """
+        if nbatch is None:
+            nbatch = self.nbatch
 
-            # perturb models
-            if len(self.dead_models) < self.nmodel - 1:
+        if self.nmodel == 1:
+            return np.zeros(nbatch, dtype=int)
 
-                for i in range(self.nbatch):
-                    u = rnd.uniform(low=0, high=1)
+        # Sample models from prior distribution
+        models = statistics.w_choice_batch(self.population_prev.margins, nbatch)
 
-                    if u > self.modelKernel:
-                        # sample randomly from other (non dead) models
-                        not_available = set(self.dead_models[:])
-                        not_available.add(models[i])
+        # perturb models
+        if len(self.dead_models) < self.nmodel - 1:
+            perturbed = np.flatnonzero(rnd.uniform(low=0, high=1, size=nbatch) > self.modelKernel)
 
-                        available_indexes = np.array(list(set(range(self.nmodel)) - not_available))
-                        rnd.shuffle(available_indexes)
-                        perturbed_model = available_indexes[0]
+            # sample randomly from the other (non dead) models: draw a position among the available models, skipping
+            # over the position of the current model if it is not dead
+            alive = np.array(sorted(set(range(self.nmodel)) - set(self.dead_models)))
+            current = models[perturbed]
+            is_alive = np.in1d(current, alive)
+            position = np.floor(rnd.uniform(size=len(perturbed)) * (len(alive) - is_alive)).astype(int)
+            position += is_alive & (position >= np.searchsorted(alive, current))
 
-                        models[i] = perturbed_model
-        return models[:]
+            models[perturbed] = alive[position]
+
+        return models
 
     def sample_parameters_from_prior(self, sampled_model_indexes):
         """
@@ -651,34 +957,21 @@ class Abcsmc:
 
         Parameters
         ----------
-        sampled_model_indexes : a list of model indexes, of length self.nbatch
+        sampled_model_indexes : a list of model indexes, one per particle of the batch
 
         Returns
         -------
-        a list of length self.nbatch, each entry of which is a list of parameter samples (whose length is
-                model.nparameters for the corresponding model)
+        an array of shape (len(sampled_model_indexes), max_nparameters); row i contains the parameter sample for the
+            i-th model index in its first model.nparameters entries, and NaN in the remaining entries
 
         """
-        samples = []
-
-        for i in range(self.nbatch):
-            model = self.models[sampled_model_indexes[i]]
-            sample = [0] * model.nparameters
-
-            for param in range(model.nparameters):
-                if model.prior[param].type == PriorType.constant:
-                    sample[param] = model.prior[param].value
-
-                if model.prior[param].type == PriorType.normal:
-                    sample[param] = rnd.normal(loc=model.prior[param].mean, scale=np.sqrt(model.prior[param].variance))
-
-                if model.prior[param].type == PriorType.uniform:
-                    sample[param] = rnd.uniform(low=model.prior[param].lower_bound, high=model.prior[param].upper_bound)
-
-                if model.prior[param].type == PriorType.lognormal:
-                    sample[param] = rnd.lognormal(mean=model.prior[param].mu, sigma=np.sqrt(model.prior[param].sigma))
+        samples = np.empty([len(sampled_model_indexes), self.population_curr.parameters.shape[1]])
+        samples.fill(np.nan)
 
-            samples.append(sample[:])
+        sampled_model_indexes = np.asarray(sampled_model_indexes)
+        for model in np.unique(sampled_model_indexes):
+            mapping = np.flatnonzero(sampled_model_indexes == model)
+            samples[mapping, :self.models[model].nparameters] = self.priors[model].sample(len(mapping))
 
         return samples
 
@@ -688,39 +981,80 @@ class Abcsmc:
         the corresponding model (with probability biased by the particle weights), and then perturbing using the
         parameter perturbation kernel; if this gives parameters with probability <=0 the process is repeated.
 
+        With the built-in perturbation function, the particles of each model are perturbed as a block by
+        kernels.perturb_particles, whose kernels are truncated to the support of the prior, so that no ancestor is
+        sampled again; custom perturbation functions are called one particle at a time by sample_parameters_sequential.
+
         Parameters
         ----------
-        sampled_model_indexes : a list of model indexes, of length self.nbatch
+        sampled_model_indexes : a list of model indexes, one per particle of the batch
 
 
         Returns
         -------
-        a list of length self.nbatch, each entry of which is a list of parameter samples (whose length is
-            model.nparameters for the corresponding model)
+        an array of shape (len(sampled_model_indexes), max_nparameters); row i contains the parameter sample for the
+            i-th model index in its first model.nparameters entries, and NaN in the remaining entries
 
         """
+        if self.perturbfn is not kernels.perturb_particle:
+            return self.sample_parameters_sequential(sampled_model_indexes)
+
         if self.debug == 2:
             print "\t\t\t***sampleTheParameter"
-        samples = []
+        samples = np.empty([len(sampled_model_indexes), self.population_curr.parameters.shape[1]])
+        samples.fill(np.nan)
+
+        sampled_model_indexes = np.asarray(sampled_model_indexes)
+        for model_num in np.unique(sampled_model_indexes):
+            model = self.models[model_num]
+            pending = np.flatnonzero(sampled_model_indexes == model_num)
+
+            while len(pending) > 0:
+                # sample putative particles from previous population, and perturb them using the truncated parameter
+                # perturbation kernel; particles outside the prior (eg on the open bound of a lognormal prior) are
+                # sampled again
+                ancestors = self.sample_ancestors(np.repeat(model_num, len(pending)))
+                block = self.population_prev.parameters[ancestors, :model.nparameters]
+                with self.timer.phase('perturbation', model.name):
+                    inside = kernels.perturb_particles(block, model.prior, self.kernels[model_num], self.kernel_type,
+                                                       self.special_cases[model_num],
+                                                       self.ancestor_position[ancestors])
+
+                if self.debug == 2:
+                    print "\t\t\tmodel / perturbed / inside prior:", model_num, len(pending), np.sum(inside)
+
+                samples[pending[inside], :model.nparameters] = block[inside]
+                pending = pending[~inside]
+
+        return samples
 
-        for i in range(self.nbatch):
+    def sample_parameters_sequential(self, sampled_model_indexes):
+        """
+        Sample parameters as in sample_parameters, calling self.perturbfn once for each particle. This is used for
+        custom perturbation functions.
+        """
+        if self.debug == 2:
+            print "\t\t\t***sampleTheParameter"
+        samples = np.empty([len(sampled_model_indexes), self.population_curr.parameters.shape[1]])
+        samples.fill(np.nan)
+
+        # sample putative particles from previous population
+        ancestors = self.sample_ancestors(sampled_model_indexes)
+
+        for i in range(len(sampled_model_indexes)):
             model = self.models[sampled_model_indexes[i]]
             model_num = sampled_model_indexes[i]
-
-            num_params = model.nparameters
-            sample = [0] * num_params
+            particle = ancestors[i]
 
             prior_prob = -1
             while prior_prob <= 0:
+                if prior_prob == 0:
+                    # the last perturbation fell outside the prior, so sample a new putative particle
+                    particle = self.sample_ancestors([model_num])[0]
 
-                # sample putative particle from previous population
-                particle = sample_particle_from_model(self.nparticles, model_num, self.margins_prev, self.model_prev,
-                                                      self.weights_prev)
-
-                # Copy this particle's params into a new array, then perturb this in place using the parameter
+                # Copy this particle's params into a new list, then perturb this in place using the parameter
                 #  perturbation kernel
-                for param in range(num_params):
-                    sample[param] = self.parameters_prev[particle][param]
+                sample = list(self.population_prev.particle_parameters(particle))
 
                 prior_prob = self.perturbfn(sample, model.prior, self.kernels[model_num],
                                             self.kernel_type, self.special_cases[model_num])
@@ -728,12 +1062,55 @@ class Abcsmc:
                 if self.debug == 2:
                     print "\t\t\tsampled p prob:", prior_prob
                     print "\t\t\tnew:", sample
-                    print "\t\t\told:", self.parameters_prev[particle]
+                    print "\t\t\told:", self.population_prev.particle_parameters(particle)
 
-            samples.append(sample)
+            samples[i, :model.nparameters] = sample
 
         return samples
 
+    def index_previous_population(self):
+        """
+        Build, for each model, the indexes and the cumulative weights of the particles of the previous population with
+        that model. These are used by sample_ancestors. Also record the position of each particle among the particles of
+        its model, which addresses the covariances of the local kernels.
+        """
+        self.ancestor_index = []
+        self.ancestor_cumulative_weights = []
+        self.ancestor_position = np.zeros(self.nparticles, dtype=int)
+        for model in range(self.nmodel):
+            index = self.population_prev.model_index(model)
+            self.ancestor_index.append(index)
+            self.ancestor_cumulative_weights.append(np.cumsum(self.population_prev.weights[index]))
+            self.ancestor_position[index] = np.arange(len(index))
+
+    def sample_ancestors(self, sampled_model_indexes):
+        """
+        For each model index in sampled_model_indexes, select a particle from those in the previous population whose
+        model is that model, weighted by their previous weight.
+
+        Parameters
+        ----------
+        sampled_model_indexes : a list of model indexes
+
+        Returns
+        -------
+        an integer array containing the index of each selected particle
+
+        """
+        sampled_model_indexes = np.asarray(sampled_model_indexes)
+        ancestors = np.zeros(len(sampled_model_indexes), dtype=int)
+
+        for model in np.unique(sampled_model_indexes):
+            mapping = np.flatnonzero(sampled_model_indexes == model)
+            index = self.ancestor_index[model]
+            cumulative = self.ancestor_cumulative_weights[model]
+
+            u = rnd.uniform(low=0, high=self.population_prev.margins[model], size=len(mapping))
+            position = np.minimum(np.searchsorted(cumulative, u, side='right'), len(index) - 1)
+            ancestors[mapping] = index[position]
+
+        return ancestors
+
     def compute_particle_weights(self):
         """
         Calculate the weight of each particle.
@@ -743,107 +1120,122 @@ class Abcsmc:
 
         (See p.4 of SOM to 'Bayesian design of synthetic biological systems', except that here we have moved model
         marginal out of s2 into a separate term)
+
+        The weights are computed in log space, into the log_weights of the current population: the kernel log densities
+        between all new and old particles of a model are evaluated as array operations, a block of new particles at a
+        time, and S_2 is their log-sum-exp weighted by the previous log weights. Custom kernel pdf functions are
+        evaluated one pair of particles at a time by compute_particle_weights_pairwise.
         """
+        if self.kernelpdffn is not kernels.get_parameter_kernel_pdf:
+            self.compute_particle_weights_pairwise()
+            return
+
         if self.debug == 2:
             print "\t***computeParticleWeights"
 
-        for k in range(self.nparticles):
-            model_num = self.model_curr[k]
+        prev = self.population_prev
+        curr = self.population_curr
+
+        for model_num in range(self.nmodel):
+            new_index = curr.model_index(model_num)
+            if len(new_index) == 0:
+                continue
+            old_index = prev.model_index(model_num)
             model = self.models[model_num]
 
-            this_param = self.parameters_curr[k]
+            this_params = curr.model_parameters(model_num)
+            old_params = prev.model_parameters(model_num)
+            old_log_weights = prev.log_weights[old_index]
+            old_aux = [self.kernel_aux[j] for j in old_index]
 
-            model_prior = self.modelprior[model_num]
+            particle_log_prior = self.priors[model_num].log_pdf(this_params)
+
+            # self.b[k] is a variable indicating whether the simulation corresponding to particle k was accepted
+            log_numerator = np.log(self.b[new_index]) + np.log(self.modelprior[model_num]) + particle_log_prior
+
+            s1 = 0
+            for i in range(self.nmodel):
+                s1 += prev.margins[i] * get_model_kernel_pdf(model_num, i, self.modelKernel, self.nmodel,
+                                                                  self.dead_models)
+
+            log_s2 = np.empty(len(new_index))
+            log_s2.fill(-np.inf)
+            if len(old_index) > 0:
+                # bound the size of the (block, num_old, num_parameters) arrays built by the kernel
+                block = max(1, weight_block_size // max(1, len(old_index) * model.nparameters))
+                for start in range(0, len(new_index), block):
+                    kernel_log_pdf = kernels.get_parameter_kernel_log_pdf_matrix(this_params[start:start + block],
+                                                                                 old_params, model.prior,
+                                                                                 self.kernels[model_num], old_aux,
+                                                                                 self.kernel_type,
+                                                                                 np.arange(len(old_index)))
+                    log_s2[start:start + block] = logsumexp(kernel_log_pdf + old_log_weights, axis=1)
 
-            particle_prior = 1
-            for n in range(len(self.parameters_curr[k])):
-                x = 1.0
-                this_prior = model.prior[n]
+            if self.debug == 2:
+                print "\tmodel/s1/m(t-1) : ", model_num, s1, prev.margins[model_num]
+                print "\tlog numer/log s2 : ", log_numerator, log_s2
+
+            curr.log_weights[new_index] = np.log(prev.margins[model_num]) + log_numerator - np.log(s1) - log_s2
+
+    def compute_particle_weights_pairwise(self):
+        """
+        Calculate the weight of each particle as in compute_particle_weights, calling self.kernelpdffn once for each
+        pair of new and old particles. This is used for custom kernel functions.
+        """
+        if self.debug == 2:
+            print "\t***computeParticleWeights"
 
-                if this_prior.type == PriorType.constant:
-                    x = 1
+        prev = self.population_prev
+        curr = self.population_curr
 
-                if this_prior.type == PriorType.normal:
-                    x = statistics.get_pdf_gauss(this_prior.mean, np.sqrt(this_prior.variance), this_param[n])
+        for k in range(self.nparticles):
+            model_num = curr.models[k]
+            model = self.models[model_num]
 
-                if this_prior.type == PriorType.uniform:
-                    x = statistics.get_pdf_uniform(this_prior.lower_bound, this_prior.upper_bound, this_param[n])
+            this_param = list(curr.particle_parameters(k))
 
-                if this_prior.type == PriorType.lognormal:
-                    x = statistics.get_pdf_lognormal(this_prior.mu, np.sqrt(this_prior.sigma), this_param[n])
-                particle_prior = particle_prior * x
+            model_prior = self.modelprior[model_num]
+
+            particle_prior = self.priors[model_num].pdf([this_param])[0]
 
             # self.b[k] is a variable indicating whether the simulation corresponding to particle k was accepted
             numerator = self.b[k] * model_prior * particle_prior
 
             s1 = 0
             for i in range(self.nmodel):
-                s1 += self.margins_prev[i] * get_model_kernel_pdf(model_num, i, self.modelKernel, self.nmodel,
-                                                                  self.dead_models)
+                s1 += prev.margins[i] * get_model_kernel_pdf(model_num, i, self.modelKernel, self.nmodel,
+                                                             self.dead_models)
             s2 = 0
             for j in range(self.nparticles):
-                if int(model_num) == int(self.model_prev[j]):
+                if int(model_num) == int(prev.models[j]):
+                    old_param = list(prev.particle_parameters(j))
 
                     if self.debug == 2:
-                        print "\tj, weights_prev, kernelpdf", j, self.weights_prev[j],
-                        self.kernelpdffn(this_param, self.parameters_prev[j], model.prior,
+                        print "\tj, weights_prev, kernelpdf", j, prev.weights[j],
+                        self.kernelpdffn(this_param, old_param, model.prior,
                                          self.kernels[model_num], self.kernel_aux[j], self.kernel_type)
 
-                    kernel_pdf = self.kernelpdffn(this_param, self.parameters_prev[j], model.prior,
+                    kernel_pdf = self.kernelpdffn(this_param, old_param, model.prior,
                                                   self.kernels[model_num], self.kernel_aux[j], self.kernel_type)
-                    s2 += self.weights_prev[j] * kernel_pdf
+                    s2 += prev.weights[j] * kernel_pdf
 
                 if self.debug == 2:
-                    print "\tnumer/s1/s2/m(t-1) : ", numerator, s1, s2, self.margins_prev[model_num]
+                    print "\tnumer/s1/s2/m(t-1) : ", numerator, s1, s2, prev.margins[model_num]
 
-            self.weights_curr[k] = self.margins_prev[model_num] * numerator / (s1 * s2)
+            with np.errstate(divide='ignore'):
+                curr.log_weights[k] = np.log(prev.margins[model_num] * numerator / (s1 * s2))
 
     def normalize_weights(self):
         """
-        Normalize weights by dividing each by the total.
+        Normalize weights by subtracting the log-sum-exp of the log weights, so that the weights sum to one.
         """
-        n = sum(self.weights_curr)
-        for i in range(self.nparticles):
-            self.weights_curr[i] /= float(n)
+        self.population_curr.normalize_weights()
 
     def update_model_marginals(self):
         """
         Re-calculate the marginal probability of each model as the sum of the weights of the corresponding particles.
         """
-        for model in range(self.nmodel):
-            self.margins_curr[model] = 0
-            for particle in range(self.nparticles):
-                if int(self.model_curr[particle]) == int(model):
-                    self.margins_curr[model] += self.weights_curr[particle]
-
-
-def sample_particle_from_model(nparticle, selected_model, margins_prev, model_prev, weights_prev):
-    """
-    Select a particle from those in the previous generation whose model was the currently selected model, weighted by
-    their previous weight.
-
-    Parameters
-    ----------
-    nparticle : number of particles
-    selected_model : index of the currently selected model
-    margins_prev : the marginal probability of the selected model at the previous iteration (nb. this is the sum of the
-        weights of the corresponding particles)
-    model_prev : list recording the model index corresponding to each particle from the previous iteration
-    weights_prev : list recording the weight of each particle from the previous iteration
-
-    Returns
-    -------
-    the index of the selected particle
-    """
-    u = rnd.uniform(low=0, high=margins_prev[selected_model])
-    f = 0
-
-    for i in range(nparticle):
-        if int(model_prev[i]) == int(selected_model):
-            f = f + weights_prev[i]
-            if f > u:
-                return i
-    return nparticle - 1
+        self.population_curr.update_margins()
 
 
 def transform_data_for_fitting(fitting_instruction, sample_points):
@@ -851,7 +1243,7 @@ def transform_data_for_fitting(fitting_instruction, sample_points):
     Given the results of a simulation, evaluate given functions of the state variables of the model.
 
     This accounts for the correspondance between species defined in the model being simulated and the experimental data
-    being fit.
+    being fit. The instructions are compiled the first time they are seen (see CompiledFit).
 
     Parameters
     ----------
@@ -866,14 +1258,7 @@ def transform_data_for_fitting(fitting_instruction, sample_points):
 
     """
 
-    if fitting_instruction is not None:
-        transformed_points = np.zeros([len(sample_points), len(fitting_instruction)])
-        for i in range(len(fitting_instruction)):
-            transformed_points[:, i] = np.squeeze(eval(fitting_instruction[i]))
-    else:
-        transformed_points = sample_points
-
-    return transformed_points[:]
+    return compile_fit(fitting_instruction).apply(sample_points)[:]
 
 
 def get_model_kernel_pdf(new_model, old_model, model_k, num_models, dead_models):
@@ -923,3 +1308,22 @@ def check_below_threshold(distance, epsilon):
             accepted = False
             break
     return accepted
+
+
+def check_below_threshold_batch(distances, epsilon):
+    """
+    Vectorised form of check_below_threshold.
+
+    Parameters
+    ----------
+    distances : array of distances, shape (num_simulations, beta, ndistances)
+    epsilon : list of maximum acceptable distances
+
+    Returns
+    -------
+    a boolean array of shape (num_simulations, beta)
+
+    """
+    distances = distances[:, :, :len(epsilon)]
+    with np.errstate(invalid='ignore'):
+        return np.all((distances >= 0) & (distances <= np.asarray(epsilon, dtype=float)), axis=2)
@@ -0,0 +1,394 @@
+# Coordinator and workers of a population spread over several hosts
+#
+# The coordinator is the Abcsmc object of the main run. Once per population it publishes the previous population, the
+# kernels and epsilon to every connected worker. A worker is an Abcsmc object built from the same input file, which
+# samples, simulates and compares batches of particles locally until it is told to stop, and streams back only the
+# accepted particles of each batch with the size of the batch.
+#
+# Messages are pickled tuples sent over a multiprocessing.connection Connection, on a TCP socket (address host:port) or
+# a Unix socket (address path). The first element of a message is its kind:
+#   coordinator -> worker:  ('seed', seed), ('population', generation, state, first_batch), ('stop', generation),
+#                           ('close',)
+#   worker -> coordinator:  ('particles', generation, batch, nbatch, positions, models, parameters, accepted,
+#                            distances, traj)
+#
+# Trust model: unpickling a message can run arbitrary code, so messages are only exchanged with peers which have proved
+# that they hold the shared authentication key, by the HMAC challenge of multiprocessing.connection, before anything is
+# unpickled. The key is read from the environment variable ABC_SYSBIO_AUTHKEY, and must be set on the coordinator and
+# on every worker. It is required for TCP sockets; a Unix socket may be used without a key, in which case anyone who
+# can open the socket file is trusted, so it should be in a directory which only the user can access. The messages are
+# authenticated but not encrypted.
+#
+# The batches of each worker are numbered, and the coordinator accepts the particles of the batches in the order of
+# their numbers, and of the workers for the same number, whatever the order in which they arrive. Particles whose
+# simulations take less time are therefore not favoured. The batches which are still being simulated, or are queued,
+# when the population is full are discarded, and are not counted in the number of particles sampled.
+
+import os
+import select
+import socket
+import stat
+import sys
+import threading
+import Queue
+from multiprocessing.connection import AuthenticationError, Client, Listener
+
+import numpy as np
+from numpy import random as rnd
+
+authkey_variable = 'ABC_SYSBIO_AUTHKEY'
+
+
+def parse_address(address):
+    """
+    Return the multiprocessing.connection family and address corresponding to a string of the form host:port (TCP) or
+    a path (Unix).
+    """
+    if ':' in address and os.sep not in address:
+        host, port = address.rsplit(':', 1)
+        return 'AF_INET', (host, int(port))
+    return 'AF_UNIX', address
+
+
+def get_authkey(family, authkey=None):
+    """
+    Return the authentication key, by default read from the environment variable ABC_SYSBIO_AUTHKEY, or exit if a TCP
+    socket is used without one.
+    """
+    if authkey is None:
+        authkey = os.environ.get(authkey_variable) or None
+    if authkey is None and family == 'AF_INET':
+        sys.exit("\nSet the environment variable " + authkey_variable + " to a shared secret key to use a TCP socket "
+                 "(see distributed.py)\n")
+    return authkey
+
+
+def population_state(algorithm, epsilon, prior, do_comp):
+    """
+    Return what a worker needs to sample and simulate particles of the next population.
+    """
+    population = algorithm.population_prev
+    rate = algorithm.rate[-1] if len(algorithm.rate) > 0 else None
+    return {'epsilon': epsilon, 'prior': prior, 'do_comp': do_comp, 'models': population.models,
+            'weights': population.weights, 'parameters': population.parameters, 'margins': population.margins,
+            'kernels': algorithm.kernels, 'kernel_aux': algorithm.kernel_aux, 'dead_models': algorithm.dead_models,
+            'rate': rate}
+
+
+def load_population_state(algorithm, state):
+    """
+    Copy a state published by the coordinator into the Abcsmc object of a worker.
+    """
+    population = algorithm.population_prev
+    population.models[:] = state['models']
+    population.weights[:] = state['weights']
+    population.parameters[:] = state['parameters']
+    population.margins[:] = state['margins']
+
+    algorithm.kernels = state['kernels']
+    algorithm.kernel_aux = state['kernel_aux']
+    algorithm.dead_models = state['dead_models']
+    algorithm.index_previous_population()
+    algorithm.batch_size.start_population(state['rate'])
+
+
+class Coordinator:
+    """
+    Listen for workers, and collect the particles of each population from them.
+    """
+
+    def __init__(self, address, authkey=None):
+        """
+
+        Parameters
+        ----------
+        address : address to listen on, host:port or the path of a Unix socket
+        authkey : the shared authentication key, by default read from the environment variable ABC_SYSBIO_AUTHKEY;
+            it may only be omitted with a Unix socket
+
+        """
+        self.family, self.address = parse_address(address)
+        self.authkey = get_authkey(self.family, authkey)
+
+        # remove the socket left behind by a previous coordinator
+        if self.family == 'AF_UNIX' and os.path.exists(self.address):
+            if stat.S_ISSOCK(os.stat(self.address).st_mode):
+                os.remove(self.address)
+
+        self.listener = Listener(self.address, self.family, 128, self.authkey)
+        if self.family == 'AF_INET':
+            self.address = self.listener.address
+
+        # workers are accepted and authenticated in a thread, so that a client which does not complete the handshake
+        # does not hold up the run; it queues them in joined, and writes to the pipe wake to interrupt select
+        self.joined = Queue.Queue()
+        self.wake = os.pipe()
+        self.closing = False
+        self.accept_thread = threading.Thread(target=self.accept_workers, name='abcsysbio-coordinator')
+        self.accept_thread.daemon = True
+        self.accept_thread.start()
+
+        self.workers = []
+        self.worker_ids = {}
+        self.next_worker_id = 0
+        self.generation = 0
+
+        # message describing the population being collected, sent to the workers that connect during the population
+        self.state = None
+
+        # number of the next batch expected from each worker, (number, worker id) of the last batch whose particles
+        # were accepted, the batches received but not yet accepted keyed by (number, worker id), and the number of
+        # batches discarded because the population was already full
+        self.next_batch = {}
+        self.last_batch = (-1, -1)
+        self.pending = {}
+        self.discarded = 0
+
+    def accept_workers(self):
+        while True:
+            try:
+                connection = self.listener.accept()
+            except (AuthenticationError, EOFError, IOError, socket.error) as e:
+                if self.closing:
+                    return
+                print "#### Refused a worker connection :", e
+                continue
+
+            if self.closing:
+                connection.close()
+                return
+            self.joined.put(connection)
+            os.write(self.wake[1], 'w')
+
+    def add_joined_workers(self):
+        os.read(self.wake[0], 1)
+        while not self.joined.empty():
+            connection = self.joined.get()
+            try:
+                connection.send(('seed', rnd.randint(2 ** 31 - 1)))
+                if self.state is not None:
+                    self.start_worker(connection)
+            except (IOError, EOFError):
+                connection.close()
+                continue
+
+            self.worker_ids[connection] = self.next_worker_id
+            self.next_worker_id += 1
+            self.workers.append(connection)
+            print "#### Worker connected, number of workers :", len(self.workers)
+
+    def start_worker(self, connection):
+        # the batches of a worker which joins during a population are numbered so that they follow the batches
+        # already accepted
+        first_batch = max(0, self.last_batch[0])
+        connection.send(self.state + (first_batch,))
+        self.next_batch[connection] = first_batch
+
+    def remove_worker(self, connection):
+        self.workers.remove(connection)
+        self.next_batch.pop(connection, None)
+        connection.close()
+        print "#### Worker disconnected, number of workers :", len(self.workers)
+
+    def broadcast(self, message):
+        for connection in list(self.workers):
+            try:
+                connection.send(message)
+            except (IOError, EOFError):
+                self.remove_worker(connection)
+
+    def next_pending_batch(self):
+        """
+        Return the key of the pending batch to accept next, or None if a worker may still send a batch which comes
+        before it.
+        """
+        if len(self.pending) == 0:
+            return None
+        key = min(self.pending)
+        for connection in self.workers:
+            if connection in self.next_batch and (self.next_batch[connection], self.worker_ids[connection]) < key:
+                return None
+        return key
+
+    def accept_particles(self, algorithm, epsilon, prior, do_comp=True):
+        """
+        Publish the state of the next population to the workers, and store the particles they accept in the current
+        population of algorithm until it is full.
+
+        Parameters
+        ----------
+        algorithm : the Abcsmc object running the population
+        epsilon : value of epsilon
+        prior : if True, sample the particles from the prior, otherwise perturb the previous population
+        do_comp : if False, do not calculate distances, and accept every simulation
+
+        Returns
+        -------
+        naccepted : number of accepted particles
+        sampled : number of particles examined before nparticles were accepted
+
+        """
+        self.generation += 1
+        self.state = ('population', self.generation, population_state(algorithm, epsilon, prior, do_comp))
+        self.last_batch = (-1, -1)
+        self.pending = {}
+        self.discarded = 0
+        for connection in list(self.workers):
+            try:
+                self.start_worker(connection)
+            except (IOError, EOFError):
+                self.remove_worker(connection)
+
+        naccepted = 0
+        sampled = 0
+        waiting = False
+        while naccepted < algorithm.nparticles:
+            if len(self.workers) == 0 and not waiting:
+                print "#### Waiting for workers on", self.address
+            waiting = len(self.workers) == 0
+
+            readable = select.select([self.wake[0]] + self.workers, [], [])[0]
+            for connection in readable:
+                if connection is self.wake[0]:
+                    self.add_joined_workers()
+                    continue
+
+                try:
+                    message = connection.recv()
+                except (IOError, EOFError):
+                    message = None
+                if message is None:
+                    self.remove_worker(connection)
+                    continue
+
+                # particles of a previous population are discarded
+                if message[1] != self.generation:
+                    continue
+
+                batch = message[2]
+                self.next_batch[connection] = batch + 1
+                self.pending[(batch, self.worker_ids[connection])] = message[3:]
+
+            key = self.next_pending_batch()
+            while key is not None and naccepted < algorithm.nparticles:
+                self.last_batch = key
+                nbatch, positions, models, params, accepted, distances, traj = self.pending.pop(key)
+                for i in range(len(positions)):
+                    algorithm.population_curr.set_particle(naccepted, models[i], params[i])
+                    algorithm.b[naccepted] = accepted[i]
+                    algorithm.simulations.set_particle(naccepted, models[i], traj[i], distances[i])
+                    naccepted += 1
+
+                    if naccepted == algorithm.nparticles:
+                        sampled += positions[i] + 1
+                        break
+                else:
+                    sampled += nbatch
+                key = self.next_pending_batch()
+
+        # the batches received after the last accepted one, and those the workers are still sending, are discarded
+        self.discarded = len(self.pending)
+        self.pending = {}
+        self.state = None
+        self.broadcast(('stop', self.generation))
+        if algorithm.debug == 2:
+            print "\t****discarded batches", self.discarded
+
+        return naccepted, sampled
+
+    def close(self):
+        """
+        Tell the workers to exit, and stop listening.
+        """
+        self.broadcast(('close',))
+        for connection in self.workers:
+            connection.close()
+        self.workers = []
+
+        # wake the accepting thread with a connection of our own
+        self.closing = True
+        try:
+            Client(self.address, self.family, self.authkey).close()
+        except (AuthenticationError, EOFError, IOError, socket.error):
+            pass
+        self.accept_thread.join(10)
+        self.listener.close()
+        os.close(self.wake[0])
+        os.close(self.wake[1])
+
+
+def read_messages(connection, messages):
+    # run in a thread of the worker, so that it keeps reading what the coordinator sends while the main thread is
+    # blocked sending particles; otherwise both sides can block on full socket buffers
+    while True:
+        try:
+            message = connection.recv()
+        except (IOError, EOFError):
+            message = None
+        messages.put(message)
+        if message is None or message[0] == 'close':
+            return
+
+
+def run_worker(algorithm, address, authkey=None):
+    """
+    Connect to a coordinator, and sample, simulate and compare particles for each population it publishes, until the
+    coordinator closes the connection.
+
+    Parameters
+    ----------
+    algorithm : an Abcsmc object built from the same input file as the coordinator
+    address : address of the coordinator, host:port or the path of a Unix socket
+    authkey : the shared authentication key, by default read from the environment variable ABC_SYSBIO_AUTHKEY
+
+    """
+    family, address = parse_address(address)
+    connection = Client(address, family, get_authkey(family, authkey))
+    print "#### Connected to coordinator", address
+
+    messages = Queue.Queue()
+    reader = threading.Thread(target=read_messages, args=(connection, messages), name='abcsysbio-worker')
+    reader.daemon = True
+    reader.start()
+
+    try:
+        message = messages.get()
+        if message is None:
+            return
+        rnd.seed(message[1])
+
+        while True:
+            message = messages.get()
+            if message is None or message[0] == 'close':
+                break
+            if message[0] != 'population':
+                # the stop message of a population that this worker has already finished
+                continue
+
+            generation, state, batch = message[1:]
+            load_population_state(algorithm, state)
+
+            batches = algorithm.simulated_batches(state['epsilon'], state['prior'], state['do_comp'])
+            try:
+                for sampled_model_indexes, sampled_params, accepted_index, distances, traj in batches:
+                    nbatch = len(sampled_model_indexes)
+                    positions = np.flatnonzero(accepted_index)
+                    algorithm.batch_size.update(nbatch, len(positions))
+
+                    connection.send(('particles', generation, batch, nbatch, positions,
+                                     np.asarray(sampled_model_indexes)[positions], sampled_params[positions],
+                                     np.asarray(accepted_index)[positions], [distances[i] for i in positions],
+                                     [traj[i] for i in positions]))
+                    batch += 1
+
+                    # stop as soon as the coordinator has sent something, which is either a stop or a close
+                    if not messages.empty():
+                        break
+            except (IOError, EOFError):
+                # the coordinator has closed the connection
+                break
+            finally:
+                batches.close()
+    finally:
+        algorithm.close_simulation_pool()
+        connection.close()
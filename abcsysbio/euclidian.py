@@ -34,3 +34,54 @@ def euclidian_distance(data1, data2, parameters, model):
         return [None]
     else:
         return [distance]
+
+
+def euclidian_distance_batch(sims, data, parameters, model):
+    """
+    Returns the Euclidian distances between each simulation of a batch and a data set.
+
+    Parameters
+    ----------
+
+    sims : array of fitted simulations, with shape (num_simulations, beta, num_timepoints, data_dimension)
+    data : dataset, with shape (num_timepoints, data_dimension)
+    parameters : not used
+    model : not used
+
+    Returns
+    -------
+    an array of distances, with shape (num_simulations, beta, 1)
+
+    """
+
+    del parameters, model
+
+    if numpy.shape(sims)[-2:] != numpy.shape(data):
+        print "\neuclidian_distance: data sets have different dimensions (%s v.s. %s)\n" % (numpy.shape(sims)[-2:],
+                                                                                          numpy.shape(data))
+        sys.exit()
+
+    z = (sims - data) * (sims - data)
+    return numpy.sqrt(numpy.sum(z, axis=(2, 3)))[:, :, numpy.newaxis]
+
+
+class BatchedDistance:
+    """
+    Adapter giving a distance function of one simulation, such as a custom distance, the signature of
+    euclidian_distance_batch. Distances returned as None are replaced by NaN, so that they are never accepted.
+    """
+
+    def __init__(self, distancefn):
+        """
+
+        Parameters
+        ----------
+        distancefn : function of (simulation, data, parameters, model) returning a list of distances
+
+        """
+        self.distancefn = distancefn
+
+    def __call__(self, sims, data, parameters, model):
+        distances = [[self.distancefn(sims[i, k], data, parameters[i], model) for k in range(len(sims[i]))]
+                     for i in range(len(sims))]
+        return numpy.array(distances, dtype=float).reshape(len(sims), numpy.shape(sims)[1], -1)
@@ -109,6 +109,10 @@ def generate_template(source, filename, sumname, dataname=None):
 # Currently uniform and normal are implemented
 <kernel> uniform </kernel>
 
+######################## nearest neighbours : OPTIONAL (default particles/4)
+# Number of nearest neighbours used to compute the covariance of the multiVariateNormalKNeigh kernel
+#<kneighbours> </kneighbours>
+
 ######################## model kernel : OPTIONAL (default 0.7)
 # Probability of perturbing the sampled model (ignored when modelnumber = 1)
 <modelkernel> 0.7 </modelkernel>
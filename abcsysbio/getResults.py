@@ -6,29 +6,7 @@ import math
 
 from matplotlib.ticker import FormatStrFormatter
 
-
-# weighted histogramming
-def bin_data(d, w, nbins):
-    d_max = np.max(d)
-    d_min = np.min(d) - 1e-6  # ensures that the lowest entry is included in the first bin
-    bin_width = (d_max - d_min) / nbins
-
-    bin_l = np.array([d_min + i * bin_width for i in range(nbins)])
-    bin_u = np.array([d_min + (i + 1) * bin_width for i in range(nbins)])
-    bin_c = np.array([bin_l[i] + bin_width / 2 for i in range(nbins)])
-
-    count = np.zeros([nbins])
-
-    for k in range(len(d)):
-        kd = d[k]
-        kw = w[k]
-
-        for i in range(nbins):
-            if bin_l[i] < kd <= bin_u[i]:
-                count[i] = count[i] + kw
-                break
-
-    return [bin_c, count]
+from abcsysbio.statistics import bin_data
 
 
 def matrix_to_text_file(matrix, filename, model, eps):
@@ -235,7 +213,7 @@ def get_all_histograms(matrix, weights, population=1, plot_name='AllScatterPlots
     """
 
     matplotlib.pylab.clf()
-    npar = len(matrix[int(model) - 1][0])
+    npar = len(matrix[int(model) - 1][int(population) - 1])
 
     # Maximum plots per page is 16
     # If we are over this then require multiple plots
@@ -271,7 +249,7 @@ def get_all_histograms(matrix, weights, population=1, plot_name='AllScatterPlots
             start = p * max1 ** 2
             end = p * max1 * max2 + max1 * max2
             for i in range(int(start), int(end)):
-                if i >= len(matrix[int(model) - 1][0]):
+                if i >= npar:
                     break
                 plt.subplot(max1, max2, i - start + 1)
                 plt.subplots_adjust(left=None, bottom=None, right=None, top=None, wspace=0.6, hspace=0.5)
@@ -397,13 +375,14 @@ def get_all_scatter_plots(matrix, weights, populations=(1,), plot_name='AllScatt
     """
 
     matplotlib.pylab.clf()
-    dim = len(matrix[int(model) - 1][0])
+    dim = len(matrix[int(model) - 1][int(populations[-1]) - 1])
 
     my_colors = ['#000000', '#003399', '#3333FF', '#6666FF', '#990000', '#CC0033', '#FF6600', '#FFCC00', '#FFFF33',
                  '#33CC00', '#339900', '#336600']
 
-    if len(populations) > len(my_colors):
-        q = int(math.ceil(len(populations) / len(my_colors)))
+    # each population keeps its colour when only the last few populations are plotted
+    if max(populations) > len(my_colors):
+        q = int(math.ceil(max(populations) / float(len(my_colors))))
 
         for slopes in range(q):
             my_colors.extend(my_colors)
@@ -426,6 +405,7 @@ def get_all_scatter_plots(matrix, weights, populations=(1,), plot_name='AllScatt
             w = weights[int(model) - 1][int(populations[len(populations) - 1]) - 1][int(permutation[i][0]) - 1]
 
             for j in range(len(populations)):
+                colour = my_colors[int(populations[j]) - 1]
 
                 x = matrix[int(model) - 1][int(populations[j]) - 1][int(permutation[i][0]) - 1]
                 y = matrix[int(model) - 1][int(populations[j]) - 1][int(permutation[i][1]) - 1]
@@ -440,12 +420,12 @@ def get_all_scatter_plots(matrix, weights, populations=(1,), plot_name='AllScatt
                             max_x = max(histogram_x)
                             min_x = min(histogram_x)
                             range_x = max_x - min_x
-                            plt.bar(histogram_x, histogram_y, width=range_x / bin_b, color=my_colors[j], align='center')
+                            plt.bar(histogram_x, histogram_y, width=range_x / bin_b, color=colour, align='center')
                             plt.xlabel('parameter ' + repr(i2), size='xx-small')
 
                 else:
                     if not (len(x) == 0):
-                        plt.scatter(x, y, s=10, marker='o', c=my_colors[j], edgecolor=my_colors[j])
+                        plt.scatter(x, y, s=10, marker='o', c=colour, edgecolor=colour)
                         plt.ylabel('parameter ' + repr(int(permutation[i][1])), size='xx-small')
                 plt.xlabel('parameter ' + repr(int(permutation[i][0])), size='xx-small')
 
@@ -503,6 +483,7 @@ def get_all_scatter_plots(matrix, weights, populations=(1,), plot_name='AllScatt
                 plt.subplots_adjust(left=None, bottom=None, right=None, top=None, wspace=0.6, hspace=0.5)
                 w = weights[int(model) - 1][int(populations[len(populations) - 1]) - 1][int(permutation[i][0]) - 1]
                 for j in range(len(populations)):
+                    colour = my_colors[int(populations[j]) - 1]
                     x = matrix[int(model) - 1][int(populations[j]) - 1][int(permutation[i][0]) - 1]
                     y = matrix[int(model) - 1][int(populations[j]) - 1][int(permutation[i][1]) - 1]
 
@@ -517,13 +498,13 @@ def get_all_scatter_plots(matrix, weights, populations=(1,), plot_name='AllScatt
                                 max_x = max(histogram_x)
                                 min_x = min(histogram_x)
                                 range_x = max_x - min_x
-                                plt.bar(histogram_x, histogram_y, color=my_colors[j], width=range_x / bin_b,
+                                plt.bar(histogram_x, histogram_y, color=colour, width=range_x / bin_b,
                                         align='center')
                                 plt.xlabel('parameter ' + repr(i2), size='xx-small')
 
                     else:
                         if not (len(x) == 0):
-                            plt.scatter(x, y, s=10, marker='o', c=my_colors[j], edgecolor=my_colors[j])
+                            plt.scatter(x, y, s=10, marker='o', c=colour, edgecolor=colour)
                             plt.ylabel('parameter ' + repr(int(permutation[i][1])), size='xx-small')
                             plt.xlabel('parameter ' + repr(int(permutation[i][0])), size='xx-small')
 
@@ -1,386 +1,509 @@
-import os, sys, pickle
-import numpy
-
-from getResults import get_all_scatter_plots
-from getResults import get_all_histograms
-from getResults import plot_time_series2
-from getResults import get_model_distribution
-from getResults import plot_data
-
-from matplotlib.backends.backend_pdf import PdfPages
-import matplotlib.pyplot as plt
-from PriorType import PriorType
-
-
-class InputOutput:
-    def __init__(self, folder, restart, diagnostic, plot_data_series, havedata=True):
-        self.folder = folder
-        self.diagnostic = diagnostic
-        self.plotDataSeries = plot_data_series
-        self.havedata = havedata
-
-        # Hold all data here for plotting purposes.
-        # May want to remove this as could get large
-        self.all_results = []
-
-        if restart:
-            self.folder += '_restart'
-
-    def plot_data(self, data):
-        if self.havedata:
-            plot_data(data, self.folder + '/_data')
-
-    # write rates, distances, trajectories
-    def write_data(self, population, results, timing, models, data):
-
-        # results abcsmc_results class
-        self.all_results.append(results)
-
-        beta = len(results.trajectories[0])
-
-        rate_file = open(self.folder + '/rates.txt', "a")
-        print >> rate_file, population + 1, results.epsilon, results.sampled, results.rate, round(timing, 2)
-        rate_file.close()
-
-        # distances are stored as [nparticle][nbeta][d1, d2, d3 .... ]
-        distance_file = open(self.folder + '/distance_Population' + repr(population + 1) + '.txt', "a")
-        for i in range(len(results.distances)):
-            for j in range(len(results.distances[i])):
-                print >> distance_file, i + 1, j, results.distances[i][j], results.models[i]
-        distance_file.close()
-
-        # trajectories are stored as [nparticle][nbeta][ species ][ times ]
-        traj_file = open(self.folder + '/traj_Population' + repr(population + 1) + '.txt', "a")
-        for i in range(len(results.trajectories)):
-            for j in range(len(results.trajectories[i])):
-                arr = results.trajectories[i][j]
-                nrow, ncol = numpy.shape(arr)
-                for ic in range(ncol):
-                    print >> traj_file, i, j, results.models[i], ic,
-                    for ir in range(nrow):
-                        print >> traj_file, arr[ir, ic],
-                    print >> traj_file, ""
-        traj_file.close()
-
-        if len(results.margins) > 1:
-            model_file = open(self.folder + '/ModelDistribution.txt', "a")
-            for m in results.margins:
-                print >> model_file, m,
-            print >> model_file, ""
-            model_file.close()
-
-        nmodels = len(models)
-        for mod in range(nmodels):
-            # print self.folder + '/results_' + models[mod].name
-            try:
-                # print self.folder + '/results_' + models[mod].name
-                os.chdir(self.folder + '/results_' + models[mod].name)
-                # print os.getcwd()
-                os.mkdir("Population_" + repr(population + 1))
-                os.chdir("../..")
-            except OSError:
-                sys.exit("\nCan not create the folder Population_" + repr(population + 1) + "!\n")
-
-        # count number of particles in each model so that we can skip empty models
-        counts = numpy.zeros([nmodels])
-        nparticles = len(results.weights)
-        for np in range(nparticles):
-            counts[results.models[np]] += 1
-
-        # print out particles and weights if there are particles
-        for mod in range(nmodels):
-            if counts[mod] > 0:
-                weight_file = open(self.folder + '/results_' + models[mod].name + '/Population_' + repr(
-                    population + 1) + '/data_Weights' + repr(population + 1) + ".txt", "w")
-                param_file = open(self.folder + '/results_' + models[mod].name + '/Population_' + repr(
-                    population + 1) + '/data_Population' + repr(population + 1) + ".txt", "w")
-
-                nparticles = len(results.weights)
-                for g in range(nparticles):
-                    if results.models[g] == mod:
-                        for k in range(len(results.parameters[g])):
-                            print >> param_file, results.parameters[g][k],
-                        print >> param_file, ""
-
-                        print >> weight_file, results.weights[g]
-
-                weight_file.close()
-                param_file.close()
-
-        # do diagnostics such as scatter plots, histograms and model distribution
-        npop = len(self.all_results)
-        if self.diagnostic:
-
-            if nmodels > 1:
-                # create matrix [npop][nmodel]
-                m = numpy.zeros([len(self.all_results), nmodels])
-                r = []
-                e = []
-                for i in range(len(self.all_results)):
-                    m[i, :] = self.all_results[i].margins
-                    r.append(self.all_results[i].rate)
-                    e.append(self.all_results[i].epsilon)
-
-                get_model_distribution(m, e, r, plot_name=self.folder + '/ModelDistribution')
-
-            # for scatter plots and histograms we require container [model][population][parameter][values]
-            population_mod = []
-            weights_mod = []
-
-            for mod in range(nmodels):
-                population_mod.append([])
-                weights_mod.append([])
-
-                if counts[mod] > 0:
-                    plot_name = self.folder + '/results_' + models[mod].name + '/Population_' + repr(
-                        population + 1) + '/ScatterPlots_Population' + repr(population + 1)
-                    plot_name2 = self.folder + '/results_' + models[mod].name + '/Population_' + repr(
-                        population + 1) + '/weightedHistograms_Population' + repr(population + 1)
-
-                    for eps in range(npop):
-                        population_mod[mod].append([])
-                        weights_mod[mod].append([])
-
-                        non_const = 0
-                        for param in range(models[mod].nparameters):
-                            if not (models[mod].prior[param].type == PriorType.constant):
-                                population_mod[mod][eps].append([])
-                                weights_mod[mod][eps].append([])
-
-                                res = self.all_results[eps]
-                                nparticles = len(res.weights)
-                                for np in range(nparticles):
-                                    if res.models[np] == mod:
-                                        population_mod[mod][eps][non_const].append(res.parameters[np][param])
-                                        weights_mod[mod][eps][non_const].append(res.weights[np])
-
-                                non_const += 1
-
-                    get_all_scatter_plots(population_mod, weights_mod, populations=numpy.arange(1, population + 2),
-                                          plot_name=plot_name, model=mod + 1)
-                    get_all_histograms(population_mod, weights_mod, population=population + 1, plot_name=plot_name2,
-                                       model=mod + 1)
-
-            if self.plotDataSeries:
-                for mod in range(nmodels):
-                    # get the first n of the accepted particles for this model
-                    pars = []
-                    traj2 = []
-                    n = 10
-                    count = 0
-                    nparticles = len(results.weights)
-                    for np in range(nparticles):
-                        if results.models[np] == mod and count < n:
-                            pars.append(results.parameters[np])
-                            traj2.append(results.trajectories[np])
-                            count += 1
-
-                    if len(pars) > 0:
-                        filename = self.folder + '/results_' + models[mod].name + '/Population_' + repr(
-                            npop) + '/Timeseries_Population' + repr(npop)
-                        #  plotTimeSeries(models[mod],pars,data,beta,filename,plotdata=self.havedata)
-                        plot_time_series2(pars, data, beta, filename, traj2, plotdata=self.havedata)
-
-                        filename2 = filename + "_byp.pdf"
-                        pp = PdfPages(filename2)
-
-                        # trajectories are stored as list [nparticle][nbeta][ species ][ times ] not numpy array
-
-                        # here we assume beta=1
-                        for i in range(min(len(results.trajectories), 1000)):
-                            # print "printing traj", i
-                            if results.models[i] == mod:
-                                # if i < 500:
-                                arr = results.trajectories[i][0]
-                                nrow, ncol = numpy.shape(arr)
-                                # print nrow, ncol
-                                for ic in range(ncol):
-                                    plt.plot(data.timepoints, arr[:, ic], label='sp ' + repr(ic))
-
-                                plt.title("particle " + repr(i))
-
-                                # Add data points
-                                plt.gca().set_color_cycle(None)  # reset colour cycle
-                                if self.havedata:
-                                    plt.plot(data.timepoints, data.values, 'o')
-
-                                # Add legend
-                                legend = plt.legend(loc='upper left', shadow=False)
-                                # Set the fontsize
-                                for label in legend.get_texts():
-                                    label.set_fontsize('small')
-
-                                for label in legend.get_lines():
-                                    label.set_linewidth(0.5)
-
-                                pp.savefig()
-                                plt.close()
-
-                        pp.close()
-
-    # writes trajectories and parameters from simulations
-    def write_data_simulation(self, results, models, data):
-
-        # results abcsmc_results class
-        self.all_results.append(results)
-
-        nparticles = len(results.trajectories)
-        beta = len(results.trajectories[0])
-
-        # trajectories are stored as [nparticle][nbeta][ species ][ times ]
-        traj_file = open(self.folder + '/trajectories.txt', "a")
-        for i in range(nparticles):
-            for j in range(beta):
-                arr = results.trajectories[i][j]
-                nrow, ncol = numpy.shape(arr)
-                for ic in range(ncol):
-                    print >> traj_file, i, j, results.models[i], ic,
-                    for ir in range(nrow):
-                        print >> traj_file, arr[ir, ic],
-                    print >> traj_file, ""
-        traj_file.close()
-
-        # dump out all the parameters
-        param_file = open(self.folder + '/particles.txt', "a")
-        for i in range(nparticles):
-            print >> param_file, i, results.models[i],
-            for j in results.parameters[i]:
-                print >> param_file, j,
-            print >> param_file, ""
-        param_file.close()
-
-        # do timeseries plots
-        nmodels = len(models)
-
-        # separate timeseries for each model
-        for mod in range(nmodels):
-            # get the first n of the accepted particles for this model
-            pars = []
-            traj2 = []
-            n = nparticles
-            count = 0
-            for np in range(nparticles):
-                if results.models[np] == mod and count < n:
-                    pars.append(results.parameters[np])
-                    traj2.append(results.trajectories[np])
-
-                    count += 1
-
-            if len(pars) > 0:
-                filename = self.folder + '/' + models[mod].name + '_timeseries'
-                #  plotTimeSeries(models[mod],pars,data,beta,filename,plotdata=False)
-                plot_time_series2(pars, data, beta, filename, traj2, plotdata=False)
-
-    # create output folders
-    def create_output_folders(self, modelnames, num_outputs, pickling, simulation):
-
-        if simulation:
-            pickling = False
-
-        try:
-            os.mkdir(self.folder)
-            os.chdir(self.folder)
-        except OSError:
-            sys.exit("\nThe folder " + self.folder + " already exists!\n")
-
-        if not simulation:
-            for mod in modelnames:
-                try:
-                    os.mkdir('results_' + mod)
-                except OSError:
-                    sys.exit("\nThe folder " + self.folder + "/results_" + mod + " already exists!\n")
-
-        os.chdir('..')
-
-        if pickling:
-            try:
-                os.chdir(self.folder)
-                os.mkdir('copy')
-                os.chdir('..')
-            except OSError:
-                sys.exit("\nThe folder \'copy\' already exists!\n")
-
-            out_file = open(self.folder + '/copy/algorithm_parameter.dat', "w")
-            pickle.dump(num_outputs, out_file)
-            out_file.close()
-
-    # read the stored data
-    @staticmethod
-    def read_pickled(location):
-        # pickle numbers selected model of previous population
-        # pickle population of selected model of previous population pop_pickled[selected_model][n][vectpos]
-        # pickle weights of selected model of previous population weights_pickled[selected_model][n][vectpos]
-
-        try:
-            in_file = open(location + '/copy/model_last.dat', "r")
-            model_pickled = pickle.load(in_file)
-            in_file.close()
-        except IOError:
-            sys.exit("\nCan not find file \'model_last.dat\' in folder \'copy\'!\n")
-
-        try:
-            in_file = open(location + '/copy/weights_last.dat', "r")
-            weights_pickled = pickle.load(in_file)
-            in_file.close()
-        except IOError:
-            sys.exit("\nCan not find file \'weights_last.dat\' in folder \'copy\'!\n")
-
-        try:
-            in_file = open(location + '/copy/params_last.dat', "r")
-            parameters_pickled = pickle.load(in_file)
-            in_file.close()
-        except IOError:
-            sys.exit("\nCan not find file \'params_last.dat\' in folder \'copy\'!\n")
-
-        try:
-            in_file = open(location + '/copy/margins_last.dat', "r")
-            margins_pickled = pickle.load(in_file)
-            in_file.close()
-        except IOError:
-            sys.exit("\nCan not find file \'margins_last.dat\' in folder \'copy\'!\n")
-
-        try:
-            in_file = open(location + '/copy/kernels_last.dat', "r")
-            kernel = pickle.load(in_file)
-            in_file.close()
-        except IOError:
-            sys.exit("\nCan not find file \'kernels_last.dat\' in folder \'copy\'!\n")
-
-        # print "\n\n\n Reading previous population"
-        # print "model_pickled", model_pickled, "\n\n\n"
-        # print "weights_pickled", weights_pickled, "\n\n\n"
-        # print "parameters_pickled", parameters_pickled, "\n\n\n"
-        # print "margins_pickled", margins_pickled, "\n\n\n"
-
-        return [model_pickled, weights_pickled, parameters_pickled, margins_pickled, kernel]
-
-    # write the stored data
-    def write_pickled(self, nmodel, model_prev, weights_prev, parameters_prev, margins_prev, kernel):
-
-        out_file = open(self.folder + '/copy/model_last.dat', "w")
-        x = model_prev[:]
-        pickle.dump(x, out_file)
-        out_file.close()
-
-        out_file = open(self.folder + '/copy/weights_last.dat', "w")
-        x = weights_prev[:]
-        pickle.dump(x, out_file)
-        out_file.close()
-
-        out_file = open(self.folder + '/copy/params_last.dat', "w")
-        x = parameters_prev
-        pickle.dump(x, out_file)
-        out_file.close()
-
-        out_file = open(self.folder + '/copy/margins_last.dat', "w")
-        x = margins_prev[:]
-        pickle.dump(x, out_file)
-        out_file.close()
-
-        out_file = open(self.folder + '/copy/kernels_last.dat', "w")
-        x = []
-        for mod in range(nmodel):
-            x.append(kernel[mod])
-        pickle.dump(x, out_file)
-        out_file.close()
-        ###
+import os, sys, pickle
+import numpy
+
+from getResults import get_all_scatter_plots
+from getResults import get_all_histograms
+from getResults import plot_time_series2
+from getResults import get_model_distribution
+from getResults import plot_data
+
+from matplotlib.backends.backend_pdf import PdfPages
+import matplotlib.pyplot as plt
+from PriorType import PriorType
+from PhaseTimer import PhaseTimer
+
+
+class PopulationSummary:
+    """Compact record of a population in InputOutput.all_results: the particles, weights, model marginals, epsilon
+    and acceptance rate, without the trajectories and distances, which are in the PopulationN.npz file."""
+
+    def __init__(self, results):
+        self.naccepted = results.naccepted
+        self.sampled = results.sampled
+        self.rate = results.rate
+        self.margins = results.margins
+        self.models = results.models
+        self.weights = results.weights
+        self.parameters = results.parameters
+        self.epsilon = results.epsilon
+
+
+class InputOutput:
+    def __init__(self, folder, restart, diagnostic, plot_data_series, havedata=True, text_output=False,
+                 compress=False, full_results=1, plot_every=1, scatter_window=12):
+        self.folder = folder
+        self.diagnostic = diagnostic
+        self.plotDataSeries = plot_data_series
+        self.havedata = havedata
+
+        # the particles of each population are written to one binary file, and also to text files if text_output is
+        # set; the binary files are compressed with zlib if compress is set
+        self.text_output = text_output
+        self.compress = compress
+
+        # times the writing of the diagnostics; Abcsmc replaces it with its own timer when timing is enabled
+        self.timer = PhaseTimer()
+
+        # Hold all data here for plotting purposes. Only the last full_results populations are held in full; the
+        # older ones are replaced by a PopulationSummary once they are written, so that memory does not grow with the
+        # trajectories of every population
+        self.all_results = []
+        self.full_results = full_results
+
+        # the diagnostics are plotted for every plot_every-th population, and for the last one (or only for the last one
+        # if plot_every is 0); the parameters and weights of each model, which are overlaid across populations in the
+        # scatter plots, are extracted once per population into plot_particles. The scatter plots overlay only the last
+        # scatter_window populations (or all of them if scatter_window is 0), so that the time taken to plot a
+        # population does not grow with the number of populations, and the older entries of plot_particles are dropped
+        self.plot_every = plot_every
+        self.scatter_window = scatter_window
+        self.plot_particles = []
+        self.pending_diagnostics = None
+
+        if restart:
+            self.folder += '_restart'
+
+    def plot_data(self, data):
+        if self.havedata:
+            plot_data(data, self.folder + '/_data')
+
+    # write rates, model distribution and the particles of a population, and do the diagnostics
+    def write_data(self, population, results, timing, models, data):
+
+        # results abcsmc_results class
+        self.all_results.append(results)
+
+        beta = results.distances.shape[1]
+
+        rate_file = open(self.folder + '/rates.txt', "a")
+        print >> rate_file, population + 1, results.epsilon, results.sampled, results.rate, round(timing, 2)
+        rate_file.close()
+
+        if len(results.margins) > 1:
+            model_file = open(self.folder + '/ModelDistribution.txt', "a")
+            for m in results.margins:
+                print >> model_file, m,
+            print >> model_file, ""
+            model_file.close()
+
+        self.write_population_arrays(population, results, models)
+
+        # this runs in the thread of the OutputQueue, so it must not change the working directory of the process
+        nmodels = len(models)
+        for mod in range(nmodels):
+            try:
+                os.mkdir(os.path.join(self.folder, 'results_' + models[mod].name, 'Population_' + repr(population + 1)))
+            except OSError:
+                sys.exit("\nCan not create the folder Population_" + repr(population + 1) + "!\n")
+
+        # count number of particles in each model so that we can skip empty models
+        counts = numpy.zeros([nmodels])
+        nparticles = len(results.weights)
+        for np in range(nparticles):
+            counts[results.models[np]] += 1
+
+        if self.text_output:
+            self.write_population_text(population, results, counts, models)
+
+        # do diagnostics such as scatter plots, histograms and model distribution
+        if self.diagnostic:
+            self.plot_particles.append(self.model_particles(results, models))
+            if self.scatter_window > 0 and len(self.plot_particles) > self.scatter_window:
+                self.plot_particles[-self.scatter_window - 1] = None
+
+        if self.plot_every > 0 and (population + 1) % self.plot_every == 0:
+            with self.timer.phase('write_diagnostics'):
+                self.write_diagnostics(population, results, counts, models, data, beta)
+            self.pending_diagnostics = None
+        else:
+            self.pending_diagnostics = (population, results, counts, models, data, beta)
+
+        self.compact_results()
+
+    # plot the diagnostics of the last population, if they were skipped because of plot_every
+    def finish_diagnostics(self):
+        if self.pending_diagnostics is not None:
+            with self.timer.phase('write_diagnostics'):
+                self.write_diagnostics(*self.pending_diagnostics)
+            self.pending_diagnostics = None
+
+    # values of the non-constant parameters, and weights, of the particles of each model of a population, as the lists
+    # [model][parameter] of arrays used by the scatter plots and histograms
+    @staticmethod
+    def model_particles(results, models):
+        population_mod = []
+        weights_mod = []
+        for mod in range(len(models)):
+            index = [param for param in range(models[mod].nparameters)
+                     if not (models[mod].prior[param].type == PriorType.constant)]
+            particles = numpy.flatnonzero(results.models == mod)
+            values = results.parameters[particles][:, index]
+            population_mod.append([values[:, k] for k in range(len(index))])
+            weights_mod.append([results.weights[particles]] * len(index))
+
+        return population_mod, weights_mod
+
+    # replace the results of the populations before the last full_results by their summaries
+    def compact_results(self):
+        for i in range(max(len(self.all_results) - self.full_results, 0)):
+            if not isinstance(self.all_results[i], PopulationSummary):
+                self.all_results[i] = PopulationSummary(self.all_results[i])
+
+    # write the parameters, weights, model indexes, distances and trajectories of a population to
+    # PopulationN.npz, read by read_population_arrays
+    def write_population_arrays(self, population, results, models):
+        arrays = {'model_names': numpy.array([model.name for model in models]),
+                  'parameters': results.parameters,
+                  'weights': results.weights,
+                  'models': results.models,
+                  'distances': results.distances,
+                  'margins': results.margins,
+                  'epsilon': numpy.asarray(results.epsilon, dtype=float),
+                  'sampled': results.sampled,
+                  'rate': results.rate}
+
+        # trajectories are stored as an array [nparticle][nbeta][ times ][ species ], or None if they were not kept
+        if results.trajectories is not None:
+            arrays['trajectories'] = results.trajectories
+            arrays['trajectory_widths'] = numpy.asarray(results.trajectory_widths)
+
+        filename = self.folder + '/Population' + repr(population + 1) + '.npz'
+        if self.compress:
+            numpy.savez_compressed(filename, **arrays)
+        else:
+            numpy.savez(filename, **arrays)
+
+    # read the arrays of a population written by write_population_arrays, as a dictionary
+    @staticmethod
+    def read_population_arrays(location, population):
+        try:
+            in_file = numpy.load(location + '/Population' + repr(population) + '.npz')
+        except IOError:
+            sys.exit("\nCan not find file \'Population" + repr(population) + ".npz\' in folder " + location + "!\n")
+
+        arrays = dict((name, in_file[name]) for name in in_file.files)
+        in_file.close()
+        return arrays
+
+    # write the distances, trajectories, parameters and weights of a population to text files
+    def write_population_text(self, population, results, counts, models):
+        nmodels = len(models)
+
+        # distances are stored as an array [nparticle][nbeta][d1, d2, d3 .... ]
+        distance_file = open(self.folder + '/distance_Population' + repr(population + 1) + '.txt', "a")
+        for i in range(len(results.distances)):
+            for j in range(len(results.distances[i])):
+                print >> distance_file, i + 1, j, results.distances[i][j], results.models[i]
+        distance_file.close()
+
+        # trajectories are stored as an array [nparticle][nbeta][ times ][ species ], or None if they were not kept
+        if results.trajectories is not None:
+            traj_file = open(self.folder + '/traj_Population' + repr(population + 1) + '.txt', "a")
+            self.write_trajectories(traj_file, results)
+            traj_file.close()
+
+        # print out particles and weights if there are particles
+        for mod in range(nmodels):
+            if counts[mod] > 0:
+                weight_file = open(self.folder + '/results_' + models[mod].name + '/Population_' + repr(
+                    population + 1) + '/data_Weights' + repr(population + 1) + ".txt", "w")
+                param_file = open(self.folder + '/results_' + models[mod].name + '/Population_' + repr(
+                    population + 1) + '/data_Population' + repr(population + 1) + ".txt", "w")
+
+                nparticles = len(results.weights)
+                for g in range(nparticles):
+                    if results.models[g] == mod:
+                        for k in range(models[mod].nparameters):
+                            print >> param_file, results.parameters[g][k],
+                        print >> param_file, ""
+
+                        print >> weight_file, results.weights[g]
+
+                weight_file.close()
+                param_file.close()
+
+    # scatter plots, histograms, model distribution and time series of the populations so far
+    def write_diagnostics(self, population, results, counts, models, data, beta):
+        nmodels = len(models)
+        npop = len(self.all_results)
+        if self.diagnostic:
+
+            if nmodels > 1:
+                # create matrix [npop][nmodel]
+                m = numpy.zeros([len(self.all_results), nmodels])
+                r = []
+                e = []
+                for i in range(len(self.all_results)):
+                    m[i, :] = self.all_results[i].margins
+                    r.append(self.all_results[i].rate)
+                    e.append(self.all_results[i].epsilon)
+
+                get_model_distribution(m, e, r, plot_name=self.folder + '/ModelDistribution')
+
+            # for scatter plots and histograms we require container [model][population][parameter][values]
+            population_mod = []
+            weights_mod = []
+
+            for mod in range(nmodels):
+                population_mod.append([])
+                weights_mod.append([])
+
+                if counts[mod] > 0:
+                    plot_name = self.folder + '/results_' + models[mod].name + '/Population_' + repr(
+                        population + 1) + '/ScatterPlots_Population' + repr(population + 1)
+                    plot_name2 = self.folder + '/results_' + models[mod].name + '/Population_' + repr(
+                        population + 1) + '/weightedHistograms_Population' + repr(population + 1)
+
+                    # the populations outside the window are not plotted, and their particles have been dropped
+                    for eps in range(npop):
+                        if self.plot_particles[eps] is None:
+                            population_mod[mod].append(None)
+                            weights_mod[mod].append(None)
+                        else:
+                            population_mod[mod].append(self.plot_particles[eps][0][mod])
+                            weights_mod[mod].append(self.plot_particles[eps][1][mod])
+
+                    get_all_scatter_plots(population_mod, weights_mod,
+                                          populations=scatter_populations(population + 1, self.scatter_window),
+                                          plot_name=plot_name, model=mod + 1)
+                    get_all_histograms(population_mod, weights_mod, population=population + 1, plot_name=plot_name2,
+                                       model=mod + 1)
+
+            if self.plotDataSeries and results.trajectories is not None:
+                for mod in range(nmodels):
+                    # get the first n of the accepted particles for this model
+                    pars = []
+                    traj2 = []
+                    n = 10
+                    count = 0
+                    nparticles = len(results.weights)
+                    for np in range(nparticles):
+                        if results.models[np] == mod and count < n:
+                            pars.append(results.parameters[np][:models[mod].nparameters])
+                            traj2.append(results.trajectories[np, :, :, :results.trajectory_widths[mod]])
+                            count += 1
+
+                    if len(pars) > 0:
+                        filename = self.folder + '/results_' + models[mod].name + '/Population_' + repr(
+                            npop) + '/Timeseries_Population' + repr(npop)
+                        #  plotTimeSeries(models[mod],pars,data,beta,filename,plotdata=self.havedata)
+                        plot_time_series2(pars, data, beta, filename, traj2, plotdata=self.havedata)
+
+                        filename2 = filename + "_byp.pdf"
+                        pp = PdfPages(filename2)
+
+                        # trajectories are stored as list [nparticle][nbeta][ species ][ times ] not numpy array
+
+                        # here we assume beta=1
+                        for i in range(min(len(results.trajectories), 1000)):
+                            # print "printing traj", i
+                            if results.models[i] == mod:
+                                # if i < 500:
+                                arr = results.trajectories[i, 0, :, :results.trajectory_widths[mod]]
+                                nrow, ncol = numpy.shape(arr)
+                                # print nrow, ncol
+                                for ic in range(ncol):
+                                    plt.plot(data.timepoints, arr[:, ic], label='sp ' + repr(ic))
+
+                                plt.title("particle " + repr(i))
+
+                                # Add data points
+                                plt.gca().set_color_cycle(None)  # reset colour cycle
+                                if self.havedata:
+                                    plt.plot(data.timepoints, data.values, 'o')
+
+                                # Add legend
+                                legend = plt.legend(loc='upper left', shadow=False)
+                                # Set the fontsize
+                                for label in legend.get_texts():
+                                    label.set_fontsize('small')
+
+                                for label in legend.get_lines():
+                                    label.set_linewidth(0.5)
+
+                                pp.savefig()
+                                plt.close()
+
+                        pp.close()
+
+    # writes trajectories and parameters from simulations
+    def write_data_simulation(self, results, models, data):
+
+        # results abcsmc_results class
+        self.all_results.append(results)
+
+        nparticles = len(results.distances)
+        beta = results.distances.shape[1]
+
+        # trajectories are stored as an array [nparticle][nbeta][ times ][ species ], or None if they were not kept
+        if results.trajectories is not None:
+            traj_file = open(self.folder + '/trajectories.txt', "a")
+            self.write_trajectories(traj_file, results)
+            traj_file.close()
+
+        # dump out all the parameters
+        param_file = open(self.folder + '/particles.txt', "a")
+        for i in range(nparticles):
+            print >> param_file, i, results.models[i],
+            for j in results.parameters[i][:models[results.models[i]].nparameters]:
+                print >> param_file, j,
+            print >> param_file, ""
+        param_file.close()
+
+        # do timeseries plots
+        nmodels = len(models)
+        if results.trajectories is None:
+            return
+
+        # separate timeseries for each model
+        for mod in range(nmodels):
+            # get the first n of the accepted particles for this model
+            pars = []
+            traj2 = []
+            n = nparticles
+            count = 0
+            for np in range(nparticles):
+                if results.models[np] == mod and count < n:
+                    pars.append(results.parameters[np][:models[mod].nparameters])
+                    traj2.append(results.trajectories[np, :, :, :results.trajectory_widths[mod]])
+
+                    count += 1
+
+            if len(pars) > 0:
+                filename = self.folder + '/' + models[mod].name + '_timeseries'
+                #  plotTimeSeries(models[mod],pars,data,beta,filename,plotdata=False)
+                plot_time_series2(pars, data, beta, filename, traj2, plotdata=False)
+
+    # write one line per particle, beta repeat and fitted species, with the trajectory over time
+    @staticmethod
+    def write_trajectories(traj_file, results):
+        nparticles, beta = results.trajectories.shape[:2]
+        for i in range(nparticles):
+            ncol = results.trajectory_widths[results.models[i]]
+            for j in range(beta):
+                arr = results.trajectories[i, j]
+                for ic in range(ncol):
+                    print >> traj_file, i, j, results.models[i], ic,
+                    for value in arr[:, ic]:
+                        print >> traj_file, value,
+                    print >> traj_file, ""
+
+    # create output folders
+    def create_output_folders(self, modelnames, num_outputs, pickling, simulation):
+
+        if simulation:
+            pickling = False
+
+        try:
+            os.mkdir(self.folder)
+        except OSError:
+            sys.exit("\nThe folder " + self.folder + " already exists!\n")
+
+        if not simulation:
+            for mod in modelnames:
+                try:
+                    os.mkdir(os.path.join(self.folder, 'results_' + mod))
+                except OSError:
+                    sys.exit("\nThe folder " + self.folder + "/results_" + mod + " already exists!\n")
+
+        if pickling:
+            try:
+                os.mkdir(os.path.join(self.folder, 'copy'))
+            except OSError:
+                sys.exit("\nThe folder \'copy\' already exists!\n")
+
+            out_file = open(self.folder + '/copy/algorithm_parameter.dat', "w")
+            pickle.dump(num_outputs, out_file)
+            out_file.close()
+
+    # read the stored data
+    @staticmethod
+    def read_pickled(location):
+        # pickle numbers selected model of previous population
+        # pickle population of selected model of previous population pop_pickled[selected_model][n][vectpos]
+        # pickle weights of selected model of previous population weights_pickled[selected_model][n][vectpos]
+
+        try:
+            in_file = open(location + '/copy/model_last.dat', "r")
+            model_pickled = pickle.load(in_file)
+            in_file.close()
+        except IOError:
+            sys.exit("\nCan not find file \'model_last.dat\' in folder \'copy\'!\n")
+
+        try:
+            in_file = open(location + '/copy/weights_last.dat', "r")
+            weights_pickled = pickle.load(in_file)
+            in_file.close()
+        except IOError:
+            sys.exit("\nCan not find file \'weights_last.dat\' in folder \'copy\'!\n")
+
+        try:
+            in_file = open(location + '/copy/params_last.dat', "r")
+            parameters_pickled = pickle.load(in_file)
+            in_file.close()
+        except IOError:
+            sys.exit("\nCan not find file \'params_last.dat\' in folder \'copy\'!\n")
+
+        try:
+            in_file = open(location + '/copy/margins_last.dat', "r")
+            margins_pickled = pickle.load(in_file)
+            in_file.close()
+        except IOError:
+            sys.exit("\nCan not find file \'margins_last.dat\' in folder \'copy\'!\n")
+
+        try:
+            in_file = open(location + '/copy/kernels_last.dat', "r")
+            kernel = pickle.load(in_file)
+            in_file.close()
+        except IOError:
+            sys.exit("\nCan not find file \'kernels_last.dat\' in folder \'copy\'!\n")
+
+        # print "\n\n\n Reading previous population"
+        # print "model_pickled", model_pickled, "\n\n\n"
+        # print "weights_pickled", weights_pickled, "\n\n\n"
+        # print "parameters_pickled", parameters_pickled, "\n\n\n"
+        # print "margins_pickled", margins_pickled, "\n\n\n"
+
+        return [model_pickled, weights_pickled, parameters_pickled, margins_pickled, kernel]
+
+    # write the stored data
+    def write_pickled(self, nmodel, model_prev, weights_prev, parameters_prev, margins_prev, kernel):
+
+        out_file = open(self.folder + '/copy/model_last.dat', "w")
+        x = model_prev[:]
+        pickle.dump(x, out_file)
+        out_file.close()
+
+        out_file = open(self.folder + '/copy/weights_last.dat', "w")
+        x = weights_prev[:]
+        pickle.dump(x, out_file)
+        out_file.close()
+
+        out_file = open(self.folder + '/copy/params_last.dat', "w")
+        x = parameters_prev
+        pickle.dump(x, out_file)
+        out_file.close()
+
+        out_file = open(self.folder + '/copy/margins_last.dat', "w")
+        x = margins_prev[:]
+        pickle.dump(x, out_file)
+        out_file.close()
+
+        out_file = open(self.folder + '/copy/kernels_last.dat', "w")
+        x = []
+        for mod in range(nmodel):
+            x.append(kernel[mod])
+        pickle.dump(x, out_file)
+        out_file.close()
+        ###
+
+
+def scatter_populations(population, window):
+    """
+    Return the numbers of the populations overlaid in the scatter plots of population: the last window populations up
+    to it, or all of them if window is 0.
+    """
+    first = 1
+    if window > 0:
+        first = max(1, population - window + 1)
+    return numpy.arange(first, population + 1)
@@ -1,15 +1,23 @@
 import numpy
 from numpy import random as rnd
-from scipy.stats import norm
 from abcsysbio import statistics
 from KernelType import KernelType
-from PriorType import PriorType
+from CompiledPrior import compile_prior
+from Covariance import Covariance
+from KernelNormalizer import KernelNormalizer
+from LocalCovariances import LocalCovariances
 import sys
 
+default_normalizer = KernelNormalizer()
+
+# maximum number of draws of a truncated multivariate normal perturbation from the same ancestor; the particles still
+# outside the support of the prior are then reported as such, and perturb_particles is called again with new ancestors
+max_truncated_draws = 1000
+
 # kernel is a list of length 3 such that :
 # kernel[0] contains the index of the non-constant paramameters
 # kernel[1] contains the informations required to build the kernels in function getKernels, given in input file
-# kernel[2] contains the kernel (list, matrix or dictionnary) once it has been built
+# kernel[2] contains the kernel (list, Covariance or LocalCovariances) once it has been built
 
 
 # populations, weights refers to particles and weights from previous population for one model
@@ -34,20 +42,17 @@ def get_kernel(kernel_type, kernel, population, weights):
     # (2) component-wise normal kernel: the variance.
 
     # (3) multi-variate normal kernel whose covariance is based on all the previous population: kernel[2] is the
-    # covariance matrix of the multivariate normal kernel of size len(kernel[0])*len(kernel[0])
+    # Covariance object holding the covariance matrix of the multivariate normal kernel of size
+    # len(kernel[0])*len(kernel[0]) and its Cholesky factor
 
     # (4) multi-variate normal kernel whose covariance is based on the K nearest neighbours of the particle:
-    #  kernel[2] is a dictionnary with pop_size keys. Each key is string(p) where p is a particle (length nparam)
-    # of the previous population. The element of the dictionnary for a given key is a covaraince matrix of size
-    # len(kernel[0])*len(kernel[0])
+    #  kernel[2] is a LocalCovariances object holding pop_size covariance matrices of size
+    #  len(kernel[0])*len(kernel[0]), in the order of the particles of the previous population.
 
-    # multi-variate normal kernel whose covariance is the OCM
-    # kernel[2] is a dictionnary with pop_size keys. Each key is string(p) where p is a particle (with nparam dimension)
-    # of the previous population. The element of the dictionnary for a given key is a covaraince matrix of size
-    #  len(kernel[0])*len(kernel[0])
+    # (5) multi-variate normal kernel whose covariance is the OCM
+    #  kernel[2] is a LocalCovariances object, as for (4)
 
     pop_size = population.shape[0]
-    npar = population.shape[1]
 
     if pop_size == 1:
         print "WARNING: getKernel : only one particle so adaptation is not possible"
@@ -82,161 +87,125 @@ def get_kernel(kernel_type, kernel, population, weights):
             for param in kernel[0]:
                 pop.append(population[:, param])
             cov = statistics.compute_cov(pop, weights)
-        kernel[2] = 2 * cov
+        kernel[2] = Covariance(2 * cov)
 
     if kernel_type == KernelType.multivariate_normal_nn:
         k = int(kernel[1])
-        d = {}
-        pop = list()
         if pop_size == 1:
-            pop_cur = list()
-            for param in range(npar):
-                pop_cur.append(population[0, param])
-                d[str(pop_cur)] = 2 * numpy.eye(len(kernel[0]))
+            covariances = 2 * numpy.eye(len(kernel[0]))[numpy.newaxis]
         else:
             # to compute the neighbours, restrain the population to the non constant parameters
-            for param in kernel[0]:
-                pop.append(population[:, param])
-            for n in range(pop_size):
-
-                # compute the index of the neighbours
-                kset = statistics.k_nearest_neighbours(n, pop, k)
-
-                # save the coordinate of the particle (with all components)
-                pop_cur = list()
-                for param in range(npar):
-                    pop_cur.append(population[n, param])
-
-                # construct the list of the neighbours and weights given kset (restrained to non-constant components)
-                subpop = list()
-                subwei = list()
-                for param in range(len(pop)):
-                    subpop.append([])
-                    for j in range(len(kset)):
-                        subpop[param].append(pop[param][kset[j]])
-                for j in range(len(kset)):
-                    subwei.append(weights[kset[j]])
-
-                # compute the covariance and write it into the dictionnary
-                d[str(pop_cur)] = 2 * statistics.compute_cov(subpop, subwei)
-        kernel[2] = d
+            pop = population[:, kernel[0]]
+            neighbours = statistics.k_nearest_neighbours_all(pop, k)
+            covariances = 2 * statistics.weighted_covariances(pop, weights, neighbours)
+        kernel[2] = LocalCovariances(covariances, population, kernel[0])
 
     if kernel_type == KernelType.multivariate_normal_ocm:
-        pop = list()
-        d = {}
         if pop_size == 1:
-            pop_cur = list()
-            for param in range(npar):
-                pop_cur.append(population[0, param])
-                d[str(pop_cur)] = 2 * numpy.eye(len(kernel[0]))
+            covariances = 2 * numpy.eye(len(kernel[0]))[numpy.newaxis]
         else:
-            for param in kernel[0]:
-                pop.append(population[:, param])
-            for n in range(pop_size):
-                pop_cur = list()
-                for param in range(npar):
-                    pop_cur.append(population[n, param])
-                d[str(pop_cur)] = statistics.compute_optcovmat(pop, weights, pop_cur)
-        kernel[2] = d
+            covariances = statistics.optimal_covariances(population[:, kernel[0]], weights)
+        kernel[2] = LocalCovariances(covariances, population, kernel[0])
 
     return kernel
 
 
 # Here params refers to one particle
 # The function changes params in place and returns the probability (which may be zero)
-def perturb_particle(params, priors, kernel, kernel_type, special_cases):
-    np = len(priors)
-
-    if special_cases == 1:
-        # this is the case where kernel is uniform and all priors are uniform
-        ind = 0
-        for n in kernel[0]:
-            lflag = (params[n] + kernel[2][ind][0]) < priors[n].lower_bound
-            uflag = (params[n] + kernel[2][ind][1]) > priors[n].upper_bound
-
-            lower = kernel[2][ind][0]
-            upper = kernel[2][ind][1]
-            if lflag:
-                lower = -(params[n] - priors[n].lower_bound)
-            if uflag:
-                upper = priors[n].upper_bound - params[n]
-
-            if lflag is False and uflag is False:
-                # proceed as normal
-                delta = rnd.uniform(low=kernel[2][ind][0], high=kernel[2][ind][1])
-            else:
-                # decide if the particle is to be perturbed positively or negatively
-                positive = rnd.uniform(0, 1) > abs(lower) / (abs(lower) + upper)
+# ancestor is the position of the particle among the particles of its model in the previous population, which
+# addresses the covariance of the local kernels; if it is not given, it is found from params
+def perturb_particle(params, priors, kernel, kernel_type, special_cases, ancestor=None):
+    block = numpy.array([params], dtype=float)
+    inside = perturb_particles(block, priors, kernel, kernel_type, special_cases,
+                               None if ancestor is None else [ancestor])
+    params[:] = list(block[0])
+
+    # this is not the actual value of the pdf but we only require it to be non zero inside the support
+    if inside[0]:
+        return 1.0
+    else:
+        return 0.0
 
-                if positive:
-                    # theta = theta + U(0, min(prior,kernel) )
-                    delta = rnd.uniform(low=0, high=upper)
-                else:
-                    # theta = theta + U( max(prior,kernel), 0 )
-                    delta = rnd.uniform(low=lower, high=0)
 
-            params[n] = params[n] + delta
-            ind += 1
+# Here params refers to a block of particles of the same model
+def perturb_particles(params, priors, kernel, kernel_type, special_cases, ancestors=None):
+    """
+    Perturb a block of particles of one model in place, with the parameter kernel truncated to the support of the prior.
 
-        # this is not the actual value of the pdf but we only require it to be non zero
-        return 1.0
+    The truncated kernels are sampled directly: the component-wise kernels by inverting the cumulative distribution of
+    each parameter inside its bounds, and the multivariate normal kernels by drawing again, from the same particle,
+    only the perturbations which fall outside the support. The density of a truncated kernel is the density of the
+    kernel divided by its mass inside the support, which is the auxilliary information of get_auxilliary_info.
 
-    else:
-        if kernel_type == KernelType.component_wise_uniform:
-            ind = 0
-            # n refers to the index of the parameter (integer between 0 and np-1)
-            # ind is an integer between 0 and len(kernel[0])-1 which enables to determine the kernel to use
-            for n in kernel[0]:
-                params[n] = params[n] + rnd.uniform(low=kernel[2][ind][0], high=kernel[2][ind][1])
-                ind += 1
-
-        if kernel_type == KernelType.component_wise_normal:
-            ind = 0
-            # n refers to the index of the parameter (integer between 0 and np-1)
-            # ind is an integer between 0 and len(kernel[0])-1 which enables to determine the kernel to use
-            for n in kernel[0]:
-                params[n] = rnd.normal(params[n], numpy.sqrt(kernel[2][ind]))
-                ind += 1
+    Parameters
+    ----------
+    params : ndarray of particles, shape (num_particles, nparameters), modified in place
+    priors : list of priors for the model
+    kernel : kernel list for the model
+    kernel_type : integer representing the type of kernel
+    special_cases : 1 if the kernel is uniform and all priors are uniform, 0 otherwise (the uniform kernel is truncated
+        in every case, so this is only used by custom perturbation functions)
+    ancestors : positions of the particles among the particles of the model in the previous population, which address
+        the covariances of the local kernels; if None, they are found from params
+
+    Returns
+    -------
+    a boolean array, True for the perturbed particles which lie inside the support of the prior
 
+    """
+    del special_cases
+    num_particles = params.shape[0]
+    this_prior = compile_prior(priors)
+    ind = kernel[0]
+    lower = this_prior.lower[ind]
+    upper = this_prior.upper[ind]
+
+    if kernel_type == KernelType.component_wise_uniform:
+        # ind refers to the index of the parameter (integer between 0 and np-1)
+        # kernel_index is an integer between 0 and len(kernel[0])-1 which enables to determine the kernel to use
+        for kernel_index in range(len(ind)):
+            x = params[:, ind[kernel_index]]
+            low = numpy.maximum(x + kernel[2][kernel_index][0], lower[kernel_index])
+            high = numpy.minimum(x + kernel[2][kernel_index][1], upper[kernel_index])
+            params[:, ind[kernel_index]] = rnd.uniform(low=low, high=high)
+
+    if kernel_type == KernelType.component_wise_normal:
+        for kernel_index in range(len(ind)):
+            params[:, ind[kernel_index]] = statistics.sample_truncated_normal(
+                params[:, ind[kernel_index]], numpy.sqrt(kernel[2][kernel_index]), lower[kernel_index],
+                upper[kernel_index])
+
+    if kernel_type in [KernelType.multivariate_normal, KernelType.multivariate_normal_nn,
+                       KernelType.multivariate_normal_ocm]:
         if kernel_type == KernelType.multivariate_normal:
-            mean = list()
-            for n in kernel[0]:
-                mean.append(params[n])
-            tmp = statistics.mvnd_gen(mean, kernel[2])
-            ind = 0
-            for n in kernel[0]:
-                params[n] = tmp[ind]
-                ind += 1
-
-        if kernel_type == KernelType.multivariate_normal_nn or kernel_type == KernelType.multivariate_normal_ocm:
-            mean = list()
-            for n in kernel[0]:
-                mean.append(params[n])
-            d = kernel[2]
-            tmp = statistics.mvnd_gen(mean, d[str(params)])
-            ind = 0
-            for n in kernel[0]:
-                params[n] = tmp[ind]
-                ind += 1
-
-        # compute the likelihood
-        prior_prob = 1
-        for n in range(np):
-            x = 1.0
-            # if priors[n][0]==1:
-            #    x=statistics.getPdfGauss(priors[n][1], numpy.sqrt(priors[n][2]), params[n])
-            # if we do not care about the value of prior_prob, then here: x=1.0
-
-            if priors[n].type == PriorType.uniform:
-                x = statistics.get_pdf_uniform(priors[n].lower_bound, priors[n].upper_bound, params[n])
-
-                # if priors[n][0]==3:
-                #    x=statistics.getPdfLognormal(priors[n][1],priors[n][2],params[n])
-                # if we do not care about the value of prior_prob, then here: x=1.0 if params[n]>=0 and 0 otherwise
-
-            prior_prob = prior_prob * x
-
-        return prior_prob
+            cholesky = kernel[2].cholesky[numpy.newaxis]
+            ancestors = numpy.zeros(num_particles, dtype=int)
+        else:
+            cholesky = kernel[2].cholesky
+            if ancestors is None:
+                ancestors = [kernel[2].find(p) for p in params]
+            ancestors = numpy.asarray(ancestors)
+
+        mean = params[:, ind]
+        pending = numpy.arange(num_particles)
+        for draw in range(max_truncated_draws):
+            if len(pending) == 0:
+                break
+            z = rnd.normal(size=(len(pending), len(ind)))
+            proposal = mean[pending] + numpy.einsum('nij,nj->ni', cholesky[ancestors[pending]], z)
+            inside = numpy.all((proposal >= lower) & (proposal <= upper), axis=1)
+            params[numpy.ix_(pending[inside], ind)] = proposal[inside]
+            pending = pending[~inside]
+
+        # the kernels of these ancestors put almost no mass inside the support, so they are not perturbed, and are
+        # reported as outside the support
+        if len(pending) > 0:
+            inside = this_prior.in_support(params[:, :len(priors)])
+            inside[pending] = False
+            return inside
+
+    # check that the perturbed particles lie inside the support of the prior
+    return this_prior.in_support(params[:, :len(priors)])
 
 
 # Here params and params0 refer to one particle each.
@@ -250,6 +219,7 @@ def get_parameter_kernel_pdf(params, params0, priors, kernel, auxilliary, kernel
         for param_index in kernel[0]:
             kern = statistics.get_pdf_uniform(params0[param_index] + kernel[2][kernel_index][0],
                                               params0[param_index] + kernel[2][kernel_index][1], params[param_index])
+            kern = kern / auxilliary[param_index]
             prob = prob * kern
             kernel_index += 1
         return prob
@@ -267,33 +237,120 @@ def get_parameter_kernel_pdf(params, params0, priors, kernel, auxilliary, kernel
         return prob
 
     elif kernel_type == KernelType.multivariate_normal:
-        p0 = list()
-        p = list()
-        for param_index in kernel[0]:
-            p0.append(params0[param_index])
-            p.append(params[param_index])
-        kern = statistics.get_pdf_multinormal(p0, kernel[2], p)
+        ind = kernel[0]
+        kern = numpy.exp(kernel[2].log_pdf(numpy.asarray(params, dtype=float)[ind],
+                                           numpy.asarray(params0, dtype=float)[ind]))
         kern = kern / auxilliary
         return kern
 
     elif kernel_type == KernelType.multivariate_normal_nn or kernel_type == KernelType.multivariate_normal_ocm:
         p0 = list()
         p = list()
-        d = kernel[2]
+        covariances = kernel[2]
         for param_index in kernel[0]:
             p0.append(params0[param_index])
             p.append(params[param_index])
-        kern = statistics.get_pdf_multinormal(p0, d[str(params0)], p)
+        kern = statistics.get_pdf_multinormal(p0, covariances.covariances[covariances.find(params0)], p)
         kern = kern / auxilliary
         return kern
     else:
         sys.exit("Invalid kernel encountered by get_parameter_kernel_pdf: " + repr(kernel_type))
 
 
+# Here params and params0 refer to blocks of particles of the same model.
+# auxilliary is the list of auxilliary information for the particles in params0
+def get_parameter_kernel_pdf_matrix(params, params0, priors, kernel, auxilliary, kernel_type, ancestors=None):
+    """
+    Evaluate the parameter kernel density for every pair of new and old particles of one model at once.
+
+    Entry [i, j] of the result is equal to get_parameter_kernel_pdf(params[i], params0[j], priors, kernel,
+    auxilliary[j], kernel_type). See get_parameter_kernel_log_pdf_matrix for the parameters.
+
+    Returns
+    -------
+    ndarray of kernel densities, shape (num_new, num_old)
+
+    """
+    return numpy.exp(get_parameter_kernel_log_pdf_matrix(params, params0, priors, kernel, auxilliary, kernel_type,
+                                                         ancestors))
+
+
+def get_parameter_kernel_log_pdf_matrix(params, params0, priors, kernel, auxilliary, kernel_type, ancestors=None):
+    """
+    Evaluate the logarithm of the parameter kernel density for every pair of new and old particles of one model at
+    once. The densities are never formed, so that they cannot underflow.
+
+    Parameters
+    ----------
+    params : ndarray of perturbed particles, shape (num_new, num_parameters)
+    params0 : ndarray of particles from the previous population, shape (num_old, num_parameters)
+    priors : list of priors for the model (unused)
+    kernel : kernel list for the model
+    auxilliary : list of auxilliary information, one entry per particle in params0
+    kernel_type : integer representing the type of kernel
+    ancestors : positions of the particles of params0 among the particles of the model in the previous population,
+        which address the covariances of the local kernels; if None, they are found from params0
+
+    Returns
+    -------
+    ndarray of log kernel densities, shape (num_new, num_old); -inf where the density is zero
+
+    """
+
+    del priors  # argument kept, so that the signature matches get_parameter_kernel_pdf
+    params = numpy.asarray(params, dtype=float)
+    params0 = numpy.asarray(params0, dtype=float)
+    log_prob = numpy.zeros([params.shape[0], params0.shape[0]])
+
+    if kernel_type == KernelType.component_wise_uniform:
+        log_aux = numpy.log(numpy.asarray(auxilliary, dtype=float))
+        kernel_index = 0
+        for param_index in kernel[0]:
+            lower = params0[numpy.newaxis, :, param_index] + kernel[2][kernel_index][0]
+            upper = params0[numpy.newaxis, :, param_index] + kernel[2][kernel_index][1]
+            x = params[:, param_index, numpy.newaxis]
+            kern = numpy.where((x > upper) | (x < lower), -numpy.inf, -numpy.log(upper - lower))
+            log_prob += kern - log_aux[numpy.newaxis, :, param_index]
+            kernel_index += 1
+        return log_prob
+
+    elif kernel_type == KernelType.component_wise_normal:
+        log_aux = numpy.log(numpy.asarray(auxilliary, dtype=float))
+        kernel_index = 0
+        for param_index in kernel[0]:
+            scale = numpy.sqrt(kernel[2][kernel_index])
+            z = (params[:, param_index, numpy.newaxis] - params0[numpy.newaxis, :, param_index]) / scale
+            kern = -0.5 * z * z - numpy.log(scale * numpy.sqrt(2 * numpy.pi))
+            log_prob += kern - log_aux[numpy.newaxis, :, param_index]
+            kernel_index += 1
+        return log_prob
+
+    elif kernel_type == KernelType.multivariate_normal:
+        ind = kernel[0]
+        kern = kernel[2].log_pdf(params[:, numpy.newaxis, ind], params0[numpy.newaxis, :, ind])
+        return kern - numpy.log(numpy.asarray(auxilliary, dtype=float))[numpy.newaxis, :]
+
+    elif kernel_type == KernelType.multivariate_normal_nn or kernel_type == KernelType.multivariate_normal_ocm:
+        ind = kernel[0]
+        covariances = kernel[2]
+        if ancestors is None:
+            ancestors = [covariances.find(p0) for p0 in params0]
+        inv_chol = covariances.inv_cholesky[ancestors]
+        log_det = covariances.log_det[ancestors]
+        diff = params[:, numpy.newaxis, ind] - params0[numpy.newaxis, :, ind]
+        z = numpy.einsum('jkl,ijl->ijk', inv_chol, diff)
+        kern = -0.5 * numpy.sum(z * z, axis=2) - 0.5 * (len(ind) * numpy.log(2 * numpy.pi) + log_det[numpy.newaxis, :])
+        return kern - numpy.log(numpy.asarray(auxilliary, dtype=float))[numpy.newaxis, :]
+    else:
+        sys.exit("Invalid kernel encountered by get_parameter_kernel_log_pdf_matrix: " + repr(kernel_type))
+
+
 # Here models and parameters refer to the whole population
-def get_auxilliary_info(kernel_type, models, parameters, model_objs, kernel):
+def get_auxilliary_info(kernel_type, models, parameters, model_objs, kernel, normalizer=None):
     """
-    Return the 'Auxilliary Information' for a kernel
+    Return the 'Auxilliary Information' for a kernel: the mass of the kernel of each particle inside the support of the
+    prior, by which the density of the truncated kernel is normalized, computed for all the particles of a model at
+    once.
 
     Parameters
     ----------
@@ -302,85 +359,55 @@ def get_auxilliary_info(kernel_type, models, parameters, model_objs, kernel):
     parameters
     model_objs
     kernel : kernel list
+    normalizer : KernelNormalizer computing the masses; by default, one shared by all calls
 
     Returns
     -------
 
     """
     nparticles = len(parameters)
-    ret = []
-
-    for k in range(nparticles):
-
-        this_prior = model_objs[models[k]].prior
-        this_kernel = kernel[models[k]]
-        nparam = model_objs[models[k]].nparameters
-
-        if kernel_type == KernelType.component_wise_normal:
-            ret.append([1.0] * nparam)
-
-            # ind is an integer between 0 and len(kernel[0])-1 which enables to determine the kernel to use
-            kernel_index = 0
-            if not (len(this_kernel[2]) == 1):
-                for param_index in this_kernel[0]:
-                    # if prior is uniform
-                    if this_prior[param_index].type == PriorType.uniform:
-                        mean = parameters[k][param_index]
-                        scale = numpy.sqrt(this_kernel[2][kernel_index])
-                        ret[k][param_index] = norm.cdf(this_prior[param_index].upper_bound, mean, scale) - \
-                            norm.cdf(this_prior[param_index].lower_bound, mean, scale)
-
-                    # if prior is normal, no truncation required
-                    if this_prior[param_index].type == PriorType.normal:
-                        ret[k][param_index] = 1
-
-                    # if prior is lognormal, trucation for the negative values
-                    if this_prior[param_index].type == PriorType.lognormal:
-                        mean = parameters[k][param_index]
-                        scale = numpy.sqrt(this_kernel[2][kernel_index])
-                        ret[k][param_index] = 1 - norm.cdf(0, mean, scale)
-
-                    kernel_index += 1
-        elif kernel_type == KernelType.multivariate_normal:
-            up = list()
-            low = list()
-            mean = list()
-            for param_index in this_kernel[0]:
-                if this_prior[param_index].type == PriorType.uniform:
-                    low.append(this_prior[param_index].lower_bound)
-                    up.append(this_prior[param_index].upper_bound)
-                if this_prior[param_index].type == PriorType.normal:
-                    low.append(-float('inf'))
-                    up.append(float('inf'))
-                if this_prior[param_index].type == PriorType.lognormal:
-                    low.append(0)
-                    up.append(float('inf'))
-                mean.append(parameters[k][param_index])
-            scale = this_kernel[2]
-            ret.append(statistics.mvnormcdf(low, up, mean, scale))
-
-        elif kernel_type == KernelType.multivariate_normal_nn or kernel_type == KernelType.multivariate_normal_ocm:
-            up = list()
-            low = list()
-            mean = list()
-            for param_index in this_kernel[0]:
-                if this_prior[param_index].type == PriorType.uniform:
-                    low.append(this_prior[param_index].lower_bound)
-                    up.append(this_prior[param_index].upper_bound)
-                if this_prior[param_index].type == PriorType.normal:
-                    low.append(-float('inf'))
-                    up.append(float('inf'))
-                if this_prior[param_index].type == PriorType.lognormal:
-                    low.append(0)
-                    up.append(float('inf'))
-                mean.append(parameters[k][param_index])
-            cur_part = list()
-            for param_index in range(nparam):
-                cur_part.append(parameters[k][param_index])
-            d = this_kernel[2]
-            scale = d[str(cur_part)]
-            ret.append(statistics.mvnormcdf(low, up, mean, scale))
+    built_in_kernels = [KernelType.component_wise_uniform, KernelType.component_wise_normal,
+                        KernelType.multivariate_normal, KernelType.multivariate_normal_nn,
+                        KernelType.multivariate_normal_ocm]
+    if kernel_type not in built_in_kernels:
+        return [0] * nparticles
+
+    if normalizer is None:
+        normalizer = default_normalizer
+
+    models = numpy.asarray(models)
+    parameters = numpy.asarray(parameters, dtype=float)
+    ret = [None] * nparticles
+
+    for model in numpy.unique(models):
+        index = numpy.flatnonzero(models == model)
+        this_prior = compile_prior(model_objs[model].prior)
+        this_kernel = kernel[model]
+        nparam = model_objs[model].nparameters
+        ind = this_kernel[0]
+        mean = parameters[index][:, ind]
+
+        if kernel_type == KernelType.component_wise_uniform or kernel_type == KernelType.component_wise_normal:
+            mass = numpy.ones([len(index), nparam])
+
+            # truncation of the kernel to the support of the prior (this is 1 for normal priors)
+            if kernel_type == KernelType.component_wise_uniform:
+                mass[:, ind] = normalizer.component_wise_uniform(mean, this_kernel[2], this_prior.lower[ind],
+                                                                 this_prior.upper[ind])
+            else:
+                mass[:, ind] = normalizer.component_wise(mean, this_kernel[2], this_prior.lower[ind],
+                                                         this_prior.upper[ind])
+            for i in range(len(index)):
+                ret[index[i]] = list(mass[i])
+
         else:
-            ret = [0] * nparticles
+            if kernel_type == KernelType.multivariate_normal:
+                cholesky = this_kernel[2].cholesky
+            else:
+                # the particles of the model are in the order of the covariances of the local kernel
+                cholesky = this_kernel[2].cholesky[numpy.arange(len(index))]
+            mass = normalizer.multivariate(mean, cholesky, this_prior.lower[ind], this_prior.upper[ind])
+            for i in range(len(index)):
+                ret[index[i]] = mass[i]
 
     return ret
@@ -0,0 +1,164 @@
+# Simulation of batches of particles in a pool of worker processes
+
+import multiprocessing
+
+import numpy as np
+from numpy import random as rnd
+
+# The Abcsmc object whose models, data and distance function are used by a worker process. It is inherited by the
+# worker when the pool is created, so the models never need to be pickled.
+worker_algorithm = None
+
+# Shared counter, incremented by the main process to cancel the tasks that were submitted before the increment.
+worker_generation = None
+
+
+def init_worker(algorithm, generation):
+    global worker_algorithm, worker_generation
+    worker_algorithm = algorithm
+    worker_generation = generation
+
+
+def simulate_chunk(task):
+    """
+    Simulate a chunk of particles of one model inside a worker, and compare the simulations to the data.
+
+    Parameters
+    ----------
+    task : tuple (model, params, epsilon, do_comp, seed, generation)
+
+    Returns
+    -------
+    the accepted counts, distances and fitted trajectories of the particles in the chunk, or None if the task was
+    cancelled before it started
+
+    """
+    model, params, epsilon, do_comp, seed, generation = task
+
+    if worker_generation.value != generation:
+        return None
+
+    # each task gets its own seed, so that workers do not share the random number stream they inherited
+    rnd.seed(seed)
+    return worker_algorithm.simulate_and_compare_model(model, params, epsilon, do_comp)
+
+
+class PendingSimulation:
+    """
+    The chunks of one call to SimulationPool.submit, which are being simulated by the workers.
+    """
+
+    def __init__(self, results):
+        """
+
+        Parameters
+        ----------
+        results : list of the AsyncResult objects of the chunks, in order
+
+        """
+        self.results = results
+
+    def ready(self):
+        """
+        Return True if all the chunks have been simulated.
+        """
+        return all(result.ready() for result in self.results)
+
+    def get(self):
+        """
+        Wait for all the chunks to be simulated.
+
+        Returns
+        -------
+        accepted, distances, traj : lists with one entry per simulated particle
+
+        """
+        accepted = []
+        distances = []
+        traj = []
+        for result in self.results:
+            chunk_accepted, chunk_distances, chunk_traj = result.get()
+            accepted.extend(chunk_accepted)
+            distances.extend(chunk_distances)
+            traj.extend(chunk_traj)
+
+        return accepted, distances, traj
+
+
+class SimulationPool:
+    """
+    A pool of worker processes, each of which simulates part of a batch of particles and computes the corresponding
+    distances. Only the distances, acceptance counts and fitted trajectories are sent back to the main process.
+    """
+
+    def __init__(self, algorithm, nprocesses):
+        """
+
+        Parameters
+        ----------
+        algorithm : the Abcsmc object whose simulate_and_compare_model method the workers run
+        nprocesses : number of worker processes
+
+        """
+        self.nprocesses = nprocesses
+        self.generation = multiprocessing.Value('i', 0)
+        self.pool = multiprocessing.Pool(nprocesses, initializer=init_worker, initargs=(algorithm, self.generation))
+
+    def submit(self, model, params, epsilon, do_comp):
+        """
+        Split params into one chunk per worker, and queue the chunks for simulation, without waiting for them.
+
+        Parameters
+        ----------
+        model : index of the model
+        params : array of parameters, shape (num_simulations, nparameters)
+        epsilon : value of epsilon
+        do_comp : if False, do not calculate distances
+
+        Returns
+        -------
+        a PendingSimulation
+
+        """
+        chunks = np.array_split(np.arange(len(params)), min(self.nprocesses, len(params)))
+        generation = self.generation.value
+
+        results = []
+        for chunk in chunks:
+            task = (model, params[chunk], epsilon, do_comp, rnd.randint(2 ** 31 - 1), generation)
+            results.append(self.pool.apply_async(simulate_chunk, (task,)))
+
+        return PendingSimulation(results)
+
+    def cancel(self):
+        """
+        Cancel all the tasks submitted so far. Tasks that have already started run to completion, but the others are
+        skipped by the workers; the results of the cancelled tasks must not be used.
+        """
+        with self.generation.get_lock():
+            self.generation.value += 1
+
+    def simulate(self, model, params, epsilon, do_comp):
+        """
+        Split params into one chunk per worker, and simulate the chunks in parallel.
+
+        Parameters
+        ----------
+        model : index of the model
+        params : array of parameters, shape (num_simulations, nparameters)
+        epsilon : value of epsilon
+        do_comp : if False, do not calculate distances
+
+        Returns
+        -------
+        accepted, distances, traj : lists with one entry per row of params
+
+        """
+        return self.submit(model, params, epsilon, do_comp).get()
+
+    def close(self):
+        """
+        Stop the worker processes.
+        """
+        self.pool.close()
+        self.pool.join()
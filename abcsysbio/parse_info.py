@@ -202,6 +202,7 @@ class AlgorithmInfo:
 
         self.modelkernel = 0.7
         self.kernel = KernelType.component_wise_uniform
+        self.kneighbours = None
         self.modelprior = []
         self.rtol = 1e-5
         self.atol = 1e-5
@@ -384,12 +385,13 @@ class AlgorithmInfo:
                 self.kernel = KernelType.component_wise_uniform
             elif re_kernel_normal.match(data):
                 self.kernel = KernelType.component_wise_normal
-            elif re_kernel_mvnormal.match(data):
-                self.kernel = KernelType.multivariate_normal
+            # multiVariateNormal is a prefix of the other two multivariate kernels, so it is tested last
             elif re_kernel_mvnormalKN.match(data):
                 self.kernel = KernelType.multivariate_normal_nn
             elif re_kernel_mvnormalOCM.match(data):
                 self.kernel = KernelType.multivariate_normal_ocm
+            elif re_kernel_mvnormal.match(data):
+                self.kernel = KernelType.multivariate_normal
             else:
                 print "\n#################"
                 print "<kernel> must be one of uniform, normal, multivariateNormal, multivariateNormalKNeigh or " + \
@@ -397,6 +399,20 @@ class AlgorithmInfo:
         except IndexError:
             pass
 
+        # get number of neighbours for the multiVariateNormalKNeigh kernel
+        try:
+            data = xmldoc.getElementsByTagName('kneighbours')[0].firstChild.data
+            try:
+                self.kneighbours = int(data)
+            except ValueError:
+                print "\n#################\n<kneighbours> must be an integer so I am going to ignore your argument"
+
+            if self.kneighbours is not None and self.kneighbours < 1:
+                print "\n#################\n<kneighbours> must be >= 1 so I am going to ignore your argument"
+                self.kneighbours = None
+        except IndexError:
+            pass
+
         # get model priors
         self.modelprior = [1 / float(self.nmodels)] * self.nmodels
         try:
@@ -443,6 +459,8 @@ class AlgorithmInfo:
                 print "\talpha:", self.alpha
 
             print "kernel:", self.kernel
+            if self.kneighbours is not None:
+                print "kernel neighbours:", self.kneighbours
             print "model kernel:", self.modelkernel
         print "model prior:", self.modelprior
 
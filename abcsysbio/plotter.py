@@ -1,28 +1,7 @@
 import matplotlib.pyplot as plt
 import numpy as np
 from PriorType import PriorType
-
-def bin_data(d, w, nbins):
-    d_max = np.max(d)
-    d_min = np.min(d) - 1e-6  # ensures that the lowest entry is included in the first bin
-    bin_width = (d_max - d_min) / nbins
-
-    bin_l = np.array([d_min + i * bin_width for i in range(nbins)])
-    bin_u = np.array([d_min + (i + 1) * bin_width for i in range(nbins)])
-    bin_c = np.array([bin_l[i] + bin_width / 2 for i in range(nbins)])
-
-    count = np.zeros([nbins])
-
-    for k in range(len(d)):
-        kd = d[k]
-        kw = w[k]
-
-        for i in range(nbins):
-            if bin_l[i] < kd <= bin_u[i]:
-                count[i] = count[i] + kw
-                break
-
-    return [bin_c, count]
+from abcsysbio.statistics import bin_data, bin_data_2d
 
 
 def modelMarginsByPopulation(allResults, models):
@@ -38,27 +17,27 @@ def plotHistogram(result, modelIndex, parameterIndexes=None, models=None, bins=9
     if parameterIndexes is None:
         parameterIndexes = nonConstantParameterIndexes(models[modelIndex])
 
-    np = len(parameterIndexes)
-    if np == 1:
+    nparams = len(parameterIndexes)
+    if nparams == 1:
         sq = (1, 1)
-    elif np == 2:
+    elif nparams == 2:
         sq = (2, 1)
-    elif np == 3:
+    elif nparams == 3:
         sq = (3, 1)
-    elif np == 4:
+    elif nparams == 4:
         sq = (2, 2)
-    elif np == 5 or np == 6:
+    elif nparams == 5 or nparams == 6:
         sq = (3, 2)
     else:
-        tmp = np.ceil(np ** 0.5)
-        sq = (int(tmp), int(np.ceil(np.np/tmp)))
+        tmp = np.ceil(nparams ** 0.5)
+        sq = (int(tmp), int(np.ceil(nparams / tmp)))
 
     fs = (4*sq[0], 4*sq[1])
-    fig, (axs) = plt.subplots(ncols=sq[0], nrows=sq[1], figsize=fs)
+    fig, (axs) = plt.subplots(ncols=sq[0], nrows=sq[1], figsize=fs, squeeze=False)
     axs = axs.flatten()
     for i, parameterIndex in enumerate(parameterIndexes):
         thisParams = result.parameters[result.models == modelIndex]
-        x = [y[parameterIndex] for y in thisParams]
+        x = thisParams[:, parameterIndex]
         w = result.weights[result.models == modelIndex]
         histogram_x, histogram_y = bin_data(x, w, int(bins))
 
@@ -86,7 +65,9 @@ def nonConstantParameterIndexes(model):
     return pi
 
 
-def doPairPlot(allResults, modelIndex, populationsIndex, models, actualValues=None):
+def doPairPlot(allResults, modelIndex, populationsIndex, models, actualValues=None, density=False):
+    # with density, the panels off the diagonal show the weighted density of the last population instead of the
+    # particles of each population
     parametersForModelByPopulation = [r.parameters[r.models == modelIndex] for r in allResults]
     weightsForModelByPopulation    = [r.weights[r.models == modelIndex] for r in allResults]
 
@@ -120,8 +101,10 @@ def doPairPlot(allResults, modelIndex, populationsIndex, models, actualValues=No
             plt.subplot(dim, dim, i + 1)
             w = weightsForModelByPopulation[populationsIndex[-1]]
             for counter, populationIndex in enumerate(populationsIndex):
-                x = [tmp[nonConstantPIs[int(permutation[i][0]-1)]] for tmp in parametersForModelByPopulation[populationIndex]]
-                y = [tmp[nonConstantPIs[int(permutation[i][1]-1)]] for tmp in parametersForModelByPopulation[populationIndex]]
+                if density and populationIndex != populationsIndex[-1]:
+                    continue
+                x = parametersForModelByPopulation[populationIndex][:, nonConstantPIs[int(permutation[i][0]-1)]]
+                y = parametersForModelByPopulation[populationIndex][:, nonConstantPIs[int(permutation[i][1]-1)]]
 
                 if permutation[i][0] == permutation[i][1]:
                     if populationIndex == populationsIndex[-1]:
@@ -140,12 +123,17 @@ def doPairPlot(allResults, modelIndex, populationsIndex, models, actualValues=No
 
                 else:
                     if not (len(x) == 0):
-                        tag = str(populationIndex)
-                        plt.scatter(x, y, s=20, marker='o', c=my_colors[counter], edgecolor=my_colors[counter], alpha=0.5, label=tag)
-                        plt.hold(True)
-
-                        if i == len(permutation)-2:
-                            plt.legend(loc='lower right', bbox_to_anchor=(1.5, -0.3), fancybox=True, shadow=True, ncol=5, prop={'size': 18})
+                        if density:
+                            x_edges, y_edges, z = bin_data_2d(x, y, w, int(bin_b))
+                            plt.pcolormesh(x_edges, y_edges, z.T, cmap='Blues')
+                            plt.hold(True)
+                        else:
+                            tag = str(populationIndex)
+                            plt.scatter(x, y, s=20, marker='o', c=my_colors[counter], edgecolor=my_colors[counter], alpha=0.5, label=tag)
+                            plt.hold(True)
+
+                            if i == len(permutation)-2:
+                                plt.legend(loc='lower right', bbox_to_anchor=(1.5, -0.3), fancybox=True, shadow=True, ncol=5, prop={'size': 18})
 
                         if actualValues is not None and populationIndex == populationsIndex[-1]:
                             plt.scatter([actualValues[int(permutation[i][0]-1)]], [actualValues[int(permutation[i][1]-1)]], marker='+', s=5000, color='black',linewidth=2)
@@ -0,0 +1,199 @@
+import numpy as np
+from scipy.special import logsumexp
+
+
+class Population:
+    """
+    Preallocated arrays holding one population of particles.
+
+    models[i] is the index of the model of particle i and weights[i] is its weight; log_weights[i] is the logarithm of
+    the weight, in which the weights are computed and normalized so that they do not underflow (see
+    normalize_weights). The parameters of all models are held in one float64 array:
+    parameters[i, :nparameters[models[i]]] are the parameters of particle i, and the remaining entries of the row are
+    NaN. margins[m] is the marginal probability of model m.
+
+    The arrays are allocated once, and re-used (see reset) for every population.
+    """
+
+    def __init__(self, nparticles, nparameters):
+        """
+
+        Parameters
+        ----------
+        nparticles : number of particles
+        nparameters : list containing the number of parameters of each model
+
+        """
+        self.nparticles = nparticles
+        self.nmodel = len(nparameters)
+        self.nparameters = np.array(nparameters, dtype=int)
+
+        self.models = np.zeros(nparticles, dtype=int)
+        self.weights = np.zeros(nparticles)
+        self.log_weights = np.zeros(nparticles)
+        self.parameters = np.zeros([nparticles, max(max(nparameters), 1)])
+        self.margins = np.zeros(self.nmodel)
+
+        self.reset()
+
+    def reset(self):
+        """
+        Clear the population, without reallocating its arrays.
+        """
+        self.models.fill(0)
+        self.weights.fill(0)
+        self.log_weights.fill(-np.inf)
+        self.parameters.fill(np.nan)
+        self.margins.fill(0)
+
+    def set_particle(self, index, model, params):
+        """
+        Store the model index and parameters of particle number index.
+
+        Parameters
+        ----------
+        index : index of the particle
+        model : index of the model of the particle
+        params : parameters of the particle (only the first nparameters[model] entries are used)
+
+        """
+        num_params = self.nparameters[model]
+        self.models[index] = model
+        self.parameters[index, :num_params] = params[:num_params]
+
+    def particle_parameters(self, index):
+        """
+        Return the parameters of particle number index, as a view of length nparameters[models[index]].
+        """
+        return self.parameters[index, :self.nparameters[self.models[index]]]
+
+    def model_index(self, model):
+        """
+        Return the indexes of the particles whose model is model.
+        """
+        return np.flatnonzero(self.models == model)
+
+    def model_parameters(self, model):
+        """
+        Return an array of shape (num_particles_of_model, nparameters[model]) containing the parameters of the
+        particles whose model is model.
+        """
+        return self.parameters[self.models == model, :self.nparameters[model]]
+
+    def fill(self, models, weights, parameters, margins):
+        """
+        Copy a population stored as lists (e.g. read from a pickled file) into the arrays.
+
+        Parameters
+        ----------
+        models : model index of each particle
+        weights : weight of each particle
+        parameters : list (or array) containing the parameters of each particle
+        margins : marginal probability of each model
+
+        """
+        self.reset()
+        self.weights[:] = weights
+        with np.errstate(divide='ignore'):
+            self.log_weights[:] = np.log(self.weights)
+        self.margins[:] = margins
+        for i in range(self.nparticles):
+            self.set_particle(i, int(models[i]), np.asarray(parameters[i], dtype=float))
+
+    def normalize_weights(self):
+        """
+        Normalize log_weights so that the weights sum to one, using log-sum-exp, and set weights accordingly.
+        """
+        self.log_weights -= logsumexp(self.log_weights)
+        self.weights[:] = np.exp(self.log_weights)
+
+    def update_margins(self):
+        """
+        Re-calculate the marginal probability of each model as the sum of the weights of the corresponding particles,
+        using log-sum-exp over the log weights.
+        """
+        for model in range(self.nmodel):
+            log_weights = self.log_weights[self.models == model]
+            self.margins[model] = np.exp(logsumexp(log_weights)) if len(log_weights) > 0 else 0.0
+
+
+class AcceptedSimulations:
+    """
+    Preallocated arrays holding the fitted trajectories and distances of the accepted particles of one population.
+
+    trajectories[i, k] is the fitted trajectory of beta repeat k of particle i, with shape (ntimes, nfit), and
+    distances[i, k] is the list of its distances. The arrays are allocated when the first particle is stored, as the
+    number of fitted dimensions and of distances are only known once a simulation has been compared to the data. If
+    the models fit different numbers of dimensions (this can happen when simulating without data), trajectories has
+    the largest number of columns, and widths[m] is the number of columns used by model m.
+
+    The arrays are handed over to the results of the population (see release), so a new set is allocated for every
+    population.
+    """
+
+    def __init__(self, nparticles, nmodel, beta, dtype=np.float64, keep_trajectories=True):
+        """
+
+        Parameters
+        ----------
+        nparticles : number of particles
+        nmodel : number of models
+        beta : number of simulations per particle
+        dtype : dtype of the trajectories, eg numpy.float32 to halve their memory use
+        keep_trajectories : if False, only the distances are kept
+
+        """
+        self.nparticles = nparticles
+        self.beta = beta
+        self.dtype = dtype
+        self.keep_trajectories = keep_trajectories
+
+        self.trajectories = None
+        self.distances = None
+        self.widths = np.zeros(nmodel, dtype=int)
+
+    def set_particle(self, index, model, traj, distances):
+        """
+        Store the trajectories and distances of the beta simulations of particle number index.
+
+        Parameters
+        ----------
+        index : index of the particle
+        model : index of the model of the particle
+        traj : list of beta fitted trajectories, each with shape (ntimes, nfit); ignored if trajectories are not kept
+        distances : list of beta lists of distances
+
+        """
+        distances = np.asarray(distances, dtype=float).reshape(self.beta, -1)
+        if self.distances is None:
+            self.distances = np.empty((self.nparticles,) + distances.shape)
+            self.distances.fill(np.nan)
+        self.distances[index] = distances
+
+        if not self.keep_trajectories:
+            return
+
+        traj = np.asarray(traj)
+        width = traj.shape[-1]
+        if self.trajectories is None:
+            self.trajectories = np.empty((self.nparticles,) + traj.shape, dtype=self.dtype)
+            self.trajectories.fill(np.nan)
+        elif width > self.trajectories.shape[-1]:
+            trajectories = np.empty(self.trajectories.shape[:-1] + (width,), dtype=self.dtype)
+            trajectories.fill(np.nan)
+            trajectories[..., :self.trajectories.shape[-1]] = self.trajectories
+            self.trajectories = trajectories
+
+        self.trajectories[index, :, :, :width] = traj
+        self.widths[model] = width
+
+    def release(self):
+        """
+        Return the arrays (trajectories, distances, widths) and forget them, so that the next population is stored in
+        new arrays.
+        """
+        arrays = self.trajectories, self.distances, self.widths
+        self.trajectories = None
+        self.distances = None
+        self.widths = np.zeros(len(self.widths), dtype=int)
+        return arrays
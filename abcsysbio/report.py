@@ -0,0 +1,479 @@
+# Offline generation of the diagnostic figures of a finished run, from the files of its results folder
+
+import multiprocessing
+import os
+import re
+import sys
+
+import numpy
+import matplotlib.pyplot as plt
+from matplotlib.backends.backend_pdf import PdfPages
+
+from abcsysbio import getResults
+from abcsysbio import plotter
+from abcsysbio.abcModel import AbcModel
+from abcsysbio.abcsmc import AbcsmcResults
+from abcsysbio.data import Data
+from abcsysbio.input_output import InputOutput, scatter_populations
+
+from Prior import Prior
+from PriorType import PriorType
+
+# a line of rates.txt: population, epsilon (printed as a list or an array), sampled, acceptance rate, time
+re_rates = re.compile(r'^\s*(\d+)\s+\[(.*)\]\s+(\S+)\s+(\S+)')
+
+# number of accepted particles whose trajectories are plotted for each model, as in InputOutput.write_diagnostics
+num_time_series = 10
+
+# the per-particle trajectories are plotted for the particles among the first max_particles_by_particle of a population,
+# as in InputOutput.write_diagnostics
+max_particles_by_particle = 1000
+
+
+def read_rates(folder):
+    """
+    Read the populations, epsilons, numbers of sampled particles and acceptance rates from rates.txt.
+
+    Parameters
+    ----------
+    folder : the results folder
+
+    Returns
+    -------
+    a list of tuples (population, epsilon, sampled, rate), one per population
+
+    """
+    try:
+        in_file = open(folder + '/rates.txt', "r")
+    except IOError:
+        sys.exit("\nCan not find file \'rates.txt\' in folder " + folder + "!\n")
+
+    rates = []
+    for line in in_file:
+        match = re_rates.match(line)
+        if match is not None:
+            epsilon = [float(e) for e in re.split(r'[\s,]+', match.group(2).strip()) if e != '']
+            rates.append((int(match.group(1)), epsilon, int(match.group(3)), float(match.group(4))))
+    in_file.close()
+
+    return rates
+
+
+def read_model_names(folder, info=None):
+    """
+    Return the names of the models, in the order of their indexes. They are taken from the input file if it is given,
+    or else from the binary file of the first population; the folders of older runs, which have neither, are ordered
+    by name.
+
+    Parameters
+    ----------
+    folder : the results folder
+    info : a parse_info.AlgorithmInfo, or None
+
+    """
+    if info is not None:
+        return list(info.name)
+
+    if os.path.exists(folder + '/Population1.npz'):
+        in_file = numpy.load(folder + '/Population1.npz')
+        if 'model_names' in in_file.files:
+            names = [str(name) for name in in_file['model_names']]
+            in_file.close()
+            return names
+        in_file.close()
+
+    return sorted(name[len('results_'):] for name in os.listdir(folder)
+                  if name.startswith('results_') and os.path.isdir(folder + '/' + name))
+
+
+def read_population(folder, population, model_names, epsilon, sampled, rate):
+    """
+    Read the particles and weights of a population, from its binary file PopulationN.npz, or else from the text files
+    data_PopulationN.txt and data_WeightsN.txt of each model. The trajectories are not read.
+
+    Parameters
+    ----------
+    folder : the results folder
+    population : number of the population, starting from 1
+    model_names : names of the models
+    epsilon, sampled, rate : epsilon, number of sampled particles and acceptance rate of the population, from rates.txt
+
+    Returns
+    -------
+    an AbcsmcResults, without trajectories
+
+    """
+    if os.path.exists(folder + '/Population' + repr(population) + '.npz'):
+        arrays = InputOutput.read_population_arrays(folder, population)
+        return AbcsmcResults(len(arrays['weights']), sampled, rate, None, arrays['distances'], arrays['margins'],
+                             arrays['models'], arrays['weights'], arrays['parameters'], epsilon)
+
+    parameters = []
+    weights = []
+    models = []
+    for mod in range(len(model_names)):
+        path = folder + '/results_' + model_names[mod] + '/Population_' + repr(population)
+        param_file = path + '/data_Population' + repr(population) + '.txt'
+        weight_file = path + '/data_Weights' + repr(population) + '.txt'
+        if not os.path.exists(param_file):
+            continue
+
+        parameters.append(numpy.loadtxt(param_file, ndmin=2))
+        weights.append(numpy.loadtxt(weight_file, ndmin=1))
+        models.append(numpy.repeat(mod, len(weights[-1])))
+
+    if len(weights) == 0:
+        sys.exit("\nCan not find the particles of population " + repr(population) + " in folder " + folder + "!\n")
+
+    # the parameters of the models are padded with NaN to the largest number of parameters, as in Population
+    padded = numpy.empty([sum(len(p) for p in parameters), max(p.shape[1] for p in parameters)])
+    padded.fill(numpy.nan)
+    start = 0
+    for p in parameters:
+        padded[start:start + len(p), :p.shape[1]] = p
+        start += len(p)
+
+    models = numpy.concatenate(models)
+    weights = numpy.concatenate(weights)
+    margins = numpy.bincount(models, weights, minlength=len(model_names))
+    return AbcsmcResults(len(weights), sampled, rate, None, [], margins, models, weights, padded, epsilon)
+
+
+def read_trajectories(folder, population, model, num_particles=None, first_particles=None):
+    """
+    Read the fitted trajectories of the first num_particles particles of a model in a population, from the binary file
+    of the population, or else from traj_PopulationN.txt.
+
+    Parameters
+    ----------
+    folder : the results folder
+    population : number of the population, starting from 1
+    model : index of the model
+    num_particles : maximum number of particles, or None for all the particles of the model
+    first_particles : if given, only the particles among the first first_particles particles of the population are read
+
+    Returns
+    -------
+    the indexes of the particles in the population, and a list of arrays of shape (beta, num_timepoints, num_species),
+    one per particle; both are empty if the trajectories were not stored
+
+    """
+    filename = folder + '/Population' + repr(population) + '.npz'
+    if os.path.exists(filename):
+        in_file = numpy.load(filename)
+        if 'trajectories' not in in_file.files:
+            in_file.close()
+            return [], []
+
+        particles = numpy.flatnonzero(in_file['models'][:first_particles] == model)[:num_particles]
+        width = in_file['trajectory_widths'][model]
+        trajectories = in_file['trajectories'][particles, :, :, :width]
+        in_file.close()
+        return list(particles), list(trajectories)
+
+    # each line holds: particle, beta repeat, model, species, and the trajectory of the species over time
+    filename = folder + '/traj_Population' + repr(population) + '.txt'
+    if not os.path.exists(filename):
+        return [], []
+    lines = numpy.loadtxt(filename, ndmin=2)
+    lines = lines[lines[:, 2] == model]
+    if first_particles is not None:
+        lines = lines[lines[:, 0] < first_particles]
+
+    first = numpy.unique(lines[:, 0], return_index=True)[1]
+    particles = lines[numpy.sort(first), 0][:num_particles]
+
+    trajectories = []
+    for i in particles:
+        rows = lines[lines[:, 0] == i]
+        beta = int(numpy.max(rows[:, 1])) + 1
+        nspecies = int(numpy.max(rows[:, 3])) + 1
+        traj = numpy.empty([beta, rows.shape[1] - 4, nspecies])
+        for row in rows:
+            traj[int(row[1]), :, int(row[3])] = row[4:]
+        trajectories.append(traj)
+
+    return [int(i) for i in particles], trajectories
+
+
+def stored_models(model_names, populations, info=None):
+    """
+    Return AbcModel objects holding the names, numbers of parameters and priors of the models, which are used by the
+    plotting functions to skip the constant parameters. The priors are taken from the input file if it is given;
+    otherwise a parameter is given a constant prior if it has the same value in all the particles of the model, and a
+    uniform prior over its range of values if not.
+
+    Parameters
+    ----------
+    model_names : names of the models
+    populations : list of AbcsmcResults
+    info : a parse_info.AlgorithmInfo, or None
+
+    """
+    models = []
+    for mod in range(len(model_names)):
+        if info is not None:
+            models.append(AbcModel(model_names[mod], None, None, info.prior[mod], info.nparameters[mod]))
+            continue
+
+        values = numpy.concatenate([p.parameters[p.models == mod] for p in populations])
+        nparameters = int(numpy.sum(numpy.any(~numpy.isnan(values), axis=0))) if len(values) > 0 else 0
+        values = values[:, :nparameters]
+
+        prior = []
+        for j in range(nparameters):
+            if numpy.min(values[:, j]) == numpy.max(values[:, j]):
+                prior.append(Prior(type=PriorType.constant, value=values[0, j]))
+            else:
+                prior.append(Prior(type=PriorType.uniform, lower_bound=numpy.min(values[:, j]),
+                                   upper_bound=numpy.max(values[:, j])))
+        models.append(AbcModel(model_names[mod], None, None, prior, nparameters))
+
+    return models
+
+
+def model_specs(models):
+    """
+    Return the tuples (name, nparameters, indexes of the non-constant parameters) of the models, which are sent to the
+    worker processes instead of the models, whose priors cannot be pickled.
+    """
+    return [(model.name, model.nparameters, plotter.nonConstantParameterIndexes(model)) for model in models]
+
+
+def spec_models(specs):
+    """
+    Return AbcModel objects rebuilt from the tuples of model_specs, with the priors of the non-constant parameters
+    replaced by uniform priors.
+    """
+    models = []
+    for name, nparameters, nonconstant in specs:
+        prior = [Prior(type=PriorType.uniform) if j in nonconstant else Prior(type=PriorType.constant)
+                 for j in range(nparameters)]
+        models.append(AbcModel(name, None, None, prior, nparameters))
+    return models
+
+
+# populations read by this process, by results folder and population number: the tasks are given the numbers of the
+# populations they plot instead of their particles, and each worker process reads a population once
+population_cache = {}
+
+
+def load_populations(folder, numbers, model_names):
+    """
+    Return the AbcsmcResults of the populations of a results folder with the given numbers, reading those which are
+    not yet in population_cache.
+    """
+    cache = population_cache.setdefault(folder, {})
+    missing = [number for number in numbers if number not in cache]
+    if len(missing) > 0:
+        rates = dict((rate[0], rate) for rate in read_rates(folder))
+        for number in missing:
+            epsilon, sampled, rate = rates[number][1:]
+            cache[number] = read_population(folder, number, model_names, epsilon, sampled, rate)
+    return [cache[number] for number in numbers]
+
+
+def plot_model_distribution(folder, margins, epsilon, rate):
+    getResults.get_model_distribution(margins, epsilon, rate, plot_name=folder + '/ModelDistribution')
+
+
+def plot_scatter_plots(plot_name, folder, numbers, overlaid, model, model_names, specs):
+    # numbers holds the numbers of the populations up to the plotted one, or None for the populations which are not
+    # overlaid
+    models = spec_models(specs)
+    population_mod = []
+    weights_mod = []
+    for number in numbers:
+        if number is None:
+            population_mod.append(None)
+            weights_mod.append(None)
+        else:
+            particles = InputOutput.model_particles(load_populations(folder, [number], model_names)[0], models)
+            population_mod.append(particles[0][model])
+            weights_mod.append(particles[1][model])
+    getResults.get_all_scatter_plots([population_mod], [weights_mod], populations=overlaid, plot_name=plot_name,
+                                     model=1)
+
+
+def plot_histograms(plot_name, folder, number, model, model_names, specs):
+    particles = InputOutput.model_particles(load_populations(folder, [number], model_names)[0], spec_models(specs))
+    getResults.get_all_histograms([[particles[0][model]]], [[particles[1][model]]], population=1, plot_name=plot_name,
+                                  model=1)
+
+
+def plot_time_series(filename, folder, population, model, data, plotdata):
+    trajectories = read_trajectories(folder, population, model, num_time_series)[1]
+    if len(trajectories) > 0:
+        if data.timepoints is None:
+            data = Data(numpy.arange(trajectories[0].shape[1]), data.values)
+        # plot_time_series2 only uses pars to count the particles, so it is given one entry per trajectory
+        getResults.plot_time_series2(pars=trajectories, data=data, beta=trajectories[0].shape[0], filename=filename,
+                                     traj2=trajectories, plotdata=plotdata)
+
+
+def plot_time_series_by_particle(filename, folder, population, model, data, plotdata):
+    # one page per particle of the model among the first max_particles_by_particle particles of the population, with
+    # the trajectory of its first beta repeat, as in InputOutput.write_diagnostics
+    particles, trajectories = read_trajectories(folder, population, model, first_particles=max_particles_by_particle)
+    if len(trajectories) == 0:
+        return
+
+    timepoints = data.timepoints
+    if timepoints is None:
+        timepoints = numpy.arange(trajectories[0].shape[1])
+
+    pp = PdfPages(filename)
+    for i, traj in zip(particles, trajectories):
+        for ic in range(traj.shape[2]):
+            plt.plot(timepoints, traj[0, :, ic], label='sp ' + repr(ic))
+        plt.title("particle " + repr(i))
+
+        plt.gca().set_prop_cycle(None)
+        if plotdata:
+            plt.plot(timepoints, data.values, 'o')
+
+        legend = plt.legend(loc='upper left', shadow=False)
+        for label in legend.get_texts():
+            label.set_fontsize('small')
+        for label in legend.get_lines():
+            label.set_linewidth(0.5)
+
+        pp.savefig()
+        plt.close()
+    pp.close()
+
+
+def plot_model_margins(filename, folder, numbers, model_names, specs):
+    plt.figure()
+    plotter.modelMarginsByPopulation(load_populations(folder, numbers, model_names), spec_models(specs))
+    plt.savefig(filename)
+    plt.close('all')
+
+
+def plot_pairs(filename, folder, numbers, model, model_names, specs):
+    populations = load_populations(folder, numbers, model_names)
+    plotter.doPairPlot(populations, model, range(len(populations)), spec_models(specs))
+    plt.savefig(filename)
+    plt.close('all')
+
+
+def plot_parameter_histograms(filename, folder, number, model, model_names, specs):
+    plotter.plotHistogram(load_populations(folder, [number], model_names)[0], model, models=spec_models(specs))
+    plt.savefig(filename)
+    plt.close('all')
+
+
+def run_task(task):
+    """
+    Draw one figure in a worker process: task is a tuple (function, args).
+    """
+    function, args = task
+    function(*args)
+
+
+def report_tasks(folder, info=None, plot_time_series_data=True, scatter_window=12):
+    """
+    Read a results folder, and return the list of the tasks drawing its figures, one per figure.
+
+    Parameters
+    ----------
+    folder : the results folder
+    info : the parse_info.AlgorithmInfo of the input file of the run, or None; it gives the models and their priors,
+        and the timepoints and data plotted with the trajectories
+    plot_time_series_data : if False, the data are not plotted over the trajectories
+    scatter_window : number of populations overlaid in the scatter plots, or 0 to overlay all of them
+
+    Returns
+    -------
+    a list of tuples (function, args), to be run by run_task
+
+    """
+    rates = read_rates(folder)
+    model_names = read_model_names(folder, info)
+    numbers = [rate[0] for rate in rates]
+    populations = load_populations(folder, numbers, model_names)
+    models = stored_models(model_names, populations, info)
+    specs = model_specs(models)
+
+    if info is not None and len(info.data) > 0:
+        data = Data(info.times, info.data)
+    else:
+        data = Data(None, None)
+        plot_time_series_data = False
+
+    # the tasks are given the numbers of the populations they plot, which the worker processes read themselves
+    tasks = []
+    if len(models) > 1:
+        margins = numpy.array([p.margins for p in populations])
+        if os.path.exists(folder + '/ModelDistribution.txt'):
+            margins = numpy.loadtxt(folder + '/ModelDistribution.txt', ndmin=2)
+        tasks.append((plot_model_distribution, (folder, margins, [p.epsilon for p in populations],
+                                                [p.rate for p in populations])))
+        tasks.append((plot_model_margins, (folder + '/ModelMargins.png', folder, numbers, model_names, specs)))
+
+    for mod in range(len(models)):
+        nonconstant = plotter.nonConstantParameterIndexes(models[mod])
+
+        for i in range(len(populations)):
+            pop = numbers[i]
+            if numpy.sum(populations[i].models == mod) == 0:
+                continue
+
+            path = folder + '/results_' + models[mod].name + '/Population_' + repr(pop)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+            if len(nonconstant) > 0:
+                overlaid = scatter_populations(i + 1, scatter_window)
+                scattered = [numbers[j] if j + 1 in overlaid else None for j in range(i + 1)]
+                tasks.append((plot_scatter_plots, (path + '/ScatterPlots_Population' + repr(pop), folder, scattered,
+                                                   overlaid, mod, model_names, specs)))
+                tasks.append((plot_histograms, (path + '/weightedHistograms_Population' + repr(pop), folder, pop, mod,
+                                                model_names, specs)))
+                tasks.append((plot_pairs, (path + '/PairPlot_Population' + repr(pop) + '.png', folder,
+                                           numbers[:i + 1], mod, model_names, specs)))
+                tasks.append((plot_parameter_histograms, (path + '/Histograms_Population' + repr(pop) + '.png',
+                                                          folder, pop, mod, model_names, specs)))
+
+            filename = path + '/Timeseries_Population' + repr(pop)
+            tasks.append((plot_time_series, (filename, folder, pop, mod, data, plot_time_series_data)))
+            tasks.append((plot_time_series_by_particle, (filename + '_byp.pdf', folder, pop, mod, data,
+                                                         plot_time_series_data)))
+
+    return tasks
+
+
+def generate_report(folder, info=None, nprocesses=1, plot_time_series_data=True, scatter_window=12):
+    """
+    Draw all the figures of a results folder, in a pool of nprocesses worker processes.
+
+    Parameters
+    ----------
+    folder : the results folder
+    info : the parse_info.AlgorithmInfo of the input file of the run, or None
+    nprocesses : number of worker processes (1 draws the figures in this process)
+    plot_time_series_data : if False, the data are not plotted over the trajectories
+    scatter_window : number of populations overlaid in the scatter plots, or 0 to overlay all of them
+
+    Returns
+    -------
+    the number of figures drawn
+
+    """
+    try:
+        tasks = report_tasks(folder, info, plot_time_series_data, scatter_window)
+
+        if nprocesses == 1:
+            for task in tasks:
+                run_task(task)
+        else:
+            pool = multiprocessing.Pool(nprocesses)
+            try:
+                pool.map(run_task, tasks, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+    finally:
+        population_cache.pop(folder, None)
+
+    return len(tasks)
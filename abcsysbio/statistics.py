@@ -5,6 +5,11 @@ from numpy import random as rnd
 from numpy import linalg as la
 import scipy
 import scipy.stats.mvn
+from scipy.spatial import cKDTree
+from scipy.special import ndtr, ndtri
+
+# maximum number of elements in the intermediate arrays used when computing many covariance matrices at once
+covariance_block_size = 2 ** 22
 
 
 def w_choice(weight):
@@ -27,6 +32,26 @@ def w_choice(weight):
     return len(weight) - 1
 
 
+def w_choice_batch(weight, size):
+    """
+    Draw size samples from the categorical distribution with probabilities given by weight.
+
+    This is equivalent to calling w_choice size times, but uses a single search of the cumulative weights.
+
+    Parameters
+    ----------
+    weight : list of probability for each category
+    size : number of samples to draw
+
+    Returns
+    -------
+    an integer array of length size
+    """
+    cumulative = np.cumsum(weight)
+    n = rnd.random_sample(size)
+    return np.minimum(np.searchsorted(cumulative, n, side='right'), len(weight) - 1)
+
+
 def get_pdf_uniform(min_val, max_val, x):
     """
     Evaluate the P(x) for x ~ U(min_val, max_val)
@@ -70,9 +95,9 @@ def get_pdf_lognormal(m, sigma, x):
     sigma : standard deviation of the associated normal
     m : mean of the associated normal
     """
-    x = np.exp(-0.5 * (np.log(x) - m) * (np.log(x) - m) / (sigma * sigma))
-    x = x / (x * sigma * np.sqrt(2 * np.pi))
-    return x
+    p = np.exp(-0.5 * (np.log(x) - m) * (np.log(x) - m) / (sigma * sigma))
+    p = p / (x * sigma * np.sqrt(2 * np.pi))
+    return p
 
 
 # compute the pdf of a multinormal distribution
@@ -90,14 +115,10 @@ def get_pdf_multinormal(x, covariances, m):
     -------
 
     """
-    a = 0
-    k = len(x)
-    inv = la.inv(covariances)
-    for i in range(k):
-        for j in range(k):
-            a += inv[i, j] * (x[i] - m[i]) * (x[j] - m[j])
+    dev = np.asarray(x, dtype=float) - np.asarray(m, dtype=float)
+    a = np.dot(dev, la.solve(covariances, dev))
     det = la.det(covariances)
-    return np.exp(-1.0 * a / 2.0) / (np.sqrt((2 * np.pi) ** k * det))
+    return np.exp(-1.0 * a / 2.0) / (np.sqrt((2 * np.pi) ** len(dev) * det))
 
 
 def wtvar(x, weights, method="R"):
@@ -116,17 +137,88 @@ def wtvar(x, weights, method="R"):
     -------
     the weighted variance of the measurements
     """
-    sum_w = sum(weights)
+    x = np.asarray(x, dtype=float)
+    weights = np.asarray(weights, dtype=float)
+
+    sum_w = np.sum(weights)
+    x_bar_wt = np.dot(weights, x) / sum_w
+    sum_sq = np.dot(weights, (x - x_bar_wt) ** 2)
     if method == "nist":
-        x_bar_wt = sum([weights * x for weights, x in zip(weights, x)]) / sum_w  # fixed.2009.03.07, divisor added.
-        num_particles = sum([1 if (weights != 0) else 0 for weights in weights])
+        num_particles = np.count_nonzero(weights)
         d = sum_w * (num_particles - 1.0) / num_particles
-        return sum([weights * (x - x_bar_wt) ** 2 for weights, x in zip(weights, x)]) / d
+        return sum_sq / d
     else:
-        sum_w2 = sum([weights ** 2 for weights in weights])
-        x_bar_wt = sum([(weights * x) for (weights, x) in zip(weights, x)]) / sum_w
-        return sum([(weights * (x - x_bar_wt) ** 2) for (weights, x) in zip(weights, x)]) * sum_w / (
-            sum_w ** 2 - sum_w2)
+        sum_w2 = np.sum(weights ** 2)
+        return sum_sq * sum_w / (sum_w ** 2 - sum_w2)
+
+
+def bin_indexes(d, nbins):
+    """
+    Return the edges of nbins bins of equal width between the minimum and the maximum of the values d, and the index of
+    the bin of each value. The bins are closed on their upper edge, (l, u], and the lower edge of the first bin is just
+    below the minimum; the values in no bin, which can only be the maximum after rounding, have index -1.
+    """
+    d_max = np.max(d)
+    d_min = np.min(d) - 1e-6  # ensures that the lowest entry is included in the first bin
+    bin_width = (d_max - d_min) / nbins
+    edges = d_min + np.arange(nbins + 1) * bin_width
+
+    index = np.searchsorted(edges, d, side='left') - 1
+    index[index >= nbins] = -1
+    return edges, index
+
+
+def bin_data(d, w, nbins):
+    """
+    Weighted histogram of the values d, in nbins bins of equal width between the minimum and the maximum of d. The
+    bins are closed on their upper edge, so a value on an edge between two bins is counted in the lower one.
+
+    Parameters
+    ----------
+    d : values
+    w : weight of each value
+    nbins : number of bins
+
+    Returns
+    -------
+    [bin_c, count]: the centres of the bins, and the sum of the weights of the values in each bin
+
+    """
+    edges, index = bin_indexes(np.asarray(d, dtype=float), nbins)
+    inside = index >= 0
+
+    count = np.bincount(index[inside], weights=np.asarray(w, dtype=float)[inside], minlength=nbins)
+    bin_c = edges[:-1] + (edges[1] - edges[0]) / 2
+
+    return [bin_c, count]
+
+
+def bin_data_2d(x, y, w, nbins):
+    """
+    Weighted two-dimensional histogram of the pairs of values (x, y), in nbins x nbins bins of equal size between the
+    minimum and the maximum of x and of y. As in bin_data, the bins are closed on their upper edges.
+
+    Parameters
+    ----------
+    x, y : values
+    w : weight of each pair of values
+    nbins : number of bins along each axis
+
+    Returns
+    -------
+    [x_edges, y_edges, density]: the edges of the bins along x and y, and the sum of the weights of the pairs in each
+    bin divided by the area of the bin, shape (nbins, nbins) indexed by [x bin, y bin]
+
+    """
+    x_edges, x_index = bin_indexes(np.asarray(x, dtype=float), nbins)
+    y_edges, y_index = bin_indexes(np.asarray(y, dtype=float), nbins)
+    inside = (x_index >= 0) & (y_index >= 0)
+
+    count = np.bincount(x_index[inside] * nbins + y_index[inside], weights=np.asarray(w, dtype=float)[inside],
+                        minlength=nbins * nbins).reshape(nbins, nbins)
+    area = (x_edges[1] - x_edges[0]) * (y_edges[1] - y_edges[0])
+
+    return [x_edges, y_edges, count / area]
 
 
 def mvnd_gen(m, c):
@@ -142,14 +234,44 @@ def mvnd_gen(m, c):
     -------
     a sample from the distribution
     """
-    a = list(rnd.normal(0, 1, len(m)))
-    lambdas, vect = la.eig(c)
-    print lambdas
-    tmp = np.mat(vect) * np.mat(np.diag(np.sqrt(lambdas))) * np.transpose(np.mat(a))
-    res = list()
-    for i in range(len(m)):
-        res.append(m[i] + tmp[i, 0])
-    return res
+    chol = cholesky_factors(np.asarray(c, dtype=float)[np.newaxis])[0]
+    return list(np.asarray(m, dtype=float) + np.dot(chol, rnd.normal(0, 1, len(m))))
+
+
+def cholesky_factors(covariances):
+    """
+    Return the lower Cholesky factors of a stack of covariance matrices, shape (num_matrices, d, d).
+
+    A matrix which is only positive semi-definite (eg the covariance of fewer neighbours than dimensions) is factorized
+    after adding to its diagonal the smallest multiple of its mean variance that makes it positive definite.
+    """
+    if covariances.shape[-1] == 0:
+        return covariances.copy()
+
+    try:
+        return la.cholesky(covariances)
+    except la.LinAlgError:
+        pass
+
+    factors = np.empty_like(covariances)
+    identity = np.eye(covariances.shape[-1])
+    for n in range(len(covariances)):
+        scale = np.mean(np.diag(covariances[n]))
+        if not (np.isfinite(scale) and scale > 0):
+            factors[n] = identity
+            continue
+
+        jitter = 1e-12
+        while True:
+            try:
+                factors[n] = la.cholesky(covariances[n] + jitter * scale * identity)
+                break
+            except la.LinAlgError:
+                jitter *= 10
+                if jitter > 1:
+                    factors[n] = np.sqrt(scale) * identity
+                    break
+    return factors
 
 
 def mvstdnormcdf(lower, upper, corr_coef, **kwargs):
@@ -224,7 +346,7 @@ def mvstdnormcdf(lower, upper, corr_coef, **kwargs):
     upper = np.array(upper)
     corr_coef = np.array(corr_coef)
 
-    correl = np.zeros(n * (n - 1) / 2.0)  # dtype necessary?
+    correl = np.zeros(n * (n - 1) // 2)
 
     if (lower.ndim != 1) or (upper.ndim != 1):
         raise ValueError('can handle only 1D bounds')
@@ -234,15 +356,18 @@ def mvstdnormcdf(lower, upper, corr_coef, **kwargs):
 
     if n == 2 and corr_coef.size == 1:
         correl = corr_coef
-    elif corr_coef.ndim == 1 and len(corr_coef) == n * (n - 1) / 2.0:
+    elif corr_coef.ndim == 1 and len(corr_coef) == n * (n - 1) // 2:
         correl = corr_coef
     elif corr_coef.shape == (n, n):
-        for ii in range(n):
-            for jj in range(ii):
-                correl[jj + ((ii - 2) * (ii - 1)) / 2] = corr_coef[ii, jj]
+        # mvndst expects the coefficients below the diagonal, row by row
+        correl = corr_coef[np.tril_indices(n, -1)]
     else:
         raise ValueError('corrcoef has incorrect dimension')
 
+    # mvndst needs at least one coefficient, even in one dimension
+    if correl.size == 0:
+        correl = np.zeros(1)
+
     if 'maxpts' not in kwargs:
         if n > 2:
             kwargs['maxpts'] = 10000 * n
@@ -317,6 +442,100 @@ def mvnormcdf(lower, upper, mu, c, **kwargs):
     return mvstdnormcdf(lower, upper, corr, **kwargs)
 
 
+def sample_truncated_normal(mean, scale, lower, upper):
+    """
+    Draw one sample from each of several normal distributions truncated to [lower, upper], by inverting their
+    cumulative distribution function. Bounds above the mean are handled in the lower tail, where the inversion is
+    accurate.
+
+    Parameters
+    ----------
+    mean : array of means
+    scale : standard deviations, broadcastable to the shape of mean
+    lower, upper : bounds, broadcastable to the shape of mean; they can be -np.inf or np.inf
+
+    Returns
+    -------
+    an array of samples, of the shape of mean
+
+    """
+    mean = np.asarray(mean, dtype=float)
+    a = (lower - mean) / scale
+    b = (upper - mean) / scale
+    flip = a > 0
+    a, b = np.where(flip, -b, a), np.where(flip, -a, b)
+
+    low = ndtr(a)
+    high = ndtr(b)
+    u = low + rnd.uniform(size=mean.shape) * (high - low)
+    z = ndtri(np.clip(u, np.finfo(float).tiny, 1 - np.finfo(float).eps))
+    z = np.where(flip, -z, z)
+    return np.clip(mean + scale * z, lower, upper)
+
+
+def mvnormcdf_qmc(lower, upper, means, cholesky, points):
+    """
+    Estimate, for each of several multivariate normal distributions, the probability of the box [lower, upper].
+
+    This is Genz's separation of variables estimator: the integral is transformed into one over the unit hypercube
+    whose integrand is smooth, and averaged over a set of low-discrepancy points, which is shared by all the
+    distributions.
+
+    Parameters
+    ----------
+    lower, upper : bounds of the box, shape (d,); they can contain -np.inf or np.inf
+    means : means of the distributions, shape (num_distributions, d)
+    cholesky : lower Cholesky factors of the covariances, shape (num_distributions, d, d)
+    points : points of the unit hypercube, shape (num_points, d - 1), eg from halton_sequence
+
+    Returns
+    -------
+    an array of probabilities, shape (num_distributions,)
+
+    """
+    means = np.asarray(means, dtype=float)
+    num_distributions, d = means.shape
+    a = np.asarray(lower, dtype=float) - means
+    b = np.asarray(upper, dtype=float) - means
+    tiny = np.finfo(float).eps
+
+    y = np.zeros([num_distributions, len(points), d])
+    f = np.ones([num_distributions, len(points)])
+    for i in range(d):
+        shift = np.einsum('nj,nmj->nm', cholesky[:, i, :i], y[:, :, :i])
+        scale = cholesky[:, i, i, np.newaxis]
+        low = ndtr((a[:, i, np.newaxis] - shift) / scale)
+        high = ndtr((b[:, i, np.newaxis] - shift) / scale)
+        f *= high - low
+        if i < d - 1:
+            y[:, :, i] = ndtri(np.clip(low + points[np.newaxis, :, i] * (high - low), tiny, 1 - tiny))
+
+    return np.mean(f, axis=1)
+
+
+def halton_sequence(n, dimension):
+    """
+    Return the first n points of the Halton low-discrepancy sequence in the unit hypercube, shape (n, dimension).
+    The point at the origin is skipped.
+    """
+    primes = []
+    candidate = 2
+    while len(primes) < dimension:
+        if all(candidate % p for p in primes):
+            primes.append(candidate)
+        candidate += 1
+
+    points = np.zeros([n, dimension])
+    for d in range(dimension):
+        index = np.arange(1, n + 1)
+        f = 1.0
+        while np.any(index > 0):
+            f /= primes[d]
+            points[:, d] += f * (index % primes[d])
+            index //= primes[d]
+    return points
+
+
 def k_nearest_neighbours(ind, s, k):
     """
     Compute the k nearest neighbors of a point inside a set S of points using the Euclidian distance.
@@ -348,31 +567,82 @@ def k_nearest_neighbours(ind, s, k):
     return k_min
 
 
+def k_nearest_neighbours_all(x, k):
+    """
+    Compute the k nearest neighbours of every point of a set, using the Euclidian distance. Each point is its own
+    nearest neighbour.
+
+    Parameters
+    ----------
+    x : positions of points, shape (num_points, num_dimensions)
+    k : the number of nearest-neighbours to identify
+
+    Returns
+    -------
+    an array of indexes into x, shape (num_points, min(k, num_points)), each row sorted by increasing distance
+
+    """
+    x = np.asarray(x, dtype=float)
+    k = min(k, len(x))
+    neighbours = cKDTree(x).query(x, k)[1]
+    return neighbours.reshape(len(x), k)
+
+
+def weighted_covariances(x, weights, neighbours):
+    """
+    Compute the weighted covariance matrix of each of several subsets of a set of measurements, as compute_cov does for
+    a single set.
+
+    Parameters
+    ----------
+    x : measurements, shape (num_samples, num_dimensions)
+    weights : weights, shape (num_samples,)
+    neighbours : indexes of the samples of each subset, shape (num_subsets, subset_size)
+
+    Returns
+    -------
+    an array of covariance matrices, shape (num_subsets, num_dimensions, num_dimensions)
+
+    """
+    x = np.asarray(x, dtype=float)
+    weights = np.asarray(weights, dtype=float)
+    num_subsets, subset_size = neighbours.shape
+    num_dimensions = x.shape[1]
+
+    covariances = np.empty([num_subsets, num_dimensions, num_dimensions])
+    block = max(1, covariance_block_size // max(subset_size * num_dimensions, 1))
+    for start in range(0, num_subsets, block):
+        index = neighbours[start:start + block]
+        w = weights[index]
+        xs = x[index]
+
+        total = np.sum(w, axis=1)
+        mean = np.einsum('nk,nkd->nd', w, xs) / total[:, np.newaxis]
+        dev = xs - mean[:, np.newaxis, :]
+        covariances[start:start + block] = np.einsum('nki,nkj->nij', w[:, :, np.newaxis] * dev, dev) / \
+            total[:, np.newaxis, np.newaxis]
+
+    return covariances
+
+
 def compute_cov(x, weights):
     """
     Compute the weighted covariance matrix for a set of measurements, by first calculating the weighted mean.
 
     Parameters
     ----------
-    x : measurements
+    x : measurements, x[dimension][sample]
     weights : weights
 
     Returns
     -------
 
     """
-    num_dimensions = len(x)
-    num_samples = len(x[0])
+    x = np.transpose(np.asarray(x, dtype=float))
+    weights = np.asarray(weights, dtype=float)
 
-    # Calculate weighted mean of the samples
-    m = list()
-    for d in range(num_dimensions):
-        m.append(0)
-        for sample in range(num_samples):
-            m[d] += weights[sample] * x[d][sample]
-        m[d] = m[d] / sum(weights)
-
-    return compute_optcovmat(x, weights, m)
+    dev = x - np.dot(weights, x) / np.sum(weights)
+    return np.dot(dev.T * weights, dev) / np.sum(weights)
 
 
 def compute_optcovmat(x, weights, m):
@@ -381,34 +651,43 @@ def compute_optcovmat(x, weights, m):
 
     Parameters
     ----------
-    x : measurements
+    x : measurements, x[dimension][sample]
     weights : weights
-    m : mean
+    m : mean, of length the number of dimensions
 
     Returns
     -------
 
     """
-    num_dimensions = len(x)
-    num_samples = len(x[0])
-    c = np.zeros([num_dimensions, num_dimensions], float)
+    x = np.transpose(np.asarray(x, dtype=float))
+    weights = np.asarray(weights, dtype=float)
+
+    dev = x - np.asarray(m, dtype=float)
+    return np.dot(dev.T * weights, dev) / np.sum(weights)
+
+
+def optimal_covariances(x, weights):
+    """
+    Compute, for each of a set of measurements, the weighted covariance matrix of all the measurements about that
+    measurement, as compute_optcovmat does for a single mean.
 
-    # Fill in upper-half of c
-    for sample in range(num_samples):
-        for d1 in range(num_dimensions):
-            for d2 in range(d1):
-                c[d1, d2] += weights[sample] * (x[d1][sample] - m[d1]) * (x[d2][sample] - m[d2])
+    The covariance about a point m is the weighted covariance about the weighted mean plus (mean - m)(mean - m)^T, so
+    all the matrices are obtained from a single covariance and one rank-one correction per measurement.
 
-    # Fill in lower-half by symmetry
-    c = c + np.transpose(c)
+    Parameters
+    ----------
+    x : measurements, shape (num_samples, num_dimensions)
+    weights : weights, shape (num_samples,)
 
-    # Fill in diagonal
-    for sample in range(num_samples):
-        for d1 in range(num_dimensions):
-            c[d1, d1] += weights[sample] * (x[d1][sample] - m[d1]) * (x[d1][sample] - m[d1])
+    Returns
+    -------
+    an array of covariance matrices, shape (num_samples, num_dimensions, num_dimensions)
+
+    """
+    x = np.asarray(x, dtype=float)
+    weights = np.asarray(weights, dtype=float)
 
-    # Divide every element by the total weight
-    for d1 in range(num_dimensions):
-        for d2 in range(num_dimensions):
-            c[d1, d2] = c[d2, d2] / sum(weights)
-    return c
+    mean = np.dot(weights, x) / np.sum(weights)
+    dev = x - mean
+    cov = np.dot(dev.T * weights, dev) / np.sum(weights)
+    return cov + np.einsum('ni,nj->nij', dev, dev)
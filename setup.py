@@ -14,7 +14,8 @@ setup(name='abc-sysbio',
       packages=['abcsysbio'],
 
       scripts=['scripts/run-abc-sysbio',
-               'scripts/abc-sysbio-sbml-sum'],
+               'scripts/abc-sysbio-sbml-sum',
+               'scripts/abc-sysbio-report'],
 
       requires=['libSBML',
                 'matplotlib',
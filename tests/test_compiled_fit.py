@@ -0,0 +1,46 @@
+import unittest
+
+import numpy as np
+
+from abcsysbio.CompiledFit import CompiledFit
+
+
+def reference_fit(fitting_instruction, sims):
+    """
+    Evaluate the fitting instructions on each trajectory of sims in turn, as the instructions were evaluated before they
+    were compiled.
+    """
+    out = np.zeros(sims.shape[:-1] + (len(fitting_instruction),))
+    for index in np.ndindex(*sims.shape[:-2]):
+        sample_points = sims[index]
+        for i in range(len(fitting_instruction)):
+            out[index + (slice(None), i)] = np.squeeze(eval(fitting_instruction[i], {'np': np,
+                                                                                      'sample_points': sample_points}))
+    return out
+
+
+class TestCompiledFit(unittest.TestCase):
+
+    """Apply compiled fitting instructions to integer and floating point simulations."""
+
+    def setUp(self):
+        self.sims = np.random.RandomState(1).randint(0, 50, size=(4, 2, 6, 3))
+
+    def check(self, fitting_instruction):
+        fit = CompiledFit(fitting_instruction)
+        for sims in [self.sims, self.sims.astype(np.float64)]:
+            np.testing.assert_allclose(fit.apply(sims), reference_fit(fitting_instruction, sims), rtol=1e-12)
+
+    def test_affine(self):
+        self.check(['sample_points[:, 0] + 2 * sample_points[:, 2] - 1', '-sample_points[:, 1] * 0.5'])
+
+    def test_division(self):
+        self.check(['sample_points[:, 0] / 3', '(sample_points[:, 1] + sample_points[:, 2]) / 2'])
+        self.check(['sample_points[:, 0] / 3.0', '7 / 2'])
+
+    def test_elementwise(self):
+        self.check(['np.log(sample_points[:, 0] + 1) / 2', 'sample_points[:, 1] / sample_points[:, 2].max()'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+import multiprocessing
+import os
+import shutil
+import signal
+import tempfile
+import unittest
+
+import numpy as np
+from multiprocessing.connection import AuthenticationError, Client
+
+from abcsysbio import distributed
+from abcsysbio.KernelType import KernelType
+
+import toy_models
+
+# the accepted particles of one batch, and the published population, are several times larger than the buffers of a
+# socket, so that the coordinator and the workers block on sending unless each keeps reading
+nparticles = 3000
+
+
+def run_worker(address, authkey):
+    algorithm = toy_models.make_abcsmc(KernelType.multivariate_normal_ocm, nparticles, nparticles)
+    distributed.run_worker(algorithm, address, authkey)
+
+
+class Timeout(Exception):
+    pass
+
+
+def raise_timeout(signum, frame):
+    raise Timeout()
+
+
+class TestDistributed(unittest.TestCase):
+
+    """Run populations in worker processes connected to a coordinator."""
+
+    def setUp(self):
+        self.folder = toy_models.OutputFolder()
+        self.socket_folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.folder.close()
+        shutil.rmtree(self.socket_folder)
+
+    def run_workers(self, address, authkey, nworkers=2):
+        np.random.seed(1)
+        coordinator = distributed.Coordinator(address, authkey)
+        if isinstance(coordinator.address, tuple):
+            address = '%s:%d' % coordinator.address
+        workers = [multiprocessing.Process(target=run_worker, args=(address, authkey)) for i in range(nworkers)]
+        for worker in workers:
+            worker.start()
+
+        algorithm = toy_models.make_abcsmc(KernelType.multivariate_normal_ocm, nparticles, nparticles,
+                                           coordinator=coordinator)
+        previous = signal.signal(signal.SIGALRM, raise_timeout)
+        signal.alarm(120)
+        try:
+            results = algorithm.run_fixed_schedule([[3.0], [1.5], [0.8]], self.folder.input_output(),
+                                                   store_all_results=True)
+        finally:
+            signal.alarm(0)
+            signal.signal(signal.SIGALRM, previous)
+            coordinator.close()
+            for worker in workers:
+                worker.join(30)
+                if worker.is_alive():
+                    worker.terminate()
+
+        for worker in workers:
+            self.assertEqual(worker.exitcode, 0)
+        return results
+
+    def test_unix_socket(self):
+        results = self.run_workers(os.path.join(self.socket_folder, 'coordinator'), None)
+        self.assertEqual(len(results), 3)
+        for result in results:
+            self.assertTrue(result.sampled >= nparticles)
+            self.assertTrue(np.all(np.isfinite(result.weights)))
+            self.assertAlmostEqual(result.weights.sum(), 1.0)
+
+    def test_tcp_socket(self):
+        results = self.run_workers('127.0.0.1:0', 'secret key', nworkers=1)
+        self.assertEqual(len(results), 3)
+
+    def test_tcp_requires_authkey(self):
+        authkey = os.environ.pop(distributed.authkey_variable, None)
+        try:
+            self.assertRaises(SystemExit, distributed.Coordinator, '127.0.0.1:0')
+        finally:
+            if authkey is not None:
+                os.environ[distributed.authkey_variable] = authkey
+
+    def test_wrong_authkey(self):
+        coordinator = distributed.Coordinator('127.0.0.1:0', 'secret key')
+        try:
+            self.assertRaises(AuthenticationError, Client, coordinator.address, 'AF_INET', 'wrong key')
+        finally:
+            coordinator.close()
+
+    def test_batch_order(self):
+        coordinator = distributed.Coordinator(os.path.join(self.socket_folder, 'coordinator'))
+        first, second = object(), object()
+        coordinator.workers = [first, second]
+        coordinator.worker_ids = {first: 0, second: 1}
+        coordinator.next_batch = {first: 0, second: 1}
+
+        # the first batch of the second worker waits for the first batch of the first worker
+        coordinator.pending = {(0, 1): None}
+        self.assertEqual(coordinator.next_pending_batch(), None)
+
+        coordinator.pending[(0, 0)] = None
+        coordinator.next_batch[first] = 1
+        self.assertEqual(coordinator.next_pending_batch(), (0, 0))
+        del coordinator.pending[(0, 0)]
+        self.assertEqual(coordinator.next_pending_batch(), (0, 1))
+
+        coordinator.workers = []
+        coordinator.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+import unittest
+
+import numpy as np
+
+from abcsysbio import kernels
+from abcsysbio.Covariance import Covariance
+from abcsysbio.KernelType import KernelType
+from abcsysbio.Prior import Prior
+from abcsysbio.PriorType import PriorType
+
+
+class TestPerturbParticles(unittest.TestCase):
+
+    """Perturb particles with the kernels truncated to the support of the prior."""
+
+    def setUp(self):
+        np.random.seed(1)
+        self.priors = [Prior(type=PriorType.uniform, lower_bound=0.0, upper_bound=1.0),
+                       Prior(type=PriorType.uniform, lower_bound=0.0, upper_bound=1.0)]
+
+    def test_multivariate_normal_inside(self):
+        params = np.array([[0.5, 0.5]] * 100)
+        kernel = [[0, 1], None, Covariance(np.eye(2) * 0.01)]
+        inside = kernels.perturb_particles(params, self.priors, kernel, KernelType.multivariate_normal, 0)
+        self.assertTrue(np.all(inside))
+        self.assertTrue(np.all((params >= 0) & (params <= 1)))
+        self.assertTrue(np.all(params != 0.5))
+
+    def test_multivariate_normal_negligible_mass(self):
+        # almost none of the mass of the kernel is inside the support, so the draws give up, and the particles are
+        # left as they were and reported as outside the support
+        params = np.array([[0.5, 0.5]] * 3)
+        kernel = [[0, 1], None, Covariance(np.eye(2) * 1e12)]
+        inside = kernels.perturb_particles(params, self.priors, kernel, KernelType.multivariate_normal, 0)
+        self.assertFalse(np.any(inside))
+        np.testing.assert_array_equal(params, 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import json
+import os
+import unittest
+
+import numpy as np
+
+from abcsysbio.KernelType import KernelType
+from abcsysbio.input_output import scatter_populations
+
+import toy_models
+
+
+class TestOutput(unittest.TestCase):
+
+    """Write the populations in the background thread of an OutputQueue."""
+
+    def setUp(self):
+        self.folder = toy_models.OutputFolder()
+
+    def tearDown(self):
+        self.folder.close()
+
+    def test_working_directory(self):
+        cwd = os.getcwd()
+        np.random.seed(1)
+        algorithm = toy_models.make_abcsmc(KernelType.component_wise_uniform, output_queue=2)
+        algorithm.run_fixed_schedule([[3.0], [1.5], [0.8]], self.folder.input_output())
+
+        self.assertEqual(os.getcwd(), cwd)
+        for model in ['M1', 'M2']:
+            for population in range(1, 4):
+                self.assertTrue(os.path.isdir(os.path.join(self.folder.name, 'results_' + model,
+                                                           'Population_' + repr(population))))
+
+    def test_timings(self):
+        np.random.seed(1)
+        algorithm = toy_models.make_abcsmc(KernelType.component_wise_uniform, timing=True, output_queue=2)
+        algorithm.run_fixed_schedule([[3.0], [1.5], [0.8]], self.folder.input_output())
+
+        in_file = open(os.path.join(self.folder.name, 'timings.json'))
+        timings = json.load(in_file)
+        in_file.close()
+
+        # the output of each population is recorded under that population, not the one sampled meanwhile
+        self.assertEqual([p['population'] for p in timings['populations']], [1, 2, 3])
+        for population in timings['populations']:
+            for name in ['write_pickled', 'write_data']:
+                self.assertEqual(population['phases'][name]['calls'], 1)
+
+    def test_scatter_populations(self):
+        self.assertEqual(list(scatter_populations(3, 12)), [1, 2, 3])
+        self.assertEqual(list(scatter_populations(20, 12)), range(9, 21))
+        self.assertEqual(list(scatter_populations(20, 0)), range(1, 21))
+
+
+if __name__ == '__main__':
+    unittest.main()
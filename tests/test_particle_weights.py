@@ -0,0 +1,103 @@
+import unittest
+
+import numpy as np
+
+from abcsysbio import abcsmc, kernels, statistics
+from abcsysbio.KernelType import KernelType
+from abcsysbio.PriorType import PriorType
+
+import toy_models
+
+
+def reference_weights(algorithm):
+    """
+    Compute the normalized weights of the current population one particle at a time, as the per-particle loop of
+    Abcsmc.compute_particle_weights did before it was vectorized.
+    """
+    prev = algorithm.population_prev
+    curr = algorithm.population_curr
+
+    weights = np.zeros(algorithm.nparticles)
+    for k in range(algorithm.nparticles):
+        model_num = curr.models[k]
+        model = algorithm.models[model_num]
+        this_param = list(curr.particle_parameters(k))
+
+        particle_prior = 1
+        for n in range(model.nparameters):
+            this_prior = model.prior[n]
+            x = 1.0
+            if this_prior.type == PriorType.normal:
+                x = statistics.get_pdf_gauss(this_prior.mean, np.sqrt(this_prior.variance), this_param[n])
+            if this_prior.type == PriorType.uniform:
+                x = statistics.get_pdf_uniform(this_prior.lower_bound, this_prior.upper_bound, this_param[n])
+            if this_prior.type == PriorType.lognormal:
+                x = statistics.get_pdf_lognormal(this_prior.mu, np.sqrt(this_prior.sigma), this_param[n])
+            particle_prior = particle_prior * x
+
+        numerator = algorithm.b[k] * algorithm.modelprior[model_num] * particle_prior
+
+        s1 = 0
+        for i in range(algorithm.nmodel):
+            s1 += prev.margins[i] * abcsmc.get_model_kernel_pdf(model_num, i, algorithm.modelKernel, algorithm.nmodel,
+                                                                algorithm.dead_models)
+        s2 = 0
+        for j in range(algorithm.nparticles):
+            if int(model_num) == int(prev.models[j]):
+                kernel_pdf = kernels.get_parameter_kernel_pdf(this_param, list(prev.particle_parameters(j)),
+                                                              model.prior, algorithm.kernels[model_num],
+                                                              algorithm.kernel_aux[j], algorithm.kernel_type)
+                s2 += prev.weights[j] * kernel_pdf
+
+        weights[k] = prev.margins[model_num] * numerator / (s1 * s2)
+
+    return weights / np.sum(weights)
+
+
+class TestParticleWeights(unittest.TestCase):
+
+    """Compare the vectorized particle weights with the per-particle reference, for each kernel."""
+
+    def setUp(self):
+        self.folder = toy_models.OutputFolder()
+
+    def tearDown(self):
+        self.folder.close()
+
+    def check_weights(self, kernel_type):
+        np.random.seed(1)
+        algorithm = toy_models.make_abcsmc(kernel_type)
+        compute_particle_weights = algorithm.compute_particle_weights
+        computed = []
+
+        def compare_weights():
+            compute_particle_weights()
+            log_weights = algorithm.population_curr.log_weights
+            computed.append((np.exp(log_weights - np.logaddexp.reduce(log_weights)), reference_weights(algorithm)))
+
+        algorithm.compute_particle_weights = compare_weights
+        algorithm.run_fixed_schedule([[3.0], [1.5], [0.8]], self.folder.input_output())
+
+        # the weights of the populations after the first, which is sampled from the prior
+        self.assertEqual(len(computed), 2)
+        for weights, reference in computed:
+            np.testing.assert_allclose(weights, reference, rtol=1e-8, atol=1e-12)
+
+    def test_component_wise_uniform(self):
+        self.check_weights(KernelType.component_wise_uniform)
+
+    def test_component_wise_normal(self):
+        self.check_weights(KernelType.component_wise_normal)
+
+    def test_multivariate_normal(self):
+        self.check_weights(KernelType.multivariate_normal)
+
+    def test_multivariate_normal_nn(self):
+        self.check_weights(KernelType.multivariate_normal_nn)
+
+    def test_multivariate_normal_ocm(self):
+        self.check_weights(KernelType.multivariate_normal_ocm)
+
+
+if __name__ == '__main__':
+    unittest.main()
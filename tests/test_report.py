@@ -0,0 +1,66 @@
+import os
+import unittest
+
+import matplotlib.pyplot as plt
+import numpy as np
+
+from abcsysbio import report
+from abcsysbio.KernelType import KernelType
+
+import toy_models
+
+
+class TestReport(unittest.TestCase):
+
+    """Draw the figures of a finished run from the binary files of its results folder."""
+
+    def setUp(self):
+        # the figures are drawn without a display, as by abc-sysbio-report
+        plt.switch_backend('Agg')
+
+        # a page of the per-particle trajectories takes a tenth of a second to draw
+        self.max_particles_by_particle = report.max_particles_by_particle
+        report.max_particles_by_particle = 5
+        self.folder = toy_models.OutputFolder()
+        np.random.seed(1)
+        algorithm = toy_models.make_abcsmc(KernelType.component_wise_uniform)
+        algorithm.run_fixed_schedule([[3.0], [1.5], [0.8]], self.folder.input_output())
+
+    def tearDown(self):
+        report.max_particles_by_particle = self.max_particles_by_particle
+        self.folder.close()
+
+    def test_tasks_hold_population_numbers(self):
+        # the tasks are not sent the particles, whose size would grow with the number of populations plotted
+        def assert_small(arg):
+            self.assertFalse(isinstance(arg, report.AbcsmcResults))
+            if isinstance(arg, np.ndarray):
+                self.assertTrue(arg.size < 100)
+            elif isinstance(arg, (list, tuple)):
+                for a in arg:
+                    assert_small(a)
+
+        tasks = report.report_tasks(self.folder.name)
+        report.population_cache.clear()
+        for function, args in tasks:
+            assert_small(args)
+
+    def test_generate_report(self):
+        nfigures = report.generate_report(self.folder.name, None, 2, False)
+        self.assertTrue(nfigures > 0)
+        self.assertEqual(report.population_cache, {})
+
+        folder = self.folder.name
+        self.assertTrue(os.path.exists(os.path.join(folder, 'ModelMargins.png')))
+        for model in ['M1', 'M2']:
+            for population in range(1, 4):
+                path = os.path.join(folder, 'results_' + model, 'Population_' + repr(population))
+                names = os.listdir(path)
+                for prefix in ['ScatterPlots_Population', 'weightedHistograms_Population', 'PairPlot_Population',
+                               'Histograms_Population', 'Timeseries_Population']:
+                    self.assertTrue(any(name.startswith(prefix + repr(population)) for name in names), (path, prefix))
+                self.assertTrue('Timeseries_Population' + repr(population) + '_byp.pdf' in names)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import unittest
+
+import numpy as np
+
+from abcsysbio.KernelType import KernelType
+
+import toy_models
+
+
+class TestRestart(unittest.TestCase):
+
+    """Restart a run from its pickled population, with each kernel, and sample one more population."""
+
+    def setUp(self):
+        self.folder = toy_models.OutputFolder()
+
+    def tearDown(self):
+        self.folder.close()
+
+    def check_restart(self, kernel_type):
+        np.random.seed(1)
+        first = toy_models.make_abcsmc(kernel_type)
+        first.run_fixed_schedule([[3.0], [1.5]], self.folder.input_output())
+
+        second = toy_models.make_abcsmc(kernel_type)
+        io = self.folder.input_output(restart=True)
+        second.fill_values(io.read_pickled(self.folder.name))
+
+        for aux, restored in zip(first.kernel_aux, second.kernel_aux):
+            np.testing.assert_allclose(restored, aux)
+
+        results = second.run_fixed_schedule([[0.8]], io, store_all_results=True)
+        weights = results[-1].weights
+        self.assertTrue(np.all(np.isfinite(weights)))
+        self.assertAlmostEqual(weights.sum(), 1.0)
+
+    def test_component_wise_uniform(self):
+        self.check_restart(KernelType.component_wise_uniform)
+
+    def test_component_wise_normal(self):
+        self.check_restart(KernelType.component_wise_normal)
+
+    def test_multivariate_normal(self):
+        self.check_restart(KernelType.multivariate_normal)
+
+    def test_multivariate_normal_nn(self):
+        self.check_restart(KernelType.multivariate_normal_nn)
+
+    def test_multivariate_normal_ocm(self):
+        self.check_restart(KernelType.multivariate_normal_ocm)
+
+
+if __name__ == '__main__':
+    unittest.main()
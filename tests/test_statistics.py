@@ -0,0 +1,95 @@
+import unittest
+
+import numpy as np
+
+from abcsysbio import statistics
+
+
+def reference_covariance(x, weights, m):
+    """
+    The weighted covariance of the rows of x about m, summed one measurement at a time.
+    """
+    cov = np.zeros((x.shape[1], x.shape[1]))
+    for k in range(len(x)):
+        dev = x[k] - m
+        cov += weights[k] * np.outer(dev, dev)
+    return cov / np.sum(weights)
+
+
+def reference_bin_data(d, w, nbins):
+    """
+    The weighted histogram of d, with each value put in the first bin (l, u] holding it.
+    """
+    d_max = np.max(d)
+    d_min = np.min(d) - 1e-6
+    bin_width = (d_max - d_min) / nbins
+    count = np.zeros(nbins)
+    for k in range(len(d)):
+        for i in range(nbins):
+            if d_min + i * bin_width < d[k] <= d_min + (i + 1) * bin_width:
+                count[i] += w[k]
+                break
+    return count
+
+
+class TestOptimalCovariances(unittest.TestCase):
+
+    """Compare the covariances of the OCM kernel with an explicit sum over the particles."""
+
+    def setUp(self):
+        rnd = np.random.RandomState(1)
+        self.x = rnd.normal(size=(50, 3)) * [1.0, 10.0, 0.01]
+        self.weights = rnd.uniform(size=50)
+
+    def test_optimal_covariances(self):
+        covariances = statistics.optimal_covariances(self.x, self.weights)
+        self.assertEqual(covariances.shape, (50, 3, 3))
+        for i in range(len(self.x)):
+            np.testing.assert_allclose(covariances[i], reference_covariance(self.x, self.weights, self.x[i]),
+                                       rtol=1e-10, atol=1e-14)
+
+    def test_compute_optcovmat(self):
+        m = self.x[7]
+        np.testing.assert_allclose(statistics.compute_optcovmat(self.x.T, self.weights, m),
+                                   reference_covariance(self.x, self.weights, m), rtol=1e-10, atol=1e-14)
+
+
+class TestBinData(unittest.TestCase):
+
+    """Compare the weighted histograms with the bins filled one value at a time."""
+
+    def test_bin_data(self):
+        rnd = np.random.RandomState(1)
+        d = rnd.uniform(size=200)
+        w = rnd.uniform(size=200)
+        bin_c, count = statistics.bin_data(d, w, 9)
+        np.testing.assert_allclose(count, reference_bin_data(d, w, 9), rtol=1e-12)
+        self.assertAlmostEqual(bin_c[1] - bin_c[0], (np.max(d) - np.min(d) + 1e-6) / 9)
+
+    def test_interior_edges(self):
+        # values on the edges between bins are counted in the lower bin
+        d_min = -1e-6
+        edges = d_min + np.arange(5) * ((4.0 - d_min) / 4)
+        d = np.concatenate([[0.0, 4.0], edges[1:-1], edges[1:-1]])
+        w = np.arange(1.0, len(d) + 1)
+        count = statistics.bin_data(d, w, 4)[1]
+        np.testing.assert_array_equal(count, reference_bin_data(d, w, 4))
+        self.assertEqual(np.sum(count), np.sum(w))
+
+    def test_bin_data_2d(self):
+        rnd = np.random.RandomState(2)
+        x = rnd.randint(0, 5, size=100).astype(float)
+        y = rnd.randint(0, 5, size=100).astype(float)
+        w = rnd.uniform(size=100)
+        x_edges, y_edges, density = statistics.bin_data_2d(x, y, w, 4)
+        area = (x_edges[1] - x_edges[0]) * (y_edges[1] - y_edges[0])
+        for i in range(4):
+            column = (x > x_edges[i]) & (x <= x_edges[i + 1])
+            # the extremes of y, with no weight, give the bins of y
+            np.testing.assert_allclose(density[i] * area, reference_bin_data(
+                np.concatenate([[np.min(y), np.max(y)], y[column]]), np.concatenate([[0.0, 0.0], w[column]]), 4),
+                rtol=1e-12)
+
+
+if __name__ == '__main__':
+    unittest.main()
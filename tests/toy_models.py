@@ -0,0 +1,77 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from abcsysbio import abcsmc, abcModel, input_output
+from abcsysbio.Prior import Prior
+from abcsysbio.PriorType import PriorType
+
+timepoints = np.linspace(0, 5, 8)
+
+
+class Data:
+    def __init__(self, timepoints, values):
+        self.timepoints = timepoints
+        self.values = values
+
+
+def decay(params):
+    """
+    Simulate x' = -k x and the accumulated product, for each row [x0, k] of params.
+    """
+    params = np.asarray(params)
+    out = np.empty((len(params), 1, len(timepoints), 2))
+    decayed = np.exp(-params[:, 1:2] * timepoints)
+    out[:, 0, :, 0] = params[:, 0:1] * decayed
+    out[:, 0, :, 1] = params[:, 0:1] * (1 - decayed)
+    return out
+
+
+def decay_offset(params):
+    """
+    As decay, with a constant offset params[:, 2] added to x.
+    """
+    out = decay(params)
+    out[:, 0, :, 0] += np.asarray(params)[:, 2:3]
+    return out
+
+
+def make_models():
+    """
+    Return two competing models of the decay data, with uniform, normal, lognormal and constant priors.
+    """
+    uniform = Prior(type=PriorType.uniform, lower_bound=0.0, upper_bound=3.0)
+    normal = Prior(type=PriorType.normal, mean=0.5, variance=0.25)
+    lognormal = Prior(type=PriorType.lognormal, mu=0.0, sigma=0.5)
+    constant = Prior(type=PriorType.constant, value=0.0)
+    return [abcModel.AbcModel('M1', decay, None, [uniform, normal], 2),
+            abcModel.AbcModel('M2', decay_offset, None, [lognormal, uniform, constant], 3)]
+
+
+def make_data():
+    return Data(timepoints, decay([[1.0, 0.5]])[0, 0])
+
+
+def make_abcsmc(kernel_type, nparticles=100, nbatch=20, timing=False, output_queue=0, **kwargs):
+    return abcsmc.Abcsmc(make_models(), nparticles, [0.5, 0.5], make_data(), 1, nbatch, 0.7, 0, timing,
+                         kernel_type=kernel_type, output_queue=output_queue, **kwargs)
+
+
+class OutputFolder:
+    """
+    A temporary folder holding the output of a run, removed by close.
+    """
+
+    def __init__(self):
+        self.root = tempfile.mkdtemp()
+        self.name = os.path.join(self.root, 'results')
+
+    def input_output(self, restart=False):
+        io = input_output.InputOutput(self.name, restart, False, False)
+        io.create_output_folders(['M1', 'M2'], 0, True, False)
+        return io
+
+    def close(self):
+        shutil.rmtree(self.root)